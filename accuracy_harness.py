@@ -0,0 +1,241 @@
+"""
+Accuracy versus cost of the Monte Carlo estimator, using the enumerators as the ground truth.
+
+A small n-gram or backoff model is trained, and every password whose minus log prob is less than `--min-prob` is
+enumerated by nwords.nwords_enumerator or backwords.backwords_enumerator from the probabilities of the model itself.
+Therefore, the exact guess number of a minus log prob m in the head of the distribution is the number of enumerated
+passwords whose minus log probs are not larger than m. The head is divided into log-spaced checkpoints, and the
+Monte Carlo estimates at the checkpoints are compared with the exact guess numbers for several sample sizes and
+samplers, each repeated with different seeds. For each (sampler, size), the CPU seconds, the memory and the
+errors of the estimates (relative error = estimate / exact - 1) are saved as JSON.
+
+The samplers and the enumerators drop the passwords shorter than `min_len`. The samplers start again instead,
+which draws from the model conditioned on the length, so the estimates are biased by 1 / P(length >= min_len).
+The tempered sampler corrects its weights by the acceptance rate of the proposal instead (see accept_proposals in
+lib4mc/MonteCarloParent.py), so its estimates are not biased.
+The bias is reported for each checkpoint besides the errors, to tell the systematic error from the sampling noise.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import List, Dict, Any
+
+import numpy
+
+from benchmark import CorpusGenerator, commit_of_tree, train
+from lib4mc.MonteCarloLib import MonteCarloLib
+from lib4mc.PerfLib import phase, recorder
+
+FAMILIES = ["nwords", "backwords"]
+# the enumerators save minus log probs with 5 (backwords) or 8 (nwords) decimals,
+# the ground truth and the estimates are compared at checkpoint + EPS so that rounding does not split ties
+EPS = 1e-5
+
+
+def ground_truth(model, family: str, min_prob: float, workdir: str) -> numpy.ndarray:
+    """
+    enumerate the passwords of the model whose minus log probs are less than min_prob
+    :param model: NWordsMonteCarlo or BackWordsMonteCarlo
+    :param family: nwords or backwords
+    :param min_prob: threshold of minus log probs
+    :param workdir: the enumerated passwords are saved here
+    :return: sorted minus log probs of the enumerated passwords
+    """
+    # the enumerators replace the probs by minus log probs in place, so they work on copies
+    probs = {ctx: dict(expanded[0]) for ctx, expanded in model.nwords.items()}
+    path = os.path.join(workdir, f"enumerated-{family}.txt")
+    with open(path, 'w') as f_save:
+        if family == "nwords":
+            from nwords.nwords_enumerator import enumerator
+            enumerator(probs, threshold=min_prob, start_chr=model.start_chr, end_chr=model.end_chr,
+                       min_len=model.min_len, f_save=f_save, order=len(model.default_start))
+        else:
+            from backwords.backwords_enumerator import enumerator
+            enumerator(probs, min_prob, model.start_chr, model.end_chr, model.min_len, f_save)
+    with open(path) as fin:
+        minus_log_probs = numpy.array([float(line.rstrip("\r\n").rsplit("\t", 1)[1]) for line in fin])
+    minus_log_probs.sort()
+    return minus_log_probs
+
+
+def checkpoints_of(truth: numpy.ndarray, points: int) -> List[Dict[str, Any]]:
+    """
+    :param truth: sorted minus log probs of the enumerated passwords
+    :param points: number of log-spaced checkpoints
+    :return: minus log prob and exact guess number of each checkpoint
+    """
+    if len(truth) == 0:
+        return []
+    ranks = numpy.unique(numpy.logspace(0, numpy.log10(len(truth)), points).round().astype(int))
+    checkpoints, seen = [], set()
+    for rank in ranks.tolist():
+        mlp = float(truth[rank - 1]) + EPS
+        guesses = int(numpy.searchsorted(truth, mlp, side='right'))
+        if guesses in seen:
+            continue
+        seen.add(guesses)
+        checkpoints.append({"minus_log_prob": mlp, "guesses": guesses})
+    return checkpoints
+
+
+def draw(model, sampler: str, size: int, seed: int, args) -> MonteCarloLib:
+    """
+    :param sampler: plain, lockstep or tempered-<temperature>
+    :return: rank table of `size` samples drawn by the sampler
+    """
+    if sampler == "plain":
+        return MonteCarloLib(model.sample(size, workers=args.workers, seed=seed))
+    if sampler == "lockstep":
+        minus_log_probs, _ = model.sample_lockstep(size, width=args.width, seed=seed)
+        return MonteCarloLib(minus_log_probs.tolist())
+    if sampler.startswith("tempered-"):
+        temperature = float(sampler[len("tempered-"):])
+        minus_log_probs, minus_log_proposals = model.sample_tempered(size, temperature, workers=args.workers,
+                                                                     seed=seed)
+        return MonteCarloLib(minus_log_probs, minus_log_proposals)
+    raise Exception(f"Unknown sampler: {sampler}")
+
+
+def evaluate(model, sampler: str, size: int, checkpoints: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    """
+    run the sampler `args.repeat` times with seeds args.seed, args.seed + 1, ...
+    :return: costs and errors of the estimates at the checkpoints
+    """
+    mlps = numpy.array([c["minus_log_prob"] for c in checkpoints])
+    exact = numpy.array([c["guesses"] for c in checkpoints], dtype=float)
+    rel_errs, predicted, costs = [], [], []
+    for rep in range(args.repeat):
+        with phase(f"{sampler}-{size}", items=size) as record:
+            mc = draw(model, sampler, size, args.seed + rep, args)
+        costs.append(record)
+        rel_errs.append(mc.ml2p_arr2position(mlps) / exact - 1)
+        predicted.append([numpy.nan if e["rel_err"] is None else e["rel_err"]
+                          for e in mc.rank_errors(exact.astype(int).tolist())])
+    rel_errs, predicted = numpy.array(rel_errs), numpy.array(predicted)
+    abs_errs = numpy.abs(rel_errs)
+    per_checkpoint = []
+    for i, checkpoint in enumerate(checkpoints):
+        reached = predicted[:, i][~numpy.isnan(predicted[:, i])]
+        per_checkpoint.append({
+            **checkpoint,
+            "median_abs_rel_err": float(numpy.median(abs_errs[:, i])),
+            "rms_rel_err": float(numpy.sqrt(numpy.mean(rel_errs[:, i] ** 2))),
+            "bias": float(numpy.mean(rel_errs[:, i])),
+            # the standard error reported by the rank table itself, None if the table does not reach the checkpoint
+            "predicted_rel_err": float(numpy.median(reached)) if len(reached) > 0 else None,
+        })
+    # a sample is a minus log prob and a position, and a minus log proposal for importance sampling
+    table_mb = size * (24 if sampler.startswith("tempered-") else 16) / (1 << 20)
+    traced = [r["peak_traced_mb"] for r in costs if r.get("peak_traced_mb") is not None]
+    return {
+        "sampler": sampler, "size": size, "repeat": args.repeat,
+        "wall_s": float(numpy.mean([r["wall_s"] for r in costs])),
+        "cpu_s": float(numpy.mean([r["cpu_s"] for r in costs])),
+        "peak_traced_mb": max(traced) if len(traced) > 0 else None,
+        "peak_rss_mb": costs[-1]["peak_rss_mb"],
+        "table_mb": table_mb,
+        "median_abs_rel_err": float(numpy.median(abs_errs)) if abs_errs.size > 0 else None,
+        "max_abs_rel_err": float(abs_errs.max()) if abs_errs.size > 0 else None,
+        "checkpoints": per_checkpoint,
+    }
+
+
+def harness(args) -> dict:
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        corpus = args.pwd_file
+        if corpus is None:
+            corpus = os.path.join(workdir, f"train-{args.format}.txt")
+            CorpusGenerator(args.seed, args.vocab, args.zipf).write(corpus, args.corpus_size, args.format)
+        with phase("train"):
+            model = train(args.family, corpus, args.format, args.ngram, args.threshold)
+        with phase("enumerate") as record:
+            truth = ground_truth(model, args.family, args.min_prob, workdir)
+            record["items"] = len(truth)
+    print(f"{len(truth)} passwords enumerated, minus log prob < {args.min_prob}", file=sys.stderr)
+    checkpoints = checkpoints_of(truth, args.points)
+    if len(checkpoints) == 0:
+        raise Exception(f"No password is enumerated, try a larger --min-prob than {args.min_prob}")
+    samplers = ["plain", "lockstep"] + [f"tempered-{t:g}" for t in args.temperatures]
+    samplers = [s for s in samplers if s.split("-")[0] in args.samplers]
+    if "lockstep" in samplers:
+        # the arrays are built once, not in every run of the lockstep sampler
+        with phase("lockstep arrays"):
+            model.lockstep_sampler()
+    results = []
+    print(f"{'sampler':>14} {'size':>10} {'cpu (s)':>9} {'table (MB)':>10} {'traced (MB)':>11} "
+          f"{'median |err|':>12} {'max |err|':>10}", file=sys.stderr)
+    for size in args.sizes:
+        for sampler in samplers:
+            result = evaluate(model, sampler, size, checkpoints, args)
+            results.append(result)
+            traced = result["peak_traced_mb"]
+            print(f"{sampler:>14} {size:>10} {result['cpu_s']:9.3f} {result['table_mb']:10.3f} "
+                  f"{'-' if traced is None else f'{traced:.3f}':>11} "
+                  f"{result['median_abs_rel_err']:12.4f} {result['max_abs_rel_err']:10.4f}", file=sys.stderr)
+    return {
+        "tree": commit_of_tree(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "args": {k: v for k, v in vars(args).items() if k != "save"},
+        "enumerated": len(truth),
+        "checkpoints": checkpoints,
+        "results": results,
+    }
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Accuracy versus cost of the Monte Carlo estimator")
+    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
+                     help="save the results here (JSON)")
+    cli.add_argument("--family", dest="family", type=str, required=False, default="nwords", choices=FAMILIES,
+                     help="model family, the ground truth is given by its enumerator")
+    cli.add_argument("-f", "--pwd-file", dest="pwd_file", type=str, required=False, default=None,
+                     help="training file in the format of `--format`, a synthetic corpus is generated if not given")
+    cli.add_argument("--format", dest="format", type=str, required=False, default="chars",
+                     choices=["chars", "segmented"], help="format of the training file, see benchmark.py")
+    cli.add_argument("--corpus-size", dest="corpus_size", type=int, required=False, default=10000,
+                     help="number of passwords of the synthetic corpus")
+    cli.add_argument("--vocab", dest="vocab", type=int, required=False, default=500,
+                     help="number of base words of the synthetic corpus")
+    cli.add_argument("--zipf", dest="zipf", type=float, required=False, default=1.1,
+                     help="exponent of the Zipf distributions of the synthetic corpus")
+    cli.add_argument("--ngram", dest="ngram", type=int, required=False, default=3, help="n of nwords, at least 2")
+    cli.add_argument("--threshold", dest="threshold", type=int, required=False, default=5,
+                     help="threshold of backwords")
+    cli.add_argument("-p", "--min-prob", dest="min_prob", type=float, required=False, default=20,
+                     help="enumerate the passwords whose minus log probs are less than this as the ground truth")
+    cli.add_argument("--points", dest="points", type=int, required=False, default=20,
+                     help="number of log-spaced checkpoints in the enumerated head")
+    cli.add_argument("--sizes", dest="sizes", type=int, nargs="+", required=False,
+                     default=[1000, 10000, 100000], help="sample sizes")
+    cli.add_argument("--samplers", dest="samplers", type=str, nargs="+", required=False,
+                     default=["plain", "lockstep", "tempered"], choices=["plain", "lockstep", "tempered"],
+                     help="samplers to evaluate")
+    cli.add_argument("--temperatures", dest="temperatures", type=float, nargs="+", required=False, default=[2.0],
+                     help="temperatures of the tempered sampler")
+    cli.add_argument("--width", dest="width", type=int, required=False, default=4096,
+                     help="number of chains of the lockstep sampler")
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help="number of processes of the plain and tempered samplers")
+    cli.add_argument("--repeat", dest="repeat", type=int, required=False, default=5,
+                     help="run each (sampler, size) this many times with different seeds")
+    cli.add_argument("--seed", dest="seed", type=int, required=False, default=0,
+                     help="seed of the synthetic corpus and of sampling")
+    cli.add_argument("--trace-memory", dest="trace_memory", required=False, action="store_true",
+                     help="record the peak memory of python objects by tracemalloc, which inflates the CPU time")
+    cli.add_argument("--workdir", dest="workdir", type=str, required=False, default=None,
+                     help="folder of the temporary corpus and enumerated passwords")
+    args = cli.parse_args()
+    if args.family == "nwords" and args.ngram < 2:
+        cli.error("--ngram should be at least 2")
+    recorder.enable(quiet=True, trace_memory=args.trace_memory)
+    report = harness(args)
+    json.dump(report, args.save, indent=2)
+    args.save.close()
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
@@ -1,8 +1,13 @@
 from math import log2
 from typing import Dict, Tuple, TextIO, List
 
+from lib4mc.FlatLib import FlatModel
+
 
 def minus_log2(backwords_dict_float: Dict[Tuple, Dict[str, float]]):
+    if isinstance(backwords_dict_float, FlatModel):
+        # the arrays are kept, the minus log probs of a prefix are computed when it is first reached
+        return backwords_dict_float.dicts(minus_log_based=True)
     for previous, items in backwords_dict_float.items():
         for item, prob in items.items():
             items[item] = -log2(prob)
@@ -1,14 +1,17 @@
 """
 Backoff words
 """
+import pickle
 import re
 import sys
 from collections import defaultdict
-from typing import TextIO, Dict, Tuple, List, Union
+from functools import partial
+from typing import BinaryIO, TextIO, Dict, Tuple, List, Union
 
-from tqdm import tqdm
-
-from lib4mc.FileLib import wc_l
+from lib4mc.CountLib import count_all_orders, count_sections
+from lib4mc.FlatLib import FlatModel
+from lib4mc.PerfLib import progress
+from lib4mc.SaveModelLib import is_model_file, open_model, save_model
 
 
 def parse_line(line: str, splitter: str, start4words: int, step4words: int):
@@ -23,61 +26,47 @@ def parse_line(line: str, splitter: str, start4words: int, step4words: int):
 def backwords_counter(nwords_list: TextIO, splitter: str, start_chr: str, end_chr: str,
                       start4words: int, step4words: int, max_gram: int, threshold: int,
                       nwords_dict: Dict[Tuple, Dict[str, int]] = None,
-                      words: Dict[str, int] = None):
+                      words: Dict[str, int] = None, workers: int = 1):
+    """
+    :param workers: number of processes to count the lines, see lib4mc.CountLib.count_sections
+    """
     if nwords_dict is None:
         nwords_dict: Dict[Tuple, Dict[str, int]] = {}
         words: Dict[str, int] = {}
     zero = tuple()
-    if isinstance(nwords_list, list):
-        line_num = len(nwords_list)
-    else:
-        line_num = wc_l(nwords_list)
-    if line_num == 0:
-        print("No passwords for training, early return!", file=sys.stderr)
-        return nwords_dict, words
     section_dict = defaultdict(lambda: defaultdict(int))
     actual_max_gram = 2
-    for line in tqdm(nwords_list, total=line_num, desc="Reading: "):  # type: str
-        line = line.strip("\r\n")
-        sections = [start_chr]
-        sections.extend(parse_line(line, splitter, start4words, step4words))
-        sections.append(end_chr)
+    sections_counts = count_sections(
+        nwords_list, partial(parse_line, splitter=splitter, start4words=start4words, step4words=step4words),
+        head=(start_chr,), tail=(end_chr,), workers=workers)
+    # the unique sections are in the order of first appearance, so the tables are in the same order as counting
+    # the lines one by one
+    for sections, cnt in sections_counts.items():
         for sec in sections:
             if sec not in words:
                 words[sec] = 0
-            words[sec] += 1
+            words[sec] += cnt
             if sec not in {start_chr}:
                 if zero not in nwords_dict:
                     nwords_dict[zero] = {}
                 if sec not in nwords_dict[zero]:
                     nwords_dict[zero][sec] = 0
-                nwords_dict[zero][sec] += 1
+                nwords_dict[zero][sec] += cnt
 
-        section_dict[len(sections)][tuple(sections)] += 1
+        section_dict[len(sections)][sections] = cnt
         if len(sections) > actual_max_gram:
             actual_max_gram = len(sections)
-    pass
+    del sections_counts
+    if len(section_dict) == 0:
+        # the lines are streamed, so it is known only after reading
+        print("No passwords for training, early return!", file=sys.stderr)
+        return nwords_dict, words
 
-    for n in tqdm(range(2, min(max_gram, actual_max_gram) + 1), desc="N-Gram: "):
-        tmp_nwords_dict: Dict[Tuple, Dict[str, int]] = {}
-        for sec_len, sec_len_dict in section_dict.items():
-            if sec_len < n:
-                continue
-            order = n - 1
-            for sec, cnt in sec_len_dict.items():
-                for i in range(0, sec_len - order):
-                    prefix = sec[i:i + order]
-                    transition = sec[i + order]
-
-                    if prefix not in tmp_nwords_dict:
-                        tmp_nwords_dict[prefix] = {}
-                    if transition not in tmp_nwords_dict[prefix]:
-                        tmp_nwords_dict[prefix][transition] = 0
-                    tmp_nwords_dict[prefix][transition] += cnt
-                pass
-            pass
-        if len(tmp_nwords_dict) == 0:
-            break
+    max_order = min(max_gram, actual_max_gram)
+    all_orders = count_all_orders(
+        ((sec, cnt) for sec_len_dict in section_dict.values() for sec, cnt in sec_len_dict.items()),
+        max_order=max_order, min_count=threshold, keep=nwords_dict)
+    for n, tmp_nwords_dict in progress(all_orders, desc="N-Gram: ", total=max_order - 1):
         """
         NOTION: Here I assume that we only supply the cracked passwords as secondary training file.
                 According to the assumption above, the model will first remove transitions whose appearance 
@@ -99,7 +88,14 @@ def backwords_counter(nwords_list: TextIO, splitter: str, start_chr: str, end_ch
     return nwords_dict, words
 
 
-def freq2prob(nwords_dict: Dict[Tuple, List[Union[Dict[str, int], int]]], threshold: int) -> Dict:
+def freq2prob(nwords_dict: Dict[Tuple, List[Union[Dict[str, int], int]]], threshold: int,
+              flat: bool = False) -> Union[Dict, FlatModel]:
+    """
+    :param nwords_dict: prefix -> (transition -> count)
+    :param threshold: transitions whose counts are less than threshold are ignored
+    :param flat: return the model as a FlatModel instead of dicts
+    :return: prefix -> (transition -> prob)
+    """
     nwords_float_dict: Dict[Tuple, Dict[str, float]] = {}
     for prefix, trans_cnt in sorted(nwords_dict.items(), key=lambda x: len(x[0])):
         total = sum(trans_cnt.values())
@@ -118,4 +114,36 @@ def freq2prob(nwords_dict: Dict[Tuple, List[Union[Dict[str, int], int]]], thresh
                 trans_prob[trans] = trans_prob.get(trans, .0) + p * missing
         nwords_float_dict[prefix] = trans_prob
 
+    if flat:
+        return FlatModel.from_dict(nwords_float_dict, consume=True)
     return nwords_float_dict
+
+
+def save_secondary_model(path: str, nwords_dict: Dict[Tuple, Dict[str, int]], words: Dict[str, int],
+                         config: dict, binary: bool = False):
+    """
+    :param path: save the model here
+    :param nwords_dict: prefix -> (transition -> count)
+    :param words: word -> count
+    :param config: start_chr, end_chr, max_gram, threshold, training_list and so on
+    :param binary: save the model in the binary format (see SaveModelLib) instead of pickle, with the counts to
+        continue the training and the probs to sample and score
+    """
+    if not binary:
+        with open(path, 'wb') as fout:
+            pickle.dump((nwords_dict, words, config), file=fout)
+        return
+    save_model(path, {'counts': FlatModel.from_dict(nwords_dict),
+                      'probs': freq2prob(nwords_dict, config['threshold'], flat=True)}, words, config)
+    pass
+
+
+def load_secondary_model(file: BinaryIO) -> Tuple[Dict[Tuple, Dict[str, int]], Dict[str, int], dict]:
+    """
+    :param file: model saved by save_secondary_model, in pickle or in the binary format
+    :return: prefix -> (transition -> count), word -> count and the config
+    """
+    if is_model_file(file):
+        sections, words, config = open_model(file.name)
+        return sections['counts'].to_dict(integral=True), words, config
+    return pickle.load(file)
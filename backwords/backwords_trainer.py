@@ -4,11 +4,12 @@ Backoff words
 import re
 import sys
 from collections import defaultdict
+from functools import partial
 from typing import TextIO, Dict, Tuple
 
-from tqdm import tqdm
-
-from lib4mc.FileLib import wc_l
+from lib4mc.CountLib import count_all_orders, count_sections
+from lib4mc.FlatLib import FlatModel
+from lib4mc.PerfLib import progress
 
 
 def parse_line(line: str, splitter: str, start4words: int, step4words: int):
@@ -21,24 +22,30 @@ def parse_line(line: str, splitter: str, start4words: int, step4words: int):
 
 
 def backwords_counter(nwords_list: TextIO, splitter: str, start_chr: str, end_chr: str,
-                      start4words: int, step4words: int, threshold: int, max_gram: int):
+                      start4words: int, step4words: int, threshold: int, max_gram: int, flat: bool = False,
+                      workers: int = 1):
+    """
+    :param flat: return the model as a FlatModel instead of dicts
+    :param workers: number of processes to count the lines, see lib4mc.CountLib.count_sections
+    :return: model, i.e., prefix -> (transition -> prob), and the counts of words
+    """
     nwords_dict: Dict[Tuple, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
     zero = tuple()
     nwords_float_dict = {zero: {}}
-    line_num = wc_l(nwords_list)
     words: Dict[str, int] = defaultdict(int)
     section_dict = defaultdict(lambda: defaultdict(int))
-    for line in tqdm(nwords_list, total=line_num, desc="Reading: "):  # type: str
-        line = line.strip("\r\n")
-        sections = [start_chr]
-        sections.extend(parse_line(line, splitter, start4words, step4words))
-        sections.append(end_chr)
+    sections_counts = count_sections(
+        nwords_list, partial(parse_line, splitter=splitter, start4words=start4words, step4words=step4words),
+        head=(start_chr,), tail=(end_chr,), workers=workers)
+    # the unique sections are in the order of first appearance, so the tables are in the same order as counting
+    # the lines one by one
+    for sections, cnt in sections_counts.items():
         for sec in sections:
-            words[sec] += 1
+            words[sec] += cnt
             if sec not in {start_chr}:
-                nwords_dict[zero][sec] += 1
-        section_dict[len(sections)][tuple(sections)] += 1
-    pass
+                nwords_dict[zero][sec] += cnt
+        section_dict[len(sections)][sections] = cnt
+    del sections_counts
 
     zero_sum = sum(nwords_dict[zero].values())
     for trans, p in nwords_dict[zero].items():
@@ -49,18 +56,11 @@ def backwords_counter(nwords_list: TextIO, splitter: str, start_chr: str, end_ch
     if max_gram == 1:
         print(f"max gram is {max_gram}, fail to model the password dataset", file=sys.stderr)
         sys.exit(-1)
-    for n in tqdm(range(min_gram, max_gram + 1), desc="Counting: "):
-        nwords_dict: Dict[Tuple, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
-        for sec_len, sections_cnt in section_dict.items():
-            if n > sec_len:
-                continue
-            for sections, cnt in sections_cnt.items():
-                prefix_words_num = n - 1
-                for i in range(len(sections) - prefix_words_num):
-                    grams = tuple(sections[i:i + prefix_words_num])
-                    transition = sections[i + prefix_words_num]
-                    nwords_dict[grams][transition] += cnt
-            pass
+    # prefixes without transitions above the threshold are skipped below, so they are not built at all
+    all_orders = count_all_orders(
+        ((sections, cnt) for sections_cnt in section_dict.values() for sections, cnt in sections_cnt.items()),
+        max_order=max_gram, min_count=threshold)
+    for n, nwords_dict in progress(all_orders, desc="Counting: ", total=max_gram - min_gram + 1):
         for prefix, trans_cnt in nwords_dict.items():
             total = sum(trans_cnt.values())
             if total < threshold:
@@ -75,4 +75,6 @@ def backwords_counter(nwords_list: TextIO, splitter: str, start_chr: str, end_ch
                     trans_prob[trans] = trans_prob.get(trans, 0) + p * missing
             nwords_float_dict[prefix] = trans_prob
     del section_dict
+    if flat:
+        return FlatModel.from_dict(nwords_float_dict, consume=True), words
     return nwords_float_dict, words
@@ -2,11 +2,13 @@ import argparse
 
 from backwords.backwords_enumerator import enumerator
 from backwords.backwords_trainer import backwords_counter
+from lib4mc.FileLib import input_file
+from lib4mc.PerfLib import add_perf_arguments, instrument
 
 
 def wrapper():
     cli = argparse.ArgumentParser("Backoff Enumerator")
-    cli.add_argument("-f", '--pwd-file', dest="pwd_file", required=True, type=argparse.FileType('r'),
+    cli.add_argument("-f", '--pwd-file', dest="pwd_file", required=True, type=input_file,
                      help="Training file")
     cli.add_argument("-p", '--min-prob', dest="min_prob", required=True, type=float,
                      help="Minimal probability that a password candidate should have")
@@ -14,8 +16,12 @@ def wrapper():
                      help="Minimal length of password candidates")
     cli.add_argument("-s", '--save', dest="f_save", required=True, type=argparse.FileType('w'),
                      help="save password candidates here")
+    cli.add_argument("--flat", dest="flat", required=False, action="store_true",
+                     help="keep the model in contiguous arrays with interned tokens, which takes much less memory")
+    add_perf_arguments(cli)
     args = cli.parse_args()
-    backwords_dict_float, _ = backwords_counter(args.pwd_file, '', '\x00', '\x03', 0, 1, 10, 256)
+    instrument(args)
+    backwords_dict_float, _ = backwords_counter(args.pwd_file, '', '\x00', '\x03', 0, 1, 10, 256, flat=args.flat)
     enumerator(backwords_dict_float, args.min_prob, '\x00', '\x03', args.min_len, args.f_save)
     pass
 
@@ -5,32 +5,43 @@ import argparse
 import json
 import math
 import os.path
-import pickle
 import random
 import sys
 from typing import List, Tuple
 
-from backwords.backwords_secondary_trainer import backwords_counter
+import numpy
+
+from backwords.backwords_secondary_trainer import backwords_counter, save_secondary_model
 from backwords_secondary_simulator import BackWordsSecondaryMonteCarlo
-from lib4mc.FileLib import wc_l
-from lib4mc.MonteCarloLib import MonteCarloLib
+from lib4mc.FileLib import input_file, read_lines, rereadable
+from lib4mc.MonteCarloLib import MonteCarloLib, fingerprint
+from lib4mc.PerfLib import add_perf_arguments, instrument, phase
 
 
 def secondary_cracker(backwords, words, config,
                       func_threshold: Tuple[int, int], **kwargs):
     save_in_folder = kwargs['save']
     tag = kwargs['tag']
+    # the model of this round is determined by the model of the previous round and the training passwords
+    config['fingerprint'] = fingerprint(
+        config.get('fingerprint', ''), kwargs['training'], kwargs['splitter'], kwargs['start4words'],
+        kwargs['skip4words'], kwargs['max_gram'], kwargs['threshold'])
     nwords_dict, _words = backwords_counter(
         nwords_list=kwargs['training'], splitter=kwargs['splitter'], start_chr=config['start_chr'],
         end_chr=config['end_chr'],
         start4words=kwargs['start4words'], step4words=kwargs['skip4words'], max_gram=kwargs['max_gram'],
-        nwords_dict=backwords, words=words, threshold=kwargs['threshold'])
-    fmodel = os.path.join(save_in_folder, f"model-to-crack-{tag}.pickle")
-    with open(fmodel, 'wb') as fd:
-        sign = kwargs['sign']
-        config['training_list'].append(f"{sign}")
-        pickle.dump((nwords_dict, words, config), file=fd)
-    backword_mc = BackWordsSecondaryMonteCarlo((nwords_dict, _words, config), max_iter=kwargs['max_iter'])
+        nwords_dict=backwords, words=words, threshold=kwargs['threshold'], workers=kwargs['workers'])
+    binary = kwargs['model_format'] == "binary"
+    fmodel = os.path.join(save_in_folder, f"model-to-crack-{tag}.{'mcmodel' if binary else 'pickle'}")
+    sign = kwargs['sign']
+    config['training_list'].append(f"{sign}")
+    save_secondary_model(fmodel, nwords_dict, _words, config, binary=binary)
+    if binary:
+        # sample and score with the memory-mapped probs saved just now
+        with open(fmodel, 'rb') as fd:
+            backword_mc = BackWordsSecondaryMonteCarlo(fd, max_iter=kwargs['max_iter'])
+    else:
+        backword_mc = BackWordsSecondaryMonteCarlo((nwords_dict, _words, config), max_iter=kwargs['max_iter'])
     # Note: this part is to "generate" some guesses and crack passwords in the testing dataset
     #
     # Besides, here we allow the user to provide a list which holds the sampled passwords
@@ -38,10 +49,35 @@ def secondary_cracker(backwords, words, config,
     # obtain the cracked passwords
     using_sample_attack = kwargs['using_sample_attack']
     sampled_pwds = None
-    if using_sample_attack:
+    if using_sample_attack and kwargs['save_samples']:
         sampled_pwds = {}
-    ml2p_list = backword_mc.sample(size=kwargs['size'], sampled_pwds=sampled_pwds)
-    if using_sample_attack:
+        mc = MonteCarloLib(backword_mc.sample(size=kwargs['size'], sampled_pwds=sampled_pwds,
+                                              workers=kwargs['workers'], seed=kwargs['seed']))
+    elif using_sample_attack:
+        # only the sampled passwords in the testing set are kept, with their guess numbers
+        targets = {line.strip("\r\n") for line in read_lines(kwargs['testing'])}
+        results, hits = backword_mc.sample_hits(kwargs['size'], targets, workers=kwargs['workers'],
+                                                seed=kwargs['seed'])
+        del targets
+        mc = MonteCarloLib(results)
+        # the guess number of a hit is 1 + the number of samples more probable than it,
+        # results are sorted in place by MonteCarloLib
+        hit_mlps = numpy.fromiter((prob for prob, _, _ in hits.values()), dtype=numpy.float64, count=len(hits))
+        hit_gns = numpy.searchsorted(numpy.asarray(results, dtype=numpy.float64), hit_mlps, side='left') + 1
+        f_hits = os.path.join(save_in_folder, f"hits-{tag}.txt")
+        with open(f_hits, 'w') as fout_hits:
+            sampled_pwds = {}
+            for (pwd, (prob, cnt, first)), gn in zip(hits.items(), hit_gns.tolist()):
+                fout_hits.write(f"{pwd}\t{prob:.8f}\t{cnt}\t{first}\t{gn}\n")
+                sampled_pwds[pwd] = gn
+        del results
+    else:
+        # the sampled passwords are not needed, therefore the rank table could be reused
+        table = os.path.join(save_in_folder, f"table-{tag}.mc") if kwargs['reuse_tables'] else None
+        mc = backword_mc.rank_table(size=kwargs['size'], table=table,
+                                    model_fingerprint=config['fingerprint'], workers=kwargs['workers'],
+                                    seed=kwargs['seed'])
+    if using_sample_attack and kwargs['save_samples']:
         f_samples = os.path.join(save_in_folder, f"samples-{tag}.txt")
         with open(f_samples, 'w') as fout_samples:
             sidx = 1
@@ -50,8 +86,7 @@ def secondary_cracker(backwords, words, config,
                 sampled_pwds[pwd] = sidx
                 sidx += cnt
         pass
-    mc = MonteCarloLib(ml2p_list)
-    scored_testing = backword_mc.parse_file(kwargs['testing'], using_component=True)
+    scored_testing = backword_mc.parse_file(kwargs['testing'], using_component=True, workers=kwargs['workers'])
     gc = mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
     secondary_training = []
     fcracked = os.path.join(save_in_folder, f"cracked-{tag}.txt")
@@ -90,9 +125,9 @@ def secondary_cracker(backwords, words, config,
 
 def wrapper():
     cli = argparse.ArgumentParser('Backwords secondary main')
-    cli.add_argument("-i", "--training", dest="training", type=argparse.FileType('r'), required=True,
+    cli.add_argument("-i", "--training", dest="training", type=input_file, required=True,
                      help="The training file, each password a line")
-    cli.add_argument("-t", "--testing", dest="testing", type=argparse.FileType('r'), required=True,
+    cli.add_argument("-t", "--testing", dest="testing", type=input_file, required=True,
                      help="The testing file, each password a line")
     cli.add_argument("-s", "--save", dest="save", required=True, type=str,
                      help='A folder, results will be saved in this folder')
@@ -122,7 +157,27 @@ def wrapper():
                      help="grams whose frequencies less than the threshold will be ignored")
     cli.add_argument("--max-iter", dest="max_iter", required=False, default=10 ** 20, type=int,
                      help="max iteration when calculating the maximum probability of a password")
+    cli.add_argument("--reuse-tables", dest="reuse_tables", required=False, action="store_true",
+                     help="save rank tables of Monte Carlo samples in the save folder, and reuse them "
+                          "instead of sampling again when the model of a round is unchanged")
+    cli.add_argument("--save-samples", dest="save_samples", required=False, action="store_true",
+                     help="`samples` strategy, keep every sampled password and save them in `samples-<round>.txt`. "
+                          "Otherwise only the sampled passwords in the testing set are kept and saved in "
+                          "`hits-<round>.txt` (password, minus log prob, count, index of the first draw, guesses)")
+    cli.add_argument("--model-format", dest="model_format", required=False, type=str, default="pickle",
+                     choices=["pickle", "binary"],
+                     help="save the models of the rounds as pickles, or in the binary format which is memory-mapped "
+                          "when loaded (see lib4mc/SaveModelLib.py)")
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help="number of processes to count the training file, to draw samples "
+                          "and to score the testing set")
+    cli.add_argument("--seed", dest="seed", type=int, required=False, default=None,
+                     help="seed of sampling. The samples only depend on the seed, not on the number of workers")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
+    # the testing set is parsed every round and in the final phase
+    args.testing = rereadable(args.testing)
     strategy_value = args.strategy
     strategy = strategy_value[0]
     permits = {'guesses', 'hits', 'samples', 'auto_hits'}
@@ -190,37 +245,49 @@ def wrapper():
         # Therefore, prior_guesses will always be args.size if `--using-samples`
         print(f"The {idx}-th iteration", file=sys.stderr)
         cum = []
-        backwords, words, config, training, max_gn = secondary_cracker(
-            backwords, words, config=config,
-            func_threshold=func_threshold,
-            training=training, splitter=args.splitter,
-            start4words=args.start4words, skip4words=args.skip4words,
-            max_gram=args.max_gram, size=args.size, max_iter=args.max_iter,
-            testing=args.testing, save=args.save, secondary_sample=args.secondary_sample,
-            already_cracked=already_cracked, cum=cum,
-            threshold=args.threshold, sign=signs[idx],
-            using_sample_attack=using_sample_attack, tag=f"iter-{idx}",
-        )
+        with phase(f"Round {idx}"):
+            backwords, words, config, training, max_gn = secondary_cracker(
+                backwords, words, config=config,
+                func_threshold=func_threshold,
+                training=training, splitter=args.splitter,
+                start4words=args.start4words, skip4words=args.skip4words,
+                max_gram=args.max_gram, size=args.size, max_iter=args.max_iter,
+                testing=args.testing, save=args.save, secondary_sample=args.secondary_sample,
+                already_cracked=already_cracked, cum=cum,
+                threshold=args.threshold, sign=signs[idx],
+                using_sample_attack=using_sample_attack, tag=f"iter-{idx}", reuse_tables=args.reuse_tables,
+                workers=args.workers, seed=args.seed, save_samples=args.save_samples,
+                model_format=args.model_format,
+            )
         cums.append(cum)
         max_guess_numbers.append(max_gn)
         if max_gn >= upper_bound:
             print(f"Too large guess number reached: {max_gn}, the training process is terminated", file=sys.stderr)
             break
         pass
-    backwords, words = backwords_counter(
-        training, splitter=args.splitter, start_chr=start_chr, end_chr=end_chr,
-        start4words=args.start4words, step4words=args.skip4words, max_gram=args.max_gram,
-        nwords_dict=backwords, words=words, threshold=args.threshold
-    )
-    f_final_model = os.path.join(args.save, "final_model.pickle")
-    with open(f_final_model, 'wb') as fout_final_model:
-        pickle.dump((backwords, words, config), file=fout_final_model)
-    print("Training phase done.", file=sys.stderr)
-    backword_mc = BackWordsSecondaryMonteCarlo((backwords, words, config), max_iter=args.max_iter)
-    ml2p_list = backword_mc.sample(size=args.size)
-    mc = MonteCarloLib(ml2p_list)
-    scored_testing = backword_mc.parse_file(args.testing)
-    gc = mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
+    with phase("Final"):
+        config['fingerprint'] = fingerprint(
+            config.get('fingerprint', ''), training, args.splitter, args.start4words, args.skip4words, args.max_gram,
+            args.threshold)
+        backwords, words = backwords_counter(
+            training, splitter=args.splitter, start_chr=start_chr, end_chr=end_chr,
+            start4words=args.start4words, step4words=args.skip4words, max_gram=args.max_gram,
+            nwords_dict=backwords, words=words, threshold=args.threshold, workers=args.workers
+        )
+        binary = args.model_format == "binary"
+        f_final_model = os.path.join(args.save, f"final_model.{'mcmodel' if binary else 'pickle'}")
+        save_secondary_model(f_final_model, backwords, words, config, binary=binary)
+        print("Training phase done.", file=sys.stderr)
+        if binary:
+            with open(f_final_model, 'rb') as fin_final_model:
+                backword_mc = BackWordsSecondaryMonteCarlo(fin_final_model, max_iter=args.max_iter)
+        else:
+            backword_mc = BackWordsSecondaryMonteCarlo((backwords, words, config), max_iter=args.max_iter)
+        table = os.path.join(args.save, "table-final.mc") if args.reuse_tables else None
+        mc = backword_mc.rank_table(size=args.size, table=table,
+                                    model_fingerprint=config['fingerprint'], workers=args.workers, seed=args.seed)
+        scored_testing = backword_mc.parse_file(args.testing, workers=args.workers)
+        gc = mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
     # note that this is the cracked passwords obtained according to the final model
     f_iter_result = os.path.join(args.save, "iter_result.txt")
     with open(f_iter_result, 'w') as fout_iter_result:
@@ -237,7 +304,7 @@ def wrapper():
     f_sectional_result = os.path.join(args.save, "sectional_result.txt")
     with open(f_sectional_result, "w") as fout_sectional_result:
         _cracked = 0
-        _total = wc_l(args.testing)
+        _total = sum([_n for _, _n, _ in scored_testing])
         for gnt, cum in zip([0, *max_guess_numbers], cums):
             for (_pwd, _prob, _n, _gn) in cum:
                 _cracked += _n
@@ -4,19 +4,28 @@ import sys
 
 from backwords.backwords_secondary_trainer import freq2prob
 from backwords_simulator import BackWordsMonteCarlo
-from lib4mc.MonteCarloLib import MonteCarloLib
-from lib4mc.ProbLib import expand_2d
+from lib4mc.FileLib import input_file
+from lib4mc.MonteCarloLib import fingerprint
+from lib4mc.MonteCarloParent import add_simulator_arguments, check_simulator_arguments
+from lib4mc.PerfLib import add_perf_arguments, instrument
+from lib4mc.ProbLib import ALIAS_MIN, lazy_expand_2d
+from lib4mc.SaveModelLib import is_model_file, open_model
 
 
 class BackWordsSecondaryMonteCarlo(BackWordsMonteCarlo):
-    def __init__(self, model, max_iter: int = 10 ** 100):
+    def __init__(self, model, max_iter: int = 10 ** 100, max_contexts: int = None, flat: bool = False):
         super().__init__(None)
         if isinstance(model, tuple):
             backwords, words, config = model
+            backwords = freq2prob(backwords, config['threshold'], flat=flat)
+        elif is_model_file(model):
+            # the probs are memory-mapped, there is nothing to compute
+            sections, words, config = open_model(model.name)
+            backwords = sections['probs']
         else:
             backwords, words, config = pickle.load(model)
-        backwords = freq2prob(backwords, config['threshold'])
-        self.nwords = expand_2d(backwords)
+            backwords = freq2prob(backwords, config['threshold'], flat=flat)
+        self.nwords = lazy_expand_2d(backwords, alias=ALIAS_MIN, max_contexts=max_contexts)
         self.end_chr = config['end_chr']
         self.words = words
         self.min_len = 4
@@ -27,17 +36,21 @@ class BackWordsSecondaryMonteCarlo(BackWordsMonteCarlo):
 
 def wrapper():
     cli = argparse.ArgumentParser("Backoff words simulator")
-    cli.add_argument("-m", "--model", dest="model", type=argparse.FileType('rb'), required=True, help="trained model")
-    cli.add_argument("-t", "--test", dest="test", type=argparse.FileType('r'), required=True, help="testing file")
-    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
-                     help="save Monte Carlo results here")
-    cli.add_argument("--size", dest="size", type=int, required=False, default=100000, help="sample size")
+    cli.add_argument("-m", "--model", dest="model", type=argparse.FileType('rb'), required=True,
+                     help="trained model, a pickle or a model file in the binary format")
+    cli.add_argument("-t", "--test", dest="test", type=input_file, required=True, help="testing file")
+    add_simulator_arguments(cli)
     cli.add_argument("--debug-mode", dest="debug_mode", required=False, action="store_true",
                      help="enter passwords and show probability of the password")
     cli.add_argument("--max-iter", dest="max_iter", required=False, default=10 ** 20, type=int,
                      help="max iteration when calculating the maximum probability of a password")
+    add_perf_arguments(cli)
     args = cli.parse_args()
-    backword_mc = BackWordsSecondaryMonteCarlo(args.model, max_iter=args.max_iter)
+    instrument(args)
+    check_simulator_arguments(cli, args)
+    model_fingerprint = fingerprint(BackWordsSecondaryMonteCarlo.__name__, args.model)
+    backword_mc = BackWordsSecondaryMonteCarlo(args.model, max_iter=args.max_iter, max_contexts=args.max_contexts,
+                                               flat=args.flat)
     if args.debug_mode:
         usr_i = ""
         while usr_i != "exit":
@@ -45,11 +58,25 @@ def wrapper():
             prob, components = backword_mc.calc_ml2p(usr_i)
             print(prob)
         return
-    ml2p_list = backword_mc.sample(size=args.size)
-    mc = MonteCarloLib(ml2p_list)
-    scored_testing = backword_mc.parse_file(args.test)
-    mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
-    mc.write2(args.save)
+    backword_mc.lockstep = args.lockstep
+    backword_mc.shared = args.shared
+    mc = backword_mc.rank_table(size=args.size, table=args.table, model_fingerprint=model_fingerprint,
+                                grow=args.grow, rel_err=args.adaptive, guesses=args.checkpoints,
+                                time_budget=args.time_budget, temperature=args.temperature,
+                                workers=args.workers, seed=args.seed, max_samples=args.max_samples)
+    if args.stream:
+        total, scored_testing = backword_mc.parse_file_stream(args.test, workers=args.workers,
+                                                              max_entries=args.max_entries)
+        mc.write_stream(scored_testing, total, args.save)
+    else:
+        scored_testing = backword_mc.parse_file(args.test, workers=args.workers)
+        mc.rank_scored(minus_log_prob_iter=scored_testing)
+        mc.write_results(save=args.save, curve=args.curve, binary=args.binary)
+    if args.adaptive is not None:
+        results = args.save.name if args.save is not None else args.curve.name if args.curve is not None \
+            else args.binary
+        with open(f"{results}.bounds.json", 'w') as fout_bounds:
+            mc.write_rank_errors(fout_bounds, args.checkpoints)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,14 @@
 import argparse
-import pickle
 import sys
 
-from backwords.backwords_secondary_trainer import backwords_counter
+from backwords.backwords_secondary_trainer import backwords_counter, load_secondary_model, save_secondary_model
+from lib4mc.FileLib import input_file
+from lib4mc.PerfLib import add_perf_arguments, instrument
 
 
 def wrapper():
     cli = argparse.ArgumentParser("Backoff: subword level trainer using secondary training file")
-    cli.add_argument("-t", '--training', required=True, type=argparse.FileType('r'), dest='training',
+    cli.add_argument("-t", '--training', required=True, type=input_file, dest='training',
                      help='training file')
     cli.add_argument('-s', '--save', required=True, type=str, dest='save',
                      help="save trained model here")
@@ -26,7 +27,15 @@ def wrapper():
     cli.add_argument("--threshold", dest="threshold", required=False, type=int, default=10,
                      help="grams whose frequencies less than the threshold will be ignored")
     cli.add_argument("--max-gram", dest="max_gram", required=False, type=int, default=256, help="max gram")
+    cli.add_argument("--format", dest="format", required=False, type=str, default="pickle",
+                     choices=["pickle", "binary"],
+                     help="save the model as a pickle, or in the binary format which is memory-mapped when loaded "
+                          "(see lib4mc/SaveModelLib.py). `model` could be in either format")
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help="number of processes to count the training file")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
     base_nwords_dict, words = None, None
     splitter_map = {'empty': '', 'space': ' ', 'tab': '\t'}
     if args.splitter.lower() in splitter_map:
@@ -36,24 +45,19 @@ def wrapper():
     if args.model is not None:
         print(f"Secondary training based on: {args.model}", file=sys.stderr)
         with open(args.model, 'rb') as f_model:
-            base_nwords_dict, words, config = pickle.load(f_model)
+            base_nwords_dict, words, config = load_secondary_model(f_model)
         start_chr, end_chr = config['start_chr'], config['end_chr']
         training_list = config['training_list']
         print(f"Prior training files: {','.join(training_list)}.", file=sys.stderr)
     nwords_dict, words = backwords_counter(
         nwords_list=args.training, splitter=args.splitter, start_chr=start_chr, end_chr=end_chr,
         start4words=args.start4words, step4words=args.skip4words, max_gram=args.max_gram,
-        nwords_dict=base_nwords_dict, words=words, threshold=args.threshold)
-    with open(args.save, 'wb') as f_save:
-        training_list.append(args.training.name)
-        pickle.dump(
-            (
-                nwords_dict,
-                words,
-                {'start_chr': start_chr, 'end_chr': end_chr, 'max_gram': args.max_gram, 'threshold': args.threshold,
-                 'training_list': training_list}
-            ), file=f_save)
-        pass
+        nwords_dict=base_nwords_dict, words=words, threshold=args.threshold, workers=args.workers)
+    training_list.append(args.training.name)
+    save_secondary_model(
+        args.save, nwords_dict, words,
+        {'start_chr': start_chr, 'end_chr': end_chr, 'max_gram': args.max_gram, 'threshold': args.threshold,
+         'training_list': training_list}, binary=args.format == "binary")
     pass
 
 
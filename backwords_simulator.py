@@ -3,21 +3,24 @@ import sys
 from typing import TextIO, Union, List, Tuple
 
 from backwords.backwords_trainer import backwords_counter
-from lib4mc.MonteCarloLib import MonteCarloLib
-from lib4mc.ProbLib import expand_2d
+from lib4mc.FileLib import input_file
+from lib4mc.MonteCarloLib import fingerprint
+from lib4mc.MonteCarloParent import add_simulator_arguments, check_simulator_arguments
+from lib4mc.PerfLib import add_perf_arguments, instrument
+from lib4mc.ProbLib import ALIAS_MIN, lazy_expand_2d
 from nwords_simulator import NWordsMonteCarlo
 
 
 class BackWordsMonteCarlo(NWordsMonteCarlo):
     def __init__(self, training_set: Union[TextIO, None], splitter: str = '', start4word: int = 0, skip4word: int = 1,
                  threshold: int = 10, start_chr: str = '\x00', end_chr: str = "\x03", max_gram: int = 256,
-                 max_iter: int = 10 ** 100):
+                 max_iter: int = 10 ** 100, max_contexts: int = None, flat: bool = False, workers: int = 1):
         super().__init__(None)
         if training_set is None:
             return
         backwords, words = backwords_counter(training_set, splitter, start_chr, end_chr, start4word, skip4word,
-                                             threshold=threshold, max_gram=max_gram)
-        self.nwords = expand_2d(backwords)
+                                             threshold=threshold, max_gram=max_gram, flat=flat, workers=workers)
+        self.nwords = lazy_expand_2d(backwords, alias=ALIAS_MIN, max_contexts=max_contexts)
         self.end_chr = end_chr
         self.words = words
         self.min_len = 4
@@ -51,11 +54,9 @@ class BackWordsMonteCarlo(NWordsMonteCarlo):
 
 def wrapper():
     cli = argparse.ArgumentParser("Backoff words simulator")
-    cli.add_argument("-i", "--input", dest="input", type=argparse.FileType('r'), required=True, help="nwords file")
-    cli.add_argument("-t", "--test", dest="test", type=argparse.FileType('r'), required=True, help="testing file")
-    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
-                     help="save Monte Carlo results here")
-    cli.add_argument("--size", dest="size", type=int, required=False, default=100000, help="sample size")
+    cli.add_argument("-i", "--input", dest="input", type=input_file, required=True, help="nwords file")
+    cli.add_argument("-t", "--test", dest="test", type=input_file, required=True, help="testing file")
+    add_simulator_arguments(cli, trains=True)
     cli.add_argument("--splitter", dest="splitter", type=str, required=False, default="empty",
                      help="how to divide different columns from the input file, "
                           "set it \"empty\" to represent \'\', \"space\" for \' \', \"tab\" for \'\t\'")
@@ -73,13 +74,19 @@ def wrapper():
     cli.add_argument("--max-gram", dest="max_gram", required=False, type=int, default=256, help="max gram")
     cli.add_argument("--max-iter", dest="max_iter", required=False, default=10 ** 20, type=int,
                      help="max iteration when calculating the maximum probability of a password")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
+    check_simulator_arguments(cli, args)
     splitter_map = {'empty': '', 'space': ' ', 'tab': '\t'}
     if args.splitter.lower() in splitter_map:
         args.splitter = splitter_map[args.splitter.lower()]
+    model_fingerprint = fingerprint(BackWordsMonteCarlo.__name__, args.input, args.splitter, args.start4word,
+                                    args.skip4word, args.threshold, args.max_gram)
     backword_mc = BackWordsMonteCarlo(args.input, splitter=args.splitter, start4word=args.start4word,
                                       skip4word=args.skip4word,
-                                      threshold=args.threshold, max_gram=args.max_gram, max_iter=args.max_iter)
+                                      threshold=args.threshold, max_gram=args.max_gram, max_iter=args.max_iter,
+                                      max_contexts=args.max_contexts, flat=args.flat, workers=args.workers)
     if args.debug_mode:
         usr_i = ""
         while usr_i != "exit":
@@ -87,11 +94,25 @@ def wrapper():
             prob, components = backword_mc.calc_ml2p(usr_i)
             print(prob)
         return
-    ml2p_list = backword_mc.sample(size=args.size)
-    mc = MonteCarloLib(ml2p_list)
-    scored_testing = backword_mc.parse_file(args.test)
-    mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
-    mc.write2(args.save)
+    backword_mc.lockstep = args.lockstep
+    backword_mc.shared = args.shared
+    mc = backword_mc.rank_table(size=args.size, table=args.table, model_fingerprint=model_fingerprint,
+                                grow=args.grow, rel_err=args.adaptive, guesses=args.checkpoints,
+                                time_budget=args.time_budget, temperature=args.temperature,
+                                workers=args.workers, seed=args.seed, max_samples=args.max_samples)
+    if args.stream:
+        total, scored_testing = backword_mc.parse_file_stream(args.test, workers=args.workers,
+                                                              max_entries=args.max_entries)
+        mc.write_stream(scored_testing, total, args.save)
+    else:
+        scored_testing = backword_mc.parse_file(args.test, workers=args.workers)
+        mc.rank_scored(minus_log_prob_iter=scored_testing)
+        mc.write_results(save=args.save, curve=args.curve, binary=args.binary)
+    if args.adaptive is not None:
+        results = args.save.name if args.save is not None else args.curve.name if args.curve is not None \
+            else args.binary
+        with open(f"{results}.bounds.json", 'w') as fout_bounds:
+            mc.write_rank_errors(fout_bounds, args.checkpoints)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,313 @@
+"""
+Benchmark training, sampling, scoring and ranking of the model families on synthetic password corpora.
+
+The corpora are generated from a fixed seed: a Zipf-distributed vocabulary of base words, optionally capitalized,
+followed by Zipf-distributed digits and symbols. Two formats are generated:
+    chars:      one password per line, the models are trained character by character
+    segmented:  `pwd \\t seg_1 \\t tag_1 \\t seg_2 \\t tag_2 ...`, i.e., --splitter "\\t" --start4word 1 --skip4word 2,
+                which is also the input format of nwords_v2
+Results of each (family, format, scale, phase) are saved as JSON, with the commit and versions of the tree, so that
+two runs could be compared by `--compare`.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import List, Tuple, Dict, Any
+
+import numpy
+
+from lib4mc.FileLib import input_file
+from lib4mc.MonteCarloLib import MonteCarloLib
+from lib4mc.PerfLib import phase, recorder
+
+FAMILIES = ["nwords", "nwords_v2", "backwords", "secondary", "bpe"]
+FORMATS = ["chars", "segmented"]
+SYMBOLS = "!@#$%&*._-?"
+
+
+class CorpusGenerator:
+    def __init__(self, seed: int, vocab_size: int = 2000, zipf: float = 1.1):
+        """
+        :param seed: the corpus only depends on the seed and the arguments
+        :param vocab_size: number of base words
+        :param zipf: exponent of the Zipf distributions, larger to concentrate on the head
+        """
+        self.rng = numpy.random.default_rng(seed)
+        letters = numpy.array(list("abcdefghijklmnopqrstuvwxyz"))
+        # frequent letters are more likely, so that n-grams are shared among words
+        letter_probs = 1 / numpy.arange(1, len(letters) + 1) ** 0.8
+        letter_probs /= letter_probs.sum()
+        words = set()
+        while len(words) < vocab_size:
+            length = int(self.rng.integers(3, 9))
+            words.add("".join(self.rng.choice(letters, size=length, p=letter_probs)))
+        self.words = sorted(words)
+        self.rng.shuffle(self.words)
+        self.word_probs = self.__zipf(len(self.words), zipf)
+        self.digits = ["1", "12", "123", "1234", "123456", "0", "00", "11", "666", "888", "520", "521"] + \
+                      [str(y) for y in range(1960, 2025)] + [f"{n:02d}" for n in range(100)]
+        self.digit_probs = self.__zipf(len(self.digits), zipf)
+        self.symbol_probs = self.__zipf(len(SYMBOLS), zipf)
+
+    @staticmethod
+    def __zipf(n: int, s: float) -> numpy.ndarray:
+        probs = 1 / numpy.arange(1, n + 1) ** s
+        return probs / probs.sum()
+
+    def password(self) -> List[Tuple[str, str]]:
+        """
+        :return: segments and their tags of one password
+        """
+        while True:
+            word = self.words[self.rng.choice(len(self.words), p=self.word_probs)]
+            segments = []
+            if self.rng.random() < 0.1:
+                segments.append((word[0].upper(), "U"))
+                word = word[1:]
+            segments.append((word, "L"))
+            if self.rng.random() < 0.6:
+                segments.append((self.digits[self.rng.choice(len(self.digits), p=self.digit_probs)], "D"))
+            if self.rng.random() < 0.15:
+                segments.append((SYMBOLS[self.rng.choice(len(SYMBOLS), p=self.symbol_probs)], "S"))
+            if sum(len(s) for s, _ in segments) >= 4:
+                return segments
+
+    def write(self, path: str, size: int, fmt: str):
+        """
+        :param path: save the corpus here
+        :param size: number of passwords
+        :param fmt: chars or segmented
+        """
+        with open(path, 'w') as fout:
+            for _ in range(size):
+                segments = self.password()
+                pwd = "".join(s for s, _ in segments)
+                if fmt == "chars":
+                    fout.write(f"{pwd}\n")
+                else:
+                    fout.write("\t".join([pwd] + [f"{s}\t{t}" for s, t in segments]) + "\n")
+        pass
+
+
+def write_bpe_model(corpus: str, folder: str):
+    """
+    write a PCFG model of LUDS segments in the folder layout read by bpeX.modelreader.read_bpe
+    :param corpus: passwords in the chars format
+    :param folder: model folder
+    """
+    from bpe_simulator import luds
+    structures = defaultdict(int)
+    terminals = defaultdict(lambda: defaultdict(int))
+    with open(corpus) as fin:
+        for line in fin:
+            pwd = line.strip("\r\n")
+            label = luds(pwd)
+            structures[label] += 1
+            start = 0
+            for tag, t_len in label:
+                terminals[(tag, t_len)][pwd[start:start + t_len]] += 1
+                start += t_len
+    folders = {"L": "lower", "U": "upper", "D": "digits", "S": "special"}
+    for name in list(folders.values()) + ["mixed_2", "mixed_3", "mixed_4", "grammar"]:
+        os.makedirs(os.path.join(folder, name), exist_ok=True)
+    total = sum(structures.values())
+    with open(os.path.join(folder, "grammar", "structures.txt"), 'w') as fout:
+        for label, cnt in structures.items():
+            fout.write(f"{''.join(f'{tag}{t_len}' for tag, t_len in label)}\t{cnt / total}\n")
+    for (tag, t_len), replacements in terminals.items():
+        total = sum(replacements.values())
+        with open(os.path.join(folder, folders[tag], f"{t_len}.txt"), 'w') as fout:
+            for replacement, cnt in replacements.items():
+                fout.write(f"{replacement}\t{cnt / total}\n")
+    pass
+
+
+def train(family: str, corpus: str, fmt: str, ngram: int, threshold: int):
+    splitter, start4word, skip4word = ("", 0, 1) if fmt == "chars" else ("\t", 1, 2)
+    if family == "bpe":
+        from bpe_simulator import BpePcfgSim
+        return BpePcfgSim(model_path=f"{corpus}.bpe")
+    with input_file(corpus) as fd:
+        if family == "nwords":
+            from nwords_simulator import NWordsMonteCarlo
+            return NWordsMonteCarlo(fd, n=ngram, splitter=splitter, start4word=start4word, skip4word=skip4word)
+        if family == "nwords_v2":
+            from nwords_simulator_v2 import NWords2MonteCarlo
+            return NWords2MonteCarlo(fd, n=ngram)
+        if family == "backwords":
+            from backwords_simulator import BackWordsMonteCarlo
+            return BackWordsMonteCarlo(fd, splitter=splitter, start4word=start4word, skip4word=skip4word,
+                                       threshold=threshold)
+        if family == "secondary":
+            from backwords.backwords_secondary_trainer import backwords_counter
+            from backwords_secondary_simulator import BackWordsSecondaryMonteCarlo
+            config = {'start_chr': '\x03', 'end_chr': '\x00', 'max_gram': 256, 'threshold': threshold,
+                      'training_list': [corpus]}
+            backwords, words = backwords_counter(fd, splitter, config['start_chr'], config['end_chr'], start4word,
+                                                 skip4word, max_gram=config['max_gram'], threshold=threshold)
+            return BackWordsSecondaryMonteCarlo((backwords, words, config))
+    raise Exception(f"Unknown family: {family}")
+
+
+def supported(family: str, fmt: str) -> bool:
+    # nwords_v2 reads the segmented format only, the BPE PCFG model is built from the chars format
+    return not (family == "nwords_v2" and fmt != "segmented") and not (family == "bpe" and fmt != "chars")
+
+
+def run_once(family: str, fmt: str, corpus: str, testing: str, args) -> Dict[str, dict]:
+    """
+    :return: phase -> record, see lib4mc.PerfLib.PhaseRecorder
+    """
+    records = {}
+    with phase("train") as record:
+        model = train(family, corpus, fmt, args.ngram, args.threshold)
+    records["train"] = record
+    random.seed(args.seed)
+    with phase("sample", items=args.samples) as record:
+        samples = model.sample(size=args.samples)
+    records["sample"] = record
+    if args.lockstep > 0 and hasattr(model, "sample_lockstep"):
+        with phase("sample_lockstep", items=args.samples) as record:
+            model.sample_lockstep(args.samples, width=args.lockstep, seed=args.seed)
+        records["sample_lockstep"] = record
+    with phase("tabulate", items=args.samples) as record:
+        mc = MonteCarloLib(samples)
+    records["tabulate"] = record
+    with open(testing) as fin:
+        with phase("score") as record:
+            scored = model.parse_file(fin, workers=args.workers)
+            record["items"] = len(scored)
+    records["score"] = record
+    with phase("rank", items=len(scored)) as record:
+        mc.rank_scored(scored)
+    records["rank"] = record
+    return records
+
+
+def commit_of_tree() -> Any:
+    try:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for scale in args.scales:
+            for fmt in args.formats:
+                families = [f for f in args.families if supported(f, fmt)]
+                if len(families) == 0:
+                    continue
+                corpus = os.path.join(workdir, f"train-{fmt}-{scale}.txt")
+                testing = os.path.join(workdir, f"test-{scale}.txt")
+                CorpusGenerator(args.seed, args.vocab, args.zipf).write(corpus, scale, fmt)
+                CorpusGenerator(args.seed + 1, args.vocab, args.zipf).write(testing, args.test_size, "chars")
+                if "bpe" in families:
+                    write_bpe_model(corpus, f"{corpus}.bpe")
+                for family in families:
+                    best: Dict[str, dict] = {}
+                    for _ in range(args.repeat):
+                        for name, record in run_once(family, fmt, corpus, testing, args).items():
+                            if name not in best or record["wall_s"] < best[name]["wall_s"]:
+                                best[name] = record
+                    for name, record in best.items():
+                        results.append({"family": family, "format": fmt, "scale": scale, "phase": name,
+                                        **{k: record.get(k) for k in ["wall_s", "cpu_s", "items", "items_per_s",
+                                                                      "peak_rss_mb", "peak_traced_mb"]}})
+                        print(f"{family:>10} {fmt:>9} {scale:>9} {name:>15} {record['wall_s']:10.4f}s",
+                              file=sys.stderr)
+    return {
+        "tree": commit_of_tree(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in {"save", "compare"}},
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, tolerance: float, fd=sys.stdout) -> int:
+    """
+    print the wall time of each (family, format, scale, phase) in both runs
+    :return: number of regressions, i.e., new / old > tolerance
+    """
+    def key(r):
+        return r["family"], r["format"], r["scale"], r["phase"]
+
+    old_results = {key(r): r for r in old["results"]}
+    regressions = 0
+    fd.write(f"{'family':>10} {'format':>9} {'scale':>9} {'phase':>15} {'old (s)':>10} {'new (s)':>10} {'ratio':>7}\n")
+    for r in new["results"]:
+        if key(r) not in old_results:
+            continue
+        old_wall, new_wall = old_results[key(r)]["wall_s"], r["wall_s"]
+        ratio = new_wall / old_wall if old_wall > 0 else float("inf")
+        flag = ""
+        if ratio > tolerance:
+            regressions += 1
+            flag = " slower"
+        fd.write(f"{r['family']:>10} {r['format']:>9} {r['scale']:>9} {r['phase']:>15} "
+                 f"{old_wall:10.4f} {new_wall:10.4f} {ratio:7.2f}{flag}\n")
+    return regressions
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Benchmark of training, sampling, scoring and ranking")
+    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
+                     help="save the results here (JSON)")
+    cli.add_argument("--families", dest="families", type=str, nargs="+", required=False, default=FAMILIES,
+                     choices=FAMILIES, help="model families to benchmark")
+    cli.add_argument("--formats", dest="formats", type=str, nargs="+", required=False, default=FORMATS,
+                     choices=FORMATS, help="formats of the training corpora")
+    cli.add_argument("--scales", dest="scales", type=int, nargs="+", required=False, default=[1000, 10000, 100000],
+                     help="numbers of training passwords")
+    cli.add_argument("--test-size", dest="test_size", type=int, required=False, default=2000,
+                     help="number of testing passwords")
+    cli.add_argument("--samples", dest="samples", type=int, required=False, default=10000, help="sample size")
+    cli.add_argument("--lockstep", dest="lockstep", type=int, required=False, default=4096,
+                     help="also time the lockstep sampler of n-gram models with this many chains, 0 to skip")
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help="number of processes to score the testing set")
+    cli.add_argument("--vocab", dest="vocab", type=int, required=False, default=2000, help="number of base words")
+    cli.add_argument("--zipf", dest="zipf", type=float, required=False, default=1.1,
+                     help="exponent of the Zipf distributions of the corpora")
+    cli.add_argument("--ngram", dest="ngram", type=int, required=False, default=3, help="n of nwords and nwords_v2")
+    cli.add_argument("--threshold", dest="threshold", type=int, required=False, default=5,
+                     help="threshold of backwords and secondary backwords")
+    cli.add_argument("--repeat", dest="repeat", type=int, required=False, default=1,
+                     help="run each benchmark this many times and keep the fastest run of each phase")
+    cli.add_argument("--seed", dest="seed", type=int, required=False, default=0,
+                     help="seed of the corpora and of sampling")
+    cli.add_argument("--workdir", dest="workdir", type=str, required=False, default=None,
+                     help="folder of the temporary corpora and models")
+    cli.add_argument("--compare", dest="compare", type=argparse.FileType('r'), required=False, default=None,
+                     help="results of a previous run, print the ratios of wall times")
+    cli.add_argument("--tolerance", dest="tolerance", type=float, required=False, default=1.1,
+                     help="a phase is reported as slower if new / old wall time is larger than this")
+    args = cli.parse_args()
+    recorder.enable(quiet=True)
+    report = benchmark(args)
+    json.dump(report, args.save, indent=2)
+    args.save.close()
+    if args.compare is not None:
+        regressions = compare(json.load(args.compare), report, args.tolerance)
+        print(f"{regressions} phases are slower than {args.tolerance}x", file=sys.stderr)
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
@@ -68,6 +68,32 @@ def read_bpe(model_path: str) -> Tuple[Dict[Any, float], Dict[Tuple[str, int], D
     return grammars, terminals
 
 
+# folder of the terminals of each tag
+TAG_FOLDERS = {"L": "lower", "U": "upper", "DM": "mixed_2", "TM": "mixed_3", "FM": "mixed_4", "D": "digits",
+               "S": "special"}
+
+
+def write_bpe(model_path: str, grammars: Dict[Any, float], terminals: Dict[Tuple[str, int], Dict[Any, float]],
+              prob_format: str = ""):
+    """
+    write a model in the layout read by read_bpe
+    :param model_path: model folder
+    :param grammars: see read_bpe
+    :param terminals: see read_bpe
+    :param prob_format: format spec of the probabilities, e.g., ".6g", the shortest repr by default
+    """
+    for folder in list(TAG_FOLDERS.values()) + ["grammar"]:
+        os.makedirs(os.path.join(model_path, folder), exist_ok=True)
+    with open(os.path.join(model_path, "grammar", "structures.txt"), 'w') as fout:
+        for structure, prob in grammars.items():
+            fout.write(f"{''.join([f'{tag}{t_len}' for tag, t_len in structure])}\t{prob:{prob_format}}\n")
+    for (tag, t_len), replacements in terminals.items():
+        with open(os.path.join(model_path, TAG_FOLDERS[tag], f"{t_len}.txt"), 'w') as fout:
+            for replacement, prob in replacements.items():
+                fout.write(f"{replacement}\t{prob:{prob_format}}\n")
+    pass
+
+
 def test():
     grammars, terminals = read_bpe("/home/cw/Documents/tmp/model")
     print(grammars)
@@ -2,14 +2,18 @@ import argparse
 import re
 import sys
 from collections import defaultdict
-from typing import TextIO, Tuple, Dict, Any, Set
-
-from tqdm import tqdm
+from collections.abc import Mapping
+from pathlib import Path
+from typing import TextIO, Tuple, Dict, Any, Set, List, Iterator
 
 from bpeX.modelreader import read_bpe
-from lib4mc.MonteCarloLib import MonteCarloLib
-from lib4mc.MonteCarloParent import MonteCarlo
-from lib4mc.ProbLib import expand_2d, pick_expand, expand_1d
+from lib4mc.FileLib import input_file
+from lib4mc.FlatLib import FlatModel
+from lib4mc.MonteCarloLib import MonteCarloLib, fingerprint
+from lib4mc.MonteCarloParent import MonteCarlo, add_simulator_arguments, check_simulator_arguments
+from lib4mc.PerfLib import add_perf_arguments, instrument, progress
+from lib4mc.ProbLib import ALIAS_MIN, TemperedExpanded, lazy_expand_2d, pick_expand, expand_1d, temper_expand
+from lib4mc.SaveModelLib import MappedModel, share_model
 
 re_digits = re.compile(r"\d+")
 
@@ -79,7 +83,7 @@ def count_luds(structures: Dict[Tuple, float]) -> (Dict[Any, Set], Dict[str, set
 
     struct_speedup = {}
     not_parsed = defaultdict(set)
-    for skipped in tqdm(skipped_list, desc="Refining: "):
+    for skipped in progress(skipped_list, desc="Refining: "):
         len_skipped = sum([slen for _, slen in skipped])
         candidates = novels[len_skipped]
         speed_skipped = []
@@ -101,20 +105,67 @@ def count_luds(structures: Dict[Tuple, float]) -> (Dict[Any, Set], Dict[str, set
     return converts, not_parsed
 
 
+class SharedTerminals(Mapping):
+    def __init__(self, model: MappedModel):
+        """
+        (tag, length) -> expanded replacements, of the terminals published by BpePcfgSim.share
+        :param model: (tag, str(length)) -> replacement -> prob
+        """
+        self.__model = model
+
+    def get(self, tag_len: Tuple[str, int], default=None):
+        return self.__model.get((tag_len[0], str(tag_len[1])), default)
+
+    def __getitem__(self, tag_len: Tuple[str, int]):
+        return self.__model[(tag_len[0], str(tag_len[1]))]
+
+    def __contains__(self, tag_len) -> bool:
+        return (tag_len[0], str(tag_len[1])) in self.__model
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        return ((tag, int(t_len)) for tag, t_len in self.__model)
+
+    def __len__(self) -> int:
+        return len(self.__model)
+
+    @property
+    def max_contexts(self) -> int:
+        return self.__model.max_contexts
+
+
 class BpePcfgSim(MonteCarlo):
     def sample1(self) -> (float, str):
         pwd = ""
         prob = .0
-        p, struct = pick_expand(self.__grammars)
+        p, struct = pick_expand(self.__grammars, self.rng)
         prob += p
         # lst = [(struct, 2 ** (-p))]
         for tag_len in struct:
             target_terminal = self.__terminals[tag_len]
-            p, replacement = pick_expand(target_terminal)
+            p, replacement = pick_expand(target_terminal, self.rng)
             prob += p
             pwd += replacement
         return prob, pwd
 
+    def sample1_tempered(self, temperature: float) -> (float, float, str, int):
+        if temperature not in self.__tempered:
+            self.__tempered[temperature] = (
+                temper_expand(self.__grammars, temperature, minus_log_based=True),
+                TemperedExpanded(self.__terminals, temperature, minus_log_based=True,
+                                 max_contexts=self.__terminals.max_contexts))
+        tempered_grammars, tempered_terminals = self.__tempered[temperature]
+        pwd = ""
+        q, struct = pick_expand(tempered_grammars, self.rng)
+        prob, proposal = self.__grammars[0].get(struct), self.minus_log2(q)
+        for tag_len in struct:
+            target_terminal = self.__terminals[tag_len]
+            q, replacement = pick_expand(tempered_terminals[tag_len], self.rng)
+            prob += target_terminal[0].get(replacement)
+            proposal += self.minus_log2(q)
+            pwd += replacement
+        # every draw is a sample, nothing is rejected
+        return prob, proposal, pwd, 1
+
     def calc_ml2p(self, pwd: str) -> float:
         label = luds(pwd)
         candidate_structures = self.__converted.get(label, set())
@@ -125,7 +176,7 @@ class BpePcfgSim(MonteCarlo):
             candidate_structures.update(addon_candidate_structures)
             if len(candidate_structures) == 0:
                 return log_max
-        grammars, _, _ = self.__grammars
+        grammars = self.__grammars[0]
         results = []
         for candidate in candidate_structures:
             p = grammars.get(candidate, log_max)
@@ -133,7 +184,7 @@ class BpePcfgSim(MonteCarlo):
                 break
             start = 0
             for tag, t_len in candidate:
-                terminal, _, _ = self.__terminals.get((tag, t_len))
+                terminal = self.__terminals.get((tag, t_len))[0]
                 replacement = pwd[start:start + t_len]
                 start += t_len
                 if replacement not in terminal:
@@ -151,9 +202,22 @@ class BpePcfgSim(MonteCarlo):
 
     def __init__(self, model_path: str):
         grammars, terminals = read_bpe(model_path=model_path)
-        self.__grammars = expand_1d(grammars, minus_log_based=True)
-        self.__terminals = expand_2d(terminals, minus_log_based=True)
+        self.__grammars = expand_1d(grammars, minus_log_based=True, alias=len(grammars) >= ALIAS_MIN)
+        self.__terminals = lazy_expand_2d(terminals, minus_log_based=True, alias=ALIAS_MIN)
         self.__converted, self.__not_parsed = count_luds(grammars)
+        # temperature -> (tempered structures, tempered terminals), built when first reached
+        self.__tempered = {}
+        pass
+
+    def share(self):
+        # the terminals take most of the memory, the structures and their LUDS conversions stay private
+        if isinstance(self.__terminals, SharedTerminals):
+            return
+        terminals = FlatModel.from_dict({(tag, str(t_len)): replacements for (tag, t_len), replacements in
+                                         self.__terminals.two_d_dict.items()})
+        self.__terminals = SharedTerminals(share_model({'terminals': terminals}, minus_log_based=True,
+                                                       alias=ALIAS_MIN)['terminals'])
+        self.__tempered = {}
         pass
 
 
@@ -172,16 +236,32 @@ def test():
     pass
 
 
-def wrapper(model_path: str, testing_set: TextIO, save2: TextIO, size: int = 1000000):
+def wrapper(model_path: str, testing_set: TextIO, save2: TextIO, size: int = 1000000, table: str = None,
+            grow: bool = False, rel_err: float = None, guesses: List[int] = None, time_budget: float = None,
+            temperature: float = None, curve: TextIO = None, binary: str = None, workers: int = 1,
+            seed: int = None, stream: bool = False, max_entries: int = 1 << 22, shared: bool = False,
+            max_samples: int = None):
     # "/home/cw/Documents/tmp/model"
     bpePcfg = BpePcfgSim(model_path=model_path)
-    samples = bpePcfg.sample(size=size)
+    bpePcfg.shared = shared
+    monte_carlo = bpePcfg.rank_table(size=size, table=table,
+                                     model_fingerprint=fingerprint(BpePcfgSim.__name__, Path(model_path)), grow=grow,
+                                     rel_err=rel_err, guesses=guesses, time_budget=time_budget,
+                                     temperature=temperature, workers=workers, seed=seed,
+                                     max_samples=max_samples)
     # open("/home/cw/Documents/tmp/178_new.txt")
-    scored = bpePcfg.parse_file(testing_set)
-    monte_carlo = MonteCarloLib(minus_log_prob_list=samples)
-    monte_carlo.ml2p_iter2gc(scored, need_resort=True, add1=True)
-    # open("/home/cw/Documents/tmp/scored_178.txt", "w")
-    monte_carlo.write2(save2)
+    if stream:
+        total, scored = bpePcfg.parse_file_stream(testing_set, workers=workers, max_entries=max_entries)
+        monte_carlo.write_stream(scored, total, save2, add1=True)
+    else:
+        scored = bpePcfg.parse_file(testing_set, workers=workers)
+        monte_carlo.rank_scored(scored, need_resort=True, add1=True)
+        # open("/home/cw/Documents/tmp/scored_178.txt", "w")
+        monte_carlo.write_results(save=save2, curve=curve, binary=binary)
+    if rel_err is not None:
+        results = save2.name if save2 is not None else curve.name if curve is not None else binary
+        with open(f"{results}.bounds.json", 'w') as fout_bounds:
+            monte_carlo.write_rank_errors(fout_bounds, guesses)
 
     pass
 
@@ -189,14 +269,16 @@ def wrapper(model_path: str, testing_set: TextIO, save2: TextIO, size: int = 100
 def main():
     cli = argparse.ArgumentParser("BPE PCFG Simulator")
     cli.add_argument("-m", "--model", dest="model", type=str, required=True, help="model to be used for bpe")
-    cli.add_argument("-t", "--target", dest="target", type=argparse.FileType('r'), required=True,
+    cli.add_argument("-t", "--target", dest="target", type=input_file, required=True,
                      help="testing set to be parsed")
-    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
-                     help="save results to file")
-    cli.add_argument("--size", dest="size", type=int, required=False, default=1000000,
-                     help="sample size for Monte Carlo")
+    add_simulator_arguments(cli, size=1000000, n_gram=False)
+    add_perf_arguments(cli)
     args = cli.parse_args()
-    wrapper(args.model, args.target, args.save, args.size)
+    instrument(args)
+    check_simulator_arguments(cli, args)
+    wrapper(args.model, args.target, args.save, args.size, args.table, args.grow, args.adaptive, args.checkpoints,
+            args.time_budget, args.temperature, args.curve, args.binary, args.workers, args.seed, args.stream,
+            args.max_entries, args.shared, args.max_samples)
 
 
 if __name__ == '__main__':
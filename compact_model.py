@@ -0,0 +1,224 @@
+"""
+Compact trained models: quantize minus log probs to fixed-point bins and prune transitions and prefixes of little
+mass (see lib4mc/CompactLib.py), then report the size reduction and the drift of the guess numbers of a reference
+testing set.
+
+- backwords: a model saved by backwords_secondary_trainer.py or backwords_secondary_main.py, compacted into a model
+  file in the binary format, which is loaded by `backwords_secondary_simulator.py -m`
+- nwords: an n-gram model trained from the given file, compacted into a model file in the binary format, which is
+  loaded by `nwords_simulator.py -m`
+- bpe: a BPE PCFG model folder, compacted into another model folder
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+from typing import Dict, Tuple, Any
+
+import numpy
+
+from lib4mc.CompactLib import dequantize, prune_contexts, prune_transitions, quantize
+from lib4mc.FileLib import InputFile, input_file, rereadable
+from lib4mc.FlatLib import FlatModel
+from lib4mc.PerfLib import add_perf_arguments, instrument, phase
+
+
+def quantized_dict(two_d_dict: Dict[Any, Dict[Any, float]], bits: int) -> Tuple[Dict[Any, Dict[Any, float]], float]:
+    """
+    :param two_d_dict: prefix -> (transition -> prob)
+    :param bits: see quantize
+    :return: the model with the probs recovered from the codes, and the step of the codes
+    """
+    model = FlatModel.from_dict(two_d_dict)
+    codes, step = quantize(model.probs, bits)
+    model.probs = dequantize(codes, step, model.offsets)
+    return model.to_dict(), step
+
+
+def folder_size(folder: str) -> int:
+    return sum([os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(folder) for file in files])
+
+
+def model_stats(two_d_dict: Dict[Any, Dict[Any, float]]) -> Dict[str, int]:
+    return {"contexts": len(two_d_dict), "transitions": sum([len(items) for items in two_d_dict.values()])}
+
+
+def compact_backwords(args, workdir: str):
+    from backwords.backwords_secondary_trainer import freq2prob, load_secondary_model
+    from backwords_secondary_simulator import BackWordsSecondaryMonteCarlo
+    from lib4mc.SaveModelLib import save_model
+    with open(args.backwords, 'rb') as fin:
+        counts, words, config = load_secondary_model(fin)
+    probs = freq2prob(counts, config['threshold'])
+    compacted = probs
+    if args.min_count > 0:
+        compacted = prune_contexts(compacted, counts, args.min_count)
+    if args.min_prob > 0:
+        compacted = prune_transitions(compacted, args.min_prob, backoff=True)
+    del counts
+    origin = os.path.join(workdir, "origin.mcmodel")
+    save_model(origin, {'probs': FlatModel.from_dict(probs)}, words, config)
+    config = {**config, 'compacted': {'bits': args.bits, 'min_prob': args.min_prob, 'min_count': args.min_count}}
+    save_model(args.output, {'probs': FlatModel.from_dict(compacted)}, words, config,
+               quantized={'probs': args.bits} if args.bits > 0 else None)
+    stats = {"before": {**model_stats(probs), "bytes": os.path.getsize(origin)},
+             "after": {**model_stats(compacted), "bytes": os.path.getsize(args.output)}}
+    with open(origin, 'rb') as f_origin, open(args.output, 'rb') as f_compacted:
+        return stats, BackWordsSecondaryMonteCarlo(f_origin), BackWordsSecondaryMonteCarlo(f_compacted)
+
+
+def compact_nwords(args, workdir: str):
+    from lib4mc.SaveModelLib import save_model
+    from nwords.nwords_trainer import nwords_counter
+    from nwords_simulator import NWordsMonteCarlo
+    start_chr, end_chr = '\x00', '\x03'
+    with InputFile(args.nwords) as fin:
+        probs, words = nwords_counter(fin, args.ngram, args.splitter, end_chr, args.start4word, args.skip4word,
+                                      start_chr=start_chr, workers=args.workers)
+    compacted = probs
+    if args.min_prob > 0:
+        compacted = prune_transitions(compacted, args.min_prob, backoff=False)
+    config = {'n': args.ngram, 'start_chr': start_chr, 'end_chr': end_chr, 'training_list': [args.nwords]}
+    origin = os.path.join(workdir, "origin.mcmodel")
+    save_model(origin, {'probs': FlatModel.from_dict(probs)}, words, config)
+    config['compacted'] = {'bits': args.bits, 'min_prob': args.min_prob}
+    save_model(args.output, {'probs': FlatModel.from_dict(compacted)}, words, config,
+               quantized={'probs': args.bits} if args.bits > 0 else None)
+    stats = {"before": {**model_stats(probs), "bytes": os.path.getsize(origin)},
+             "after": {**model_stats(compacted), "bytes": os.path.getsize(args.output)}}
+    return stats, NWordsMonteCarlo.from_model(origin), NWordsMonteCarlo.from_model(args.output)
+
+
+def compact_bpe(args, workdir: str):
+    from bpeX.modelreader import read_bpe, write_bpe
+    from bpe_simulator import BpePcfgSim
+    grammars, terminals = read_bpe(args.bpe)
+    stats = {"before": {**model_stats({(): grammars, **terminals}), "bytes": folder_size(args.bpe)}}
+    if args.min_prob > 0:
+        grammars = prune_transitions({(): grammars}, args.min_prob, backoff=False)[()]
+        terminals = prune_transitions(terminals, args.min_prob, backoff=False)
+    prob_format = ""
+    if args.bits > 0:
+        grammars, _ = quantized_dict({(): grammars}, args.bits)
+        grammars = grammars[()]
+        terminals, step = quantized_dict(terminals, args.bits)
+        # digits enough to tell the bins apart
+        prob_format = f".{max(1, math.ceil(-math.log10(2 ** step - 1))) + 2}g"
+    write_bpe(args.output, grammars, terminals, prob_format=prob_format)
+    stats["after"] = {**model_stats({(): grammars, **terminals}), "bytes": folder_size(args.output)}
+    return stats, BpePcfgSim(model_path=args.bpe), BpePcfgSim(model_path=args.output)
+
+
+def rank_drift(origin, compacted, args) -> Dict[str, Any]:
+    """
+    :param origin: simulator of the model before compaction
+    :param compacted: simulator of the model after compaction
+    :return: statistics of |log2(guess number after / guess number before)| of the passwords of the testing set
+        within the sampled range of both rank tables
+    """
+    # both models parse the testing set, read_lines rewinds it
+    test = rereadable(args.test)
+    ranks, in_range = [], None
+    for name, model in [("Original", origin), ("Compacted", compacted)]:
+        with phase(name):
+            mc = model.rank_table(size=args.size, seed=args.seed, workers=args.workers)
+            scored = sorted(model.parse_file(test, workers=args.workers), key=lambda x: x[0])
+            positions = mc.ml2p_arr2position(numpy.array([ml2p for _, _, ml2p in scored]))
+            # guess numbers beyond the largest sampled minus log prob are clamped to the last position, not compared
+            within = positions < mc.ml2p_arr2position(numpy.array([numpy.inf]))[0]
+            in_range = within if in_range is None else in_range & within
+            ranks.append(positions)
+            counts = numpy.array([cnt for _, cnt, _ in scored], dtype=numpy.float64)
+    total = counts.sum()
+    drift = numpy.abs(numpy.log2(ranks[1][in_range] / ranks[0][in_range]))
+    counts = counts[in_range]
+    stats = {"passwords": int(total), "unique": len(in_range), "in_range": float(counts.sum() / total)}
+    if len(drift) == 0:
+        return stats
+    order = numpy.argsort(drift)
+    cum_counts = numpy.cumsum(counts[order]) / counts.sum()
+
+    def percentile(q: float) -> float:
+        # weighted by the appearances of the passwords
+        return float(drift[order][min(numpy.searchsorted(cum_counts, q), len(drift) - 1)])
+
+    return {**stats, "median_log2_drift": percentile(.5), "p90_log2_drift": percentile(.9),
+            "max_log2_drift": float(drift.max()), "within_2x": float(counts[drift <= 1].sum() / counts.sum())}
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Compact trained models by quantization and pruning")
+    models = cli.add_mutually_exclusive_group(required=True)
+    models.add_argument("--backwords", dest="backwords", type=str,
+                        help="model saved by backwords_secondary_trainer.py or backwords_secondary_main.py")
+    models.add_argument("--nwords", dest="nwords", type=str, help="train an n-gram model from this file")
+    models.add_argument("--bpe", dest="bpe", type=str, help="BPE PCFG model folder")
+    cli.add_argument("-o", "--output", dest="output", type=str, required=True,
+                     help="save the compacted model here, a model file in the binary format for backwords and "
+                          "nwords, a model folder for bpe")
+    cli.add_argument("--bits", dest="bits", type=int, required=False, default=8, choices=[0, 8, 16],
+                     help="quantize the minus log probs to codes of this many bits, 0 to keep the probs")
+    cli.add_argument("--min-prob", dest="min_prob", type=float, required=False, default=0,
+                     help="prune the transitions whose probs are less than this, the mass goes to the backoff "
+                          "parent for backwords and to the remaining transitions otherwise")
+    cli.add_argument("--min-count", dest="min_count", type=int, required=False, default=0,
+                     help="backwords only, prune the prefixes seen less than this many times, "
+                          "the backoff parent is used instead")
+    cli.add_argument("-t", "--test", dest="test", type=input_file, required=False, default=None,
+                     help="reference testing set, report the drift of the guess numbers of its passwords")
+    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=False, default=None,
+                     help="save the sizes and the drift here (JSON)")
+    cli.add_argument("--size", dest="size", type=int, required=False, default=100000,
+                     help="sample size of the rank tables to measure the drift")
+    cli.add_argument("--seed", dest="seed", type=int, required=False, default=0, help="seed of sampling")
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help="number of processes to count the training file (nwords), to draw samples and to score "
+                          "the testing set")
+    cli.add_argument("-n", "--ngram", dest="ngram", type=int, required=False, default=2, choices=[2, 3, 4, 5, 6],
+                     help="nwords only, ngram")
+    cli.add_argument("--splitter", dest="splitter", type=str, required=False, default="empty",
+                     help="nwords only, how to divide different columns from the input file, "
+                          "set it \"empty\" to represent \'\', \"space\" for \' \', \"tab\" for \'\t\'")
+    cli.add_argument("--start4word", dest="start4word", type=int, required=False, default=0,
+                     help="nwords only, index of the first word in the array of an entry")
+    cli.add_argument("--skip4word", dest="skip4word", type=int, required=False, default=1,
+                     help="nwords only, skip4word - 1 elements between words are skipped")
+    add_perf_arguments(cli)
+    args = cli.parse_args()
+    instrument(args)
+    if args.min_count > 0 and args.backwords is None:
+        cli.error("--min-count only supports --backwords, the other models have no backoff for pruned prefixes")
+    splitter_map = {'empty': '', 'space': ' ', 'tab': '\t'}
+    args.splitter = splitter_map.get(args.splitter.lower(), args.splitter)
+    with tempfile.TemporaryDirectory() as workdir:
+        with phase("Compacting"):
+            if args.backwords is not None:
+                stats, origin, compacted = compact_backwords(args, workdir)
+            elif args.nwords is not None:
+                stats, origin, compacted = compact_nwords(args, workdir)
+            else:
+                stats, origin, compacted = compact_bpe(args, workdir)
+        stats["ratio"] = stats["after"]["bytes"] / max(stats["before"]["bytes"], 1)
+        print(f"{stats['before']['transitions']:,} -> {stats['after']['transitions']:,} transitions, "
+              f"{stats['before']['contexts']:,} -> {stats['after']['contexts']:,} contexts, "
+              f"{stats['before']['bytes']:,} -> {stats['after']['bytes']:,} bytes ({stats['ratio']:.1%})",
+              file=sys.stderr)
+        if args.test is not None:
+            stats["drift"] = rank_drift(origin, compacted, args)
+            drift = stats["drift"]
+            if "median_log2_drift" in drift:
+                print(f"Drift of the guess numbers (|log2(after / before)|) of {drift['in_range']:.1%} passwords "
+                      f"in the sampled range, median: {drift['median_log2_drift']:.3f}, "
+                      f"p90: {drift['p90_log2_drift']:.3f}, max: {drift['max_log2_drift']:.3f}, "
+                      f"within 2x: {drift['within_2x']:.1%}", file=sys.stderr)
+            else:
+                print("No password of the testing set is in the sampled range, try a larger --size", file=sys.stderr)
+    if args.save is not None:
+        json.dump(stats, args.save, indent=2)
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
@@ -0,0 +1,67 @@
+"""
+Convert pickled models to the binary model format, which is memory-mapped when loaded (see lib4mc/SaveModelLib.py)
+"""
+import argparse
+import codecs
+import pickle
+import sys
+
+from backwords.backwords_secondary_trainer import save_secondary_model
+from lib4mc.FlatLib import FlatModel
+from lib4mc.PerfLib import add_perf_arguments, instrument, phase
+from lib4mc.SaveModelLib import is_model_file, read_model_header, save_model
+
+
+def convert(src: str, dst: str, start_chr: str = "\x00"):
+    """
+    :param src: a pickle of (prefix -> (transition -> count), words, config), saved by backwords_secondary_trainer.py
+        or backwords_secondary_main.py, or of (n, end_chr, prefix -> (char -> prob)), saved by save_ngram
+    :param dst: save the model in the binary format here
+    :param start_chr: the start symbol of the n-gram model saved by save_ngram, which is not in the pickle
+    """
+    with open(src, 'rb') as fin:
+        if is_model_file(fin):
+            raise Exception(f"{src} is already a model file in the binary format")
+        with phase("Unpickling"):
+            model = pickle.load(fin)
+    if not isinstance(model, tuple) or len(model) != 3:
+        raise Exception(f"{src} is not a pickled model, expecting (counts, words, config) or (n, end_chr, probs)")
+    with phase("Converting"):
+        if isinstance(model[0], int):
+            n, end_chr, ngram_float_dict = model
+            start = tuple([start_chr for _ in range(n - 1)])
+            if start not in ngram_float_dict:
+                raise Exception(f"the start prefix {start} is not in the {n}-gram model {src}, "
+                                f"set the start symbol of the model by --start-chr")
+            save_model(dst, {'probs': FlatModel.from_dict(ngram_float_dict)},
+                       config={'n': n, 'start_chr': start_chr, 'end_chr': end_chr})
+        else:
+            nwords_dict, words, config = model
+            save_secondary_model(dst, nwords_dict, words, config, binary=True)
+    pass
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Convert pickled models to the binary model format")
+    cli.add_argument("-i", "--input", dest="input", type=str, required=True,
+                     help="pickled model, saved by backwords_secondary_trainer.py, backwords_secondary_main.py "
+                          "or SaveModelLib.save_ngram")
+    cli.add_argument("-o", "--output", dest="output", type=str, required=True,
+                     help="save the model in the binary format here")
+    cli.add_argument("--start-chr", dest="start_chr", type=lambda x: codecs.decode(x, "unicode_escape"),
+                     required=False, default="\x00",
+                     help="start symbol of the n-gram model saved by save_ngram, which is not in the pickle, "
+                          "escapes such as \\x00 are allowed. \\x00 by default, the same as nwords_simulator.py")
+    add_perf_arguments(cli)
+    args = cli.parse_args()
+    instrument(args)
+    convert(args.input, args.output, start_chr=args.start_chr)
+    header, _ = read_model_header(args.output)
+    sections = ", ".join([f"{name} ({s['contexts']} prefixes, {s['transitions']} transitions)"
+                          for name, s in header['sections'].items()])
+    print(f"{args.input} converted to {args.output}: {sections}, {header['words']} words", file=sys.stderr)
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
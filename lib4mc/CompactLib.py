@@ -0,0 +1,91 @@
+"""
+Compaction of trained models, i.e., prefix -> (transition -> prob).
+
+Minus log probs are quantized to fixed-point bins of `step` bits, so that a transition takes 1 or 2 bytes instead of
+a float64 prob and its cumulative sum. The probs are recovered as 2 ** (-code * step), renormalized within each
+prefix, so that sampling and scoring use the same distribution.
+Transitions and prefixes of little mass are pruned. The mass of the pruned transitions of a prefix goes to its
+backoff parent, i.e., prefix[1:], the way backwords.backwords_secondary_trainer.freq2prob does, or is spread over the
+remaining transitions for models without backoff. A pruned prefix is replaced by its longest remaining suffix by the
+backoff simulators.
+"""
+from typing import Any, Dict, Tuple
+
+import numpy
+
+
+def quantize(probs: numpy.ndarray, bits: int = 8) -> Tuple[numpy.ndarray, float]:
+    """
+    :param probs: probs of the transitions, larger than 0
+    :param bits: 8 or 16, size of a code
+    :return: codes, i.e., round(minus log prob / step), and step, the bits of minus log prob per code
+    """
+    if bits not in (8, 16):
+        raise Exception(f"codes should be of 8 or 16 bits, but got {bits}")
+    minus_log_probs = -numpy.log2(numpy.asarray(probs, dtype=numpy.float64))
+    top = (1 << bits) - 1
+    largest = float(minus_log_probs.max()) if len(minus_log_probs) > 0 else .0
+    step = largest / top if largest > 0 else 1.0
+    codes = numpy.rint(minus_log_probs / step).astype(numpy.uint8 if bits == 8 else numpy.uint16)
+    return codes, step
+
+
+def dequantize(codes: numpy.ndarray, step: float, offsets: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param codes: see quantize
+    :param step: see quantize
+    :param offsets: the transitions of the i-th prefix are offsets[i]:offsets[i + 1], prefixes should not be empty
+    :return: probs, renormalized within each prefix
+    """
+    probs = numpy.exp2(codes * -step)
+    if len(offsets) > 1:
+        probs /= numpy.repeat(numpy.add.reduceat(probs, offsets[:-1]), numpy.diff(offsets))
+    return probs
+
+
+def prune_contexts(two_d_dict: Dict[Tuple, Dict[Any, float]], counts: Dict[Tuple, Dict[Any, int]],
+                   min_count: int) -> Dict[Tuple, Dict[Any, float]]:
+    """
+    :param two_d_dict: prefix -> (transition -> prob) of a backoff model
+    :param counts: prefix -> (transition -> count) the model is trained from
+    :param min_count: prefixes seen less than min_count times are pruned, except the ones of length 0 and 1
+    :return: the model without the pruned prefixes, the dicts of the remaining ones are shared with two_d_dict
+    """
+    return {prefix: trans_prob for prefix, trans_prob in two_d_dict.items()
+            if len(prefix) <= 1 or sum(counts.get(prefix, {}).values()) >= min_count}
+
+
+def prune_transitions(two_d_dict: Dict[Tuple, Dict[Any, float]], min_prob: float, backoff: bool) \
+        -> Dict[Tuple, Dict[Any, float]]:
+    """
+    :param two_d_dict: prefix -> (transition -> prob)
+    :param min_prob: transitions whose probs are less than min_prob are pruned, the most likely transition of a prefix
+        is always kept
+    :param backoff: the mass of the pruned transitions goes to the longest shorter suffix of the prefix in the model,
+        otherwise it is spread over the remaining transitions of the prefix. The transitions of the suffix given
+        less than min_prob are not added, their share is spread over the others as well
+    :return: prefix -> (transition -> prob), in the order of the lengths of the prefixes if backoff is set
+    """
+    pruned_dict: Dict[Tuple, Dict[Any, float]] = {}
+    prefixes = sorted(two_d_dict.keys(), key=len) if backoff else two_d_dict.keys()
+    for prefix in prefixes:
+        trans_prob = two_d_dict[prefix]
+        kept = {trans: p for trans, p in trans_prob.items() if p >= min_prob}
+        if len(kept) == 0:
+            best = max(trans_prob, key=trans_prob.get)
+            kept = {best: trans_prob[best]}
+        if len(kept) < len(trans_prob):
+            parent_prefix = prefix[1:] if backoff and len(prefix) > 0 else None
+            # the parent may have been pruned, back off to the longest remaining suffix then
+            while parent_prefix is not None and parent_prefix not in pruned_dict and len(parent_prefix) > 0:
+                parent_prefix = parent_prefix[1:]
+            if parent_prefix is not None and parent_prefix in pruned_dict:
+                missing = 1.0 - sum(kept.values())
+                for trans, p in pruned_dict[parent_prefix].items():
+                    # the transitions of the parent which would be pruned here are not brought in
+                    if trans in kept or p * missing >= min_prob:
+                        kept[trans] = kept.get(trans, .0) + p * missing
+            total = sum(kept.values())
+            kept = {trans: p / total for trans, p in kept.items()}
+        pruned_dict[prefix] = kept
+    return pruned_dict
@@ -0,0 +1,122 @@
+"""
+Memory-mapped reader of uncompressed training and testing files.
+
+The file is cut into byte ranges which start after a newline, so that each worker maps the file by itself and decodes
+its own range, and no process reads the whole file first. A range is decoded in blocks of about READ_BUFFER bytes
+which end with a newline, and the lines are split the same way as the text layer does (universal newlines), so that
+the lines are the same as iterating over the file opened in text mode and stripping "\\r\\n".
+The encoding should encode "\\n" as the single byte b"\\n" (e.g., utf-8, latin-1 or gbk, but not utf-16),
+otherwise a newline could not be found by its byte.
+"""
+import mmap
+import os
+from typing import Iterator, List, Tuple, TextIO, Union
+
+from lib4mc.FileLib import READ_BUFFER, InputFile
+
+
+class Corpus:
+    def __init__(self, path: str, encoding: str = "utf-8", errors: str = "strict"):
+        """
+        :param path: an uncompressed file
+        :param encoding: see the module docstring
+        :param errors: how to handle invalid bytes, see bytes.decode, e.g., "strict", "replace" or "surrogateescape"
+        """
+        if "\n".encode(encoding) != b"\n":
+            raise Exception(f"newlines are not single bytes of b'\\n' in {encoding}, which is not supported")
+        self.path = path
+        self.encoding = encoding
+        self.errors = errors
+        self.size = os.path.getsize(path)
+        self.__mm = None
+        if self.size > 0:
+            # an empty file can not be mapped
+            with open(path, 'rb') as fin:
+                self.__mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        pass
+
+    def ranges(self, parts: int) -> List[Tuple[int, int]]:
+        """
+        :param parts: number of ranges wanted
+        :return: [start, end) byte ranges of about the same size which start after a newline, fewer than `parts` if
+            the file has fewer lines, no range for an empty file
+        """
+        bounds = [0]
+        for i in range(1, max(parts, 1)):
+            cut = max(self.size * i // parts, bounds[-1])
+            newline = self.__mm.find(b"\n", cut) if cut < self.size else -1
+            if newline < 0:
+                break
+            if newline + 1 > bounds[-1]:
+                bounds.append(newline + 1)
+        if bounds[-1] < self.size:
+            bounds.append(self.size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def blocks(self, start: int = 0, end: int = None) -> Iterator[str]:
+        """
+        :param start: start of the range, which starts after a newline, see ranges
+        :param end: end of the range, the end of the file if None
+        :return: decoded blocks of the range, each of which ends with a newline except the last one of the file
+        """
+        end = self.size if end is None else end
+        position = start
+        while position < end:
+            block_end = min(position + READ_BUFFER, end)
+            if block_end < end:
+                newline = self.__mm.rfind(b"\n", position, block_end)
+                if newline < 0:
+                    # the line is longer than READ_BUFFER
+                    newline = self.__mm.find(b"\n", block_end, end)
+                block_end = end if newline < 0 else newline + 1
+            yield self.__mm[position:block_end].decode(self.encoding, self.errors)
+            position = block_end
+        pass
+
+    def lines(self, start: int = 0, end: int = None) -> Iterator[str]:
+        """
+        :param start: see blocks
+        :param end: see blocks
+        :return: lines of the range, without "\\r\\n"
+        """
+        for block in self.blocks(start, end):
+            if "\r" in block:
+                # universal newlines of the text layer, a block never ends between "\r" and "\n"
+                block = block.replace("\r\n", "\n").replace("\r", "\n")
+            lines = block.split("\n")
+            if lines[-1] == "":
+                # the block ends with a newline
+                lines.pop()
+            yield from lines
+        pass
+
+    def __iter__(self) -> Iterator[str]:
+        return self.lines()
+
+    def close(self):
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __reduce__(self):
+        # pickled as its path, workers map the file by themselves
+        return Corpus, (self.path, self.encoding, self.errors)
+
+
+def corpus_of(file: Union[TextIO, List[str]], encoding: str = "utf-8", errors: str = "strict") -> Union[Corpus, None]:
+    """
+    :param file: an opened training or testing file, see FileLib.input_file
+    :param encoding: see Corpus
+    :param errors: see Corpus
+    :return: the memory-mapped corpus of the file, None if it is not an uncompressed regular file, e.g., stdin,
+        compressed files or lists of lines
+    """
+    if isinstance(file, InputFile) and file.compression is None and file.size is not None:
+        return Corpus(file.name, encoding=encoding, errors=errors)
+    return None
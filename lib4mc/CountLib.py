@@ -0,0 +1,182 @@
+"""
+Map-reduce counting of the sections of training files.
+
+Each line of a training file is parsed into a tuple of sections, and the trainers build their tables (counts of
+words, n-grams and so on) from the appearances of the unique tuples. Visiting the unique tuples in the order of their
+first appearance, with their appearances, gives the same tables in the same order as visiting the lines one by one:
+the first tuple holding a word is the one of the first line holding it.
+Workers count the tuples of newline-aligned ranges of a memory-mapped file (see CorpusLib), and the partial tables
+are merged in the order of the ranges, which keeps the order of first appearance. A worker spills its partial table
+to disk once it holds max_entries tuples, and the spilled tables are merged in the order they are written.
+The transitions of all orders are counted by count_all_orders in one pass over the unique tuples, see there.
+"""
+import multiprocessing
+import os
+import pickle
+import tempfile
+from typing import Any, Callable, Container, Dict, Iterable, Iterator, List, TextIO, Tuple, Union
+
+import numpy
+
+from lib4mc.CorpusLib import Corpus, corpus_of
+from lib4mc.FileLib import read_lines
+from lib4mc.PerfLib import progress
+
+# at most this many unique tuples in the partial table of a worker, the others are spilled to disk
+MAX_ENTRIES = 1 << 22
+# ranges of the file per worker, more ranges balance the workers better
+RANGES_PER_WORKER = 4
+
+_worker_task = None
+
+
+def _init_counter(corpus: Corpus, parse: Callable[[str], List[str]], head: Tuple, tail: Tuple, max_entries: int,
+                  tmp_dir: str):
+    global _worker_task
+    _worker_task = (corpus, parse, head, tail, max_entries, tmp_dir)
+
+
+def _spill(counts: Dict[Tuple, int], tmp_dir: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=".counts", dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as fout:
+        pickle.dump(counts, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _count_range(bounds: Tuple[int, int]) -> Tuple[List[str], Dict[Tuple, int]]:
+    corpus, parse, head, tail, max_entries, tmp_dir = _worker_task
+    runs, counts = [], {}
+    for line in corpus.lines(*bounds):
+        sections = (*head, *parse(line), *tail)
+        counts[sections] = counts.get(sections, 0) + 1
+        if len(counts) >= max_entries:
+            runs.append(_spill(counts, tmp_dir))
+            counts = {}
+    return runs, counts
+
+
+def _merge(counts: Dict[Tuple, int], partial_counts: Dict[Tuple, int]):
+    for sections, cnt in partial_counts.items():
+        counts[sections] = counts.get(sections, 0) + cnt
+
+
+def count_sections(training: Union[TextIO, List[str]], parse: Callable[[str], List[str]], head: Tuple = (),
+                   tail: Tuple = (), workers: int = 1, max_entries: int = MAX_ENTRIES, tmp_dir: str = None,
+                   desc: str = "Reading: ") -> Dict[Tuple, int]:
+    """
+    :param training: training file, or lines. Only uncompressed regular files are counted in parallel, the others
+        are streamed by one process
+    :param parse: line without "\\r\\n" -> sections, picklable (e.g., a module function or a functools.partial of it)
+    :param head: sections prepended to the sections of each line, e.g., the start symbols
+    :param tail: sections appended to the sections of each line, e.g., the end symbol
+    :param workers: number of processes
+    :param max_entries: see MAX_ENTRIES
+    :param tmp_dir: folder of the spilled tables, None for the default temporary folder
+    :param desc: see progress
+    :return: tuple of sections -> appearances, in the order of first appearance
+    """
+    corpus = corpus_of(training) if workers > 1 else None
+    counts: Dict[Tuple, int] = {}
+    if corpus is None:
+        for line in read_lines(training, desc=desc):
+            sections = (*head, *parse(line.strip("\r\n")), *tail)
+            counts[sections] = counts.get(sections, 0) + 1
+        return counts
+    ranges = corpus.ranges(workers * RANGES_PER_WORKER)
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context()
+    with ctx.Pool(processes=workers, initializer=_init_counter,
+                  initargs=(corpus, parse, head, tail, max_entries, tmp_dir)) as pool, \
+            progress(desc=desc, total=corpus.size, unit="B", unit_scale=True) as bar:
+        # imap keeps the order of the ranges
+        for (start, end), (runs, partial_counts) in zip(ranges, pool.imap(_count_range, ranges)):
+            for run in runs:
+                with open(run, 'rb') as fin:
+                    _merge(counts, pickle.load(fin))
+                os.remove(run)
+            _merge(counts, partial_counts)
+            bar.update(end - start)
+    corpus.close()
+    return counts
+
+
+def count_all_orders(sections_counts: Iterable[Tuple[Tuple, int]], max_order: int, min_count: int = 0,
+                     keep: Container[Tuple] = None) -> Iterator[Tuple[int, Dict[Tuple, Dict[Any, int]]]]:
+    """
+    Count the transitions of all orders in one pass over the tuples of sections, instead of one pass per order.
+    Sections are interned to ids and the tuples are laid out in one array, in the order they are visited. The id of
+    the prefix of k + 1 sections at a position is the id of the pair (id of the prefix of k sections, the next
+    section), so that the pairs interned by numpy.unique for order n = k + 1 are the transitions of order n and,
+    at the same time, the prefixes of order n + 1. The ids are exact, and the first index of a pair is its first
+    appearance, which restores the order of the dicts.
+    Only the prefixes kept are built as dicts, which saves most of the time, because most prefixes of higher orders
+    appear a few times.
+    :param sections_counts: (tuple of sections, appearances), in the order the tuples are visited for each order
+    :param max_order: the largest order n, i.e., prefixes of n - 1 sections
+    :param min_count: the prefixes whose transitions all appear fewer than min_count times are left out
+    :param keep: prefixes which are never left out, e.g., the prefixes of the model to update
+    :return: (n, prefix -> (transition -> count)) for n = 2, ..., until max_order or no tuple is longer than n - 1,
+        the same tables in the same order as visiting the tuples for each n, without the prefixes left out
+    """
+    sections_list, counts, flat_ids = [], [], []
+    ids_of_sections: Dict[Any, int] = {}
+    for sections, cnt in progress(sections_counts, desc="Interning: "):
+        sections_list.append(sections)
+        counts.append(cnt)
+        flat_ids.extend([ids_of_sections.setdefault(sec, len(ids_of_sections)) for sec in sections])
+    all_sections = list(ids_of_sections.keys())
+    del ids_of_sections
+    vocab = max(len(all_sections), 1)
+    tokens = numpy.array(flat_ids, dtype=numpy.int64)
+    del flat_ids
+    lengths = numpy.fromiter(map(len, sections_list), dtype=numpy.int64, count=len(sections_list))
+    starts = numpy.cumsum(lengths) - lengths
+    owners = numpy.repeat(numpy.arange(len(sections_list), dtype=numpy.int64), lengths)
+    ends = numpy.repeat(starts + lengths, lengths)
+    weights = numpy.repeat(numpy.array(counts, dtype=numpy.int64), lengths)
+    del counts
+    # positions of the prefixes of k sections, and the ids of the prefixes
+    positions, ids = numpy.arange(len(tokens), dtype=numpy.int64), tokens
+    for n in range(2, max_order + 1):
+        k = n - 1
+        followed = positions + k < ends[positions]
+        positions, ids = positions[followed], ids[followed]
+        if len(positions) == 0:
+            break
+        pairs, firsts, inverse = numpy.unique(ids * vocab + tokens[positions + k], return_index=True,
+                                              return_inverse=True)
+        pair_counts = numpy.rint(numpy.bincount(inverse, weights=weights[positions])).astype(numpy.int64)
+        # the pairs are sorted by the prefix ids, so the transitions of a prefix are contiguous
+        prefix_of_pairs = pairs // vocab
+        bounds = numpy.flatnonzero(numpy.diff(prefix_of_pairs, prepend=-1))
+        prefix_firsts = numpy.minimum.reduceat(firsts, bounds)
+        kept = numpy.maximum.reduceat(pair_counts, bounds) >= min_count
+        if keep is not None and len(keep) > 0:
+            for j in numpy.flatnonzero(~kept).tolist():
+                p = int(positions[prefix_firsts[j]])
+                owner = int(owners[p])
+                start = p - int(starts[owner])
+                kept[j] = sections_list[owner][start:start + k] in keep
+        group_of_pairs = numpy.repeat(numpy.arange(len(bounds)), numpy.diff(numpy.append(bounds, len(pairs))))
+        kept_pairs = numpy.flatnonzero(kept[group_of_pairs])
+        # in the order of the first appearances of the prefixes, then of the transitions
+        order = kept_pairs[numpy.lexsort((firsts[kept_pairs], prefix_firsts[group_of_pairs[kept_pairs]]))]
+        table: Dict[Tuple, Dict[Any, int]] = {}
+        prev_group, trans_cnt = -1, None
+        first_positions = positions[prefix_firsts].tolist()
+        for group, trans, cnt in zip(group_of_pairs[order].tolist(), (pairs[order] % vocab).tolist(),
+                                     pair_counts[order].tolist()):
+            if group != prev_group:
+                p = first_positions[group]
+                owner = int(owners[p])
+                start = p - int(starts[owner])
+                trans_cnt = table[sections_list[owner][start:start + k]] = {}
+                prev_group = group
+            trans_cnt[all_sections[trans]] = cnt
+        # the prefixes of k + 1 sections are the pairs
+        ids = inverse.astype(numpy.int64)
+        del pairs, firsts, inverse, pair_counts
+        yield n, table
+    pass
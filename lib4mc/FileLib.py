@@ -1,5 +1,16 @@
+import argparse
+import bz2
+import gzip
+import heapq
+import io
+import json
+import lzma
+import os
 import sys
-from typing import TextIO
+import tempfile
+from typing import TextIO, List, Iterator, Iterable, Tuple, Callable, Any, Union
+
+from lib4mc.PerfLib import progress
 
 
 def wc_l(file: TextIO, new_line: str = "\n", silence: bool = False):
@@ -25,3 +36,269 @@ def wc_l(file: TextIO, new_line: str = "\n", silence: bool = False):
     if file.seekable():
         file.seek(0)
     return count
+
+
+# size of the reads from the input files and from the decompressors
+READ_BUFFER = 8 * 1024 * 1024
+# magic numbers of the compressed formats
+COMPRESSIONS = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd")]
+
+
+class CountingReader(io.RawIOBase):
+    def __init__(self, raw):
+        """
+        binary stream which counts the bytes read from another one, i.e., the compressed bytes consumed
+        :param raw: binary stream, e.g., a file opened in "rb" mode or sys.stdin.buffer
+        """
+        super().__init__()
+        self.raw = raw
+        self.consumed = 0
+        pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.raw.readinto(b)
+        if n:
+            self.consumed += n
+        return n
+
+    def seekable(self) -> bool:
+        return self.raw.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        position = self.raw.seek(offset, whence)
+        self.consumed = position
+        return position
+
+    def tell(self) -> int:
+        return self.raw.tell()
+
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class InputFile(io.TextIOWrapper):
+    def __init__(self, path: str, encoding: str = "utf-8", errors: str = "strict"):
+        """
+        text stream of a plain or compressed (gzip, bz2, xz, zstd) file, or of stdin if path is "-".
+        The compression is detected by the magic number, so that compressed pipes are read as well
+        :param path: path of the file, or "-" for stdin
+        :param encoding: see open
+        :param errors: see open
+        """
+        raw = sys.stdin.buffer if path == "-" else open(path, 'rb', buffering=0)
+        self.counter = CountingReader(raw)
+        buffered = io.BufferedReader(self.counter, buffer_size=READ_BUFFER)
+        head = buffered.peek(8)
+        compression = next((name for magic, name in COMPRESSIONS if head.startswith(magic)), None)
+        if compression == "gzip":
+            stream = io.BufferedReader(gzip.GzipFile(fileobj=buffered, mode='rb'), buffer_size=READ_BUFFER)
+        elif compression == "bz2":
+            stream = io.BufferedReader(bz2.BZ2File(buffered, mode='rb'), buffer_size=READ_BUFFER)
+        elif compression == "xz":
+            stream = io.BufferedReader(lzma.LZMAFile(buffered, mode='rb'), buffer_size=READ_BUFFER)
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception(f"{path} is compressed by zstd, please install zstandard to read it")
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(buffered, read_size=READ_BUFFER),
+                                       buffer_size=READ_BUFFER)
+        else:
+            stream = buffered
+        super().__init__(stream, encoding=encoding, errors=errors)
+        self.compression = compression
+        # argparse.FileType names stdin "<stdin>" as well
+        self.path = "<stdin>" if path == "-" else path
+        pass
+
+    @property
+    def name(self) -> str:
+        return self.path
+
+    @property
+    def consumed(self) -> int:
+        """
+        :return: bytes of the file read so far, which are the compressed bytes for compressed files
+        """
+        return self.counter.consumed
+
+    @property
+    def size(self) -> Union[int, None]:
+        """
+        :return: bytes of the file, None for pipes
+        """
+        if self.counter.seekable() and os.path.isfile(self.path):
+            return os.path.getsize(self.path)
+        return None
+
+    def fileno(self) -> int:
+        return self.counter.fileno()
+
+
+def input_file(path: str) -> InputFile:
+    """
+    the type of the arguments of input files, instead of argparse.FileType('r')
+    :param path: path of a plain or compressed file, or "-" for stdin
+    :return: see InputFile
+    """
+    try:
+        return InputFile(path)
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't open '{path}': {e}")
+
+
+def read_lines(file: Union[TextIO, List[str]], desc: str = "Reading: ") -> Iterator[str]:
+    """
+    read the lines of a file once, the progress is measured by the (compressed) bytes consumed, so that the lines
+    are not counted by another pass. Seekable files are read from the beginning, the same as after wc_l
+    :param file: InputFile, other text streams or lists of lines
+    :param desc: see progress
+    :return: lines
+    """
+    if isinstance(file, list):
+        yield from progress(file, desc=desc, total=len(file))
+        return
+    if file.seekable():
+        file.seek(0)
+    if not isinstance(file, InputFile) or file.size is None:
+        yield from progress(file, desc=desc, unit=" lines")
+        return
+    with progress(desc=desc, total=file.size, unit="B", unit_scale=True) as bar:
+        consumed = file.consumed
+        bar.update(consumed)
+        for line in file:
+            yield line
+            # the counter moves once per read of READ_BUFFER bytes
+            if file.consumed != consumed:
+                bar.update(file.consumed - consumed)
+                consumed = file.consumed
+    pass
+
+
+def rereadable(file: TextIO, tmp_dir: str = None) -> TextIO:
+    """
+    input files read more than once (e.g., a testing set parsed every round) should be seekable, read_lines rewinds
+    them. Stdin and pipes are not, so their lines are copied once to a temporary file, which is removed when closed
+    :param file: InputFile or other text streams
+    :param tmp_dir: folder of the temporary file, None for the default temporary folder
+    :return: file itself if it is seekable, otherwise the temporary file holding its lines
+    """
+    if file.seekable():
+        return file
+    spooled = tempfile.TemporaryFile('w+', encoding='utf-8', dir=tmp_dir)
+    for line in read_lines(file, desc="Spooling: "):
+        spooled.write(line)
+    file.close()
+    spooled.seek(0)
+    return spooled
+
+
+def spill_run(records: List, tmp_dir: str = None) -> str:
+    """
+    write records to a temporary file, one json per line
+    :param records: json serializable records, already sorted
+    :param tmp_dir: folder of the temporary file, None for the default one
+    :return: path of the run
+    """
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogatepass') as fout:
+        for record in records:
+            fout.write(json.dumps(record))
+            fout.write("\n")
+    return path
+
+
+def read_run(path: str) -> Iterator[Tuple]:
+    """
+    read the records saved by spill_run, lists are converted to tuples, the run is removed after read
+    :param path: path of the run
+    :return: records
+    """
+    try:
+        with open(path, 'r', encoding='utf-8', errors='surrogatepass') as fin:
+            for line in fin:
+                yield tuple(json.loads(line))
+    finally:
+        os.remove(path)
+
+
+def merge_runs(runs: List[str], key: Callable[[Any], Any]) -> Iterator[Tuple]:
+    """
+    merge sorted runs, records with the same key keep the order of the runs
+    :param runs: paths of runs, see spill_run
+    :param key: sorting key
+    :return: records
+    """
+    return heapq.merge(*[read_run(run) for run in runs], key=key)
+
+
+def external_sort(records: Iterable[Tuple], key: Callable[[Any], Any], max_entries: int = 1 << 22,
+                  tmp_dir: str = None) -> Iterator[Tuple]:
+    """
+    stable sort which keeps at most `max_entries` records in memory, sorted runs are spilled to disk
+    :param records: json serializable records
+    :param key: sorting key
+    :param max_entries: max number of records in memory
+    :param tmp_dir: folder of the runs
+    :return: sorted records
+    """
+    runs, buffer = [], []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= max_entries:
+            runs.append(spill_run(sorted(buffer, key=key), tmp_dir))
+            buffer = []
+    buffer.sort(key=key)
+    if len(runs) == 0:
+        yield from buffer
+        return
+    runs.append(spill_run(buffer, tmp_dir))
+    del buffer
+    yield from merge_runs(runs, key=key)
+
+
+def count_lines(file: TextIO, max_entries: int = 1 << 22, tmp_dir: str = None) -> Tuple[int, Iterator[Tuple[str, int]]]:
+    """
+    count the appearances of lines by reading the file once.
+    At most `max_entries` unique lines are kept in memory, the others are spilled to disk as sorted runs
+    :param file: lines, "\\r\\n" will be stripped
+    :param max_entries: max number of unique lines in memory
+    :param tmp_dir: folder of the runs
+    :return: number of lines, and (line, appearance) in the order of first appearance if nothing is spilled,
+        otherwise in lexicographic order
+    """
+    counter = {}
+    runs = []
+    total = 0
+    for line in read_lines(file, desc="Reading: "):
+        line = line.strip("\r\n")
+        total += 1
+        counter[line] = counter.get(line, 0) + 1
+        if len(counter) >= max_entries:
+            runs.append(spill_run(sorted(counter.items()), tmp_dir))
+            counter = {}
+    if len(runs) == 0:
+        return total, iter(counter.items())
+    runs.append(spill_run(sorted(counter.items()), tmp_dir))
+    del counter
+
+    def merged():
+        prev, cnt = None, 0
+        for line, num in merge_runs(runs, key=lambda x: x[0]):
+            if line != prev and cnt > 0:
+                yield prev, cnt
+                cnt = 0
+            prev = line
+            cnt += num
+        if cnt > 0:
+            yield prev, cnt
+
+    return total, merged()
@@ -0,0 +1,182 @@
+"""
+Compact store of n-gram like models, i.e., prefix -> (token -> prob), in contiguous arrays.
+
+Tokens and prefixes are interned to integer ids. The transitions of the i-th prefix are the entries
+offsets[i]:offsets[i + 1] of token_ids, probs and cum_sums (cumulative sums of the probs within the prefix),
+which is the CSR layout of the sparse matrix prefix x token. There is no dict per prefix, so the model takes about
+20 bytes per transition instead of a few hundred.
+FlatModel is a LazyExpanded: the expanded distribution of a prefix is built from the arrays when it is first reached,
+so that the simulators sample and score with it the same way as with the dicts.
+"""
+from array import array
+from collections.abc import Mapping
+from math import log2
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy
+
+from lib4mc.ProbLib import LazyExpanded, alias_table
+
+
+def segment_cum_sums(offsets: numpy.ndarray, probs: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param offsets: the entries of the i-th segment are offsets[i]:offsets[i + 1], segments should not be empty
+    :param probs: values of the entries
+    :return: cumulative sums of the values within each segment
+    """
+    # one cumsum over all entries, and the sum of the previous segment is subtracted at the start of a segment
+    cum_sums = numpy.array(probs, dtype=numpy.float64)
+    if len(offsets) > 2:
+        cum_sums[offsets[1:-1]] -= numpy.add.reduceat(probs, offsets[:-1])[:-1]
+    numpy.cumsum(cum_sums, out=cum_sums)
+    return cum_sums
+
+
+class FlatModel(LazyExpanded):
+    def __init__(self, contexts: List[Tuple], tokens: List[str], offsets: numpy.ndarray, token_ids: numpy.ndarray,
+                 probs: numpy.ndarray, cum_sums: numpy.ndarray = None, minus_log_based: bool = False,
+                 alias: int = None, max_contexts: int = None, context_ids: Dict[Tuple, int] = None):
+        """
+        :param contexts: the i-th prefix
+        :param tokens: the token of id i
+        :param offsets: the transitions of the i-th prefix are offsets[i]:offsets[i + 1], len(contexts) + 1 entries
+        :param token_ids: token id of each transition
+        :param probs: prob (or count) of each transition, None if the subclass provides them by _segment
+        :param cum_sums: cumulative sums of probs within each prefix, computed if None
+        :param minus_log_based: see expand_1d
+        :param alias: see expand_2d
+        :param max_contexts: see LazyExpanded
+        :param context_ids: prefix -> id, built if None
+        """
+        super().__init__({}, minus_log_based=minus_log_based, alias=alias, max_contexts=max_contexts)
+        self.contexts = contexts
+        self.tokens = tokens
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.token_ids = numpy.asarray(token_ids, dtype=numpy.int32)
+        if probs is not None:
+            self.probs = numpy.asarray(probs, dtype=numpy.float64)
+            self.cum_sums = segment_cum_sums(self.offsets, self.probs) if cum_sums is None else cum_sums
+        if context_ids is None:
+            context_ids = {ctx: i for i, ctx in enumerate(contexts)}
+        self.__context_ids = context_ids
+        pass
+
+    @classmethod
+    def from_dict(cls, two_d_dict: Dict[Tuple, Dict[str, float]], consume: bool = False, **kwargs) -> "FlatModel":
+        """
+        :param two_d_dict: prefix -> (token -> prob or count), prefixes without tokens are dropped
+        :param consume: replace the dicts of two_d_dict by None once converted, to lower the peak memory
+        :param kwargs: see __init__
+        :return: the model in arrays, in the order of two_d_dict
+        """
+        contexts, tokens = [], []
+        ids_of_tokens: Dict[str, int] = {}
+        offsets, token_ids, probs = array('q', [0]), array('i'), array('d')
+        for ctx, items in two_d_dict.items():
+            if items is None or len(items) == 0:
+                continue
+            contexts.append(ctx)
+            for token, prob in items.items():
+                token_id = ids_of_tokens.get(token)
+                if token_id is None:
+                    token_id = len(tokens)
+                    ids_of_tokens[token] = token_id
+                    tokens.append(token)
+                token_ids.append(token_id)
+                probs.append(prob)
+            offsets.append(len(token_ids))
+            if consume:
+                two_d_dict[ctx] = None
+        return cls(contexts, tokens, numpy.frombuffer(offsets, dtype=numpy.int64),
+                   numpy.frombuffer(token_ids, dtype=numpy.int32), numpy.frombuffer(probs, dtype=numpy.float64),
+                   **kwargs)
+
+    def context_id(self, context: Tuple) -> int:
+        """
+        :return: id of the prefix, -1 if it is not in the model
+        """
+        return self.__context_ids.get(context, -1)
+
+    def _segment(self, start: int, end: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :return: probs and their cumulative sums of the transitions start:end, which are of the same prefix
+        """
+        return self.probs[start:end], self.cum_sums[start:end]
+
+    def _expand(self, k) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+        i = self.__context_ids[k]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        keys = [self.tokens[t] for t in self.token_ids[start:end].tolist()]
+        probs, cum_sums = self._segment(start, end)
+        values = probs.tolist()
+        if self.minus_log_based:
+            values = [-log2(v) for v in values]
+        items = dict(zip(keys, values))
+        if self.alias is not None and end - start >= self.alias:
+            return items, keys, cum_sums, alias_table(probs)
+        return items, keys, cum_sums
+
+    def __contains__(self, k) -> bool:
+        return k in self.__context_ids
+
+    def __iter__(self) -> Iterator:
+        return iter(self.contexts)
+
+    def __len__(self) -> int:
+        return len(self.contexts)
+
+    def dicts(self, minus_log_based: bool = False) -> "FlatDicts":
+        """
+        :param minus_log_based: whether the values are minus log probs instead of probs
+        :return: read-only view prefix -> (token -> value) sharing the arrays, e.g., for the enumerators
+        """
+        return FlatDicts(FlatModel(self.contexts, self.tokens, self.offsets, self.token_ids, self.probs,
+                                   cum_sums=self.cum_sums, minus_log_based=minus_log_based,
+                                   context_ids=self.__context_ids))
+
+    def to_dict(self, integral: bool = False) -> Dict[Tuple, Dict[str, float]]:
+        """
+        :param integral: the values are counts, convert them to int
+        :return: prefix -> (token -> prob or count), in the order of the model
+        """
+        two_d_dict = {}
+        offsets = self.offsets.tolist()
+        for i, ctx in enumerate(self.contexts):
+            start, end = offsets[i], offsets[i + 1]
+            values, _ = self._segment(start, end)
+            two_d_dict[ctx] = dict(zip([self.tokens[t] for t in self.token_ids[start:end].tolist()],
+                                       values.astype(numpy.int64).tolist() if integral else values.tolist()))
+        return two_d_dict
+
+    def __getstate__(self):
+        # the ids of the prefixes and the cumulative sums are built again when loaded
+        state = super().__getstate__()
+        del state[f"_{FlatModel.__name__}__context_ids"]
+        del state["cum_sums"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cum_sums = segment_cum_sums(self.offsets, self.probs)
+        self.__context_ids = {ctx: i for i, ctx in enumerate(self.contexts)}
+
+
+class FlatDicts(Mapping):
+    def __init__(self, model: FlatModel):
+        """
+        prefix -> (token -> value) view of a FlatModel, the dict of a prefix is built when first accessed
+        :param model: see FlatModel.dicts
+        """
+        self.__model = model
+
+    def __getitem__(self, k) -> Dict[str, float]:
+        return self.__model[k][0]
+
+    def __contains__(self, k) -> bool:
+        return k in self.__model
+
+    def __iter__(self) -> Iterator:
+        return iter(self.__model)
+
+    def __len__(self) -> int:
+        return len(self.__model)
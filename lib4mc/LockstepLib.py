@@ -0,0 +1,145 @@
+"""
+Draw samples from n-gram like models by advancing many chains in lockstep.
+
+The expanded model {context: (items, keys, cum_sums)} is flattened into arrays, and a FlatModel is used as it is.
+Context i owns the entries offsets[i]:offsets[i + 1], whose keys are i + cum_sums / cum_sums[-1]. Therefore one
+searchsorted on the keys picks the next token of every chain at once. The context reached after an entry is resolved
+when the entry is first drawn and then cached in an array.
+"""
+from math import log2
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import numpy
+
+from lib4mc.FlatLib import FlatModel
+
+
+class LockstepSampler:
+    def __init__(self, expanded: Dict[Tuple, Tuple[Dict[Any, float], List[Any], List[float]]], start: Tuple,
+                 next_context: Callable[[Tuple, Any], Tuple], end_chr: str, min_len: int = 4, max_len: int = 256):
+        """
+        :param expanded: obtained by expand_2d, LazyExpanded or FlatModel, the items are probs.
+            The arrays of a FlatModel are used directly
+        :param start: the context where every chain starts
+        :param next_context: (context, token) -> the context to draw the next token.
+            Note that the next context should only depend on the current context and the token
+        :param end_chr: the token which finishes a chain
+        :param min_len: a finished chain shorter than min_len is dropped and started again
+        :param max_len: a chain reaching max_len is dropped and started again
+        """
+        self.contexts = list(expanded.keys())
+        self.__context_ids = {ctx: i for i, ctx in enumerate(self.contexts)}
+        if start not in self.__context_ids:
+            raise Exception(f"Start context {start} is not in the model")
+        self.start = self.__context_ids[start]
+        self.next_context = next_context
+        self.min_len = min_len
+        self.max_len = max_len
+        if isinstance(expanded, FlatModel):
+            self.tokens = list(expanded.tokens)
+            token_ids = {t: i for i, t in enumerate(self.tokens)}
+            offsets = expanded.offsets
+            owners = numpy.repeat(numpy.arange(len(self.contexts)), numpy.diff(offsets))
+            self.__keys = owners + expanded.cum_sums / expanded.cum_sums[offsets[1:] - 1][owners]
+            entry_tokens = expanded.token_ids
+            minus_log_probs = -numpy.log2(expanded.probs)
+        else:
+            self.tokens: List[str] = []
+            token_ids: Dict[str, int] = {}
+            offsets, keys, entry_tokens, minus_log_probs = [0], [], [], []
+            for i, ctx in enumerate(self.contexts):
+                items, ctx_keys, cum_sums = expanded[ctx][:3]
+                cum_sums = numpy.asarray(cum_sums, dtype=float)
+                keys.append(i + cum_sums / cum_sums[-1])
+                for k in ctx_keys:
+                    if k not in token_ids:
+                        token_ids[k] = len(self.tokens)
+                        self.tokens.append(k)
+                    entry_tokens.append(token_ids[k])
+                    minus_log_probs.append(-log2(items.get(k)))
+                offsets.append(offsets[-1] + len(ctx_keys))
+            offsets = numpy.array(offsets, dtype=numpy.int64)
+            self.__keys = numpy.concatenate(keys) if len(keys) > 0 else numpy.empty(0)
+        self.__last = offsets[1:] - 1
+        self.__owners = numpy.repeat(numpy.arange(len(self.contexts)), numpy.diff(offsets))
+        self.__entry_tokens = numpy.asarray(entry_tokens, dtype=numpy.int32)
+        self.__minus_log_probs = numpy.asarray(minus_log_probs, dtype=float)
+        token_lens = numpy.array([len(t) for t in self.tokens], dtype=numpy.int64)
+        self.__lens = token_lens[self.__entry_tokens]
+        self.__ends = self.__entry_tokens == token_ids.get(end_chr, -1)
+        # -1 for unresolved entries
+        self.__next = numpy.full(len(self.__entry_tokens), -1, dtype=numpy.int64)
+        pass
+
+    def __resolve(self, entries: numpy.ndarray):
+        for j in numpy.unique(entries).tolist():
+            ctx = self.next_context(self.contexts[self.__owners[j]], self.tokens[self.__entry_tokens[j]])
+            if ctx not in self.__context_ids:
+                raise Exception(f"Context {ctx} is not in the model")
+            self.__next[j] = self.__context_ids[ctx]
+
+    def sample(self, size: int, rng: numpy.random.Generator, width: int = 4096, keep_passwords: bool = False) \
+            -> Tuple[numpy.ndarray, Union[List[str], None]]:
+        """
+        advance `width` chains in lockstep, a finished chain is replaced by a new one until `size` chains are started.
+        The i-th sample is the one of the i-th chain started, and every chain started runs until it finishes.
+        Keeping the chains finishing first instead would bias the samples towards the short passwords of large probs
+        :param size: sample size
+        :param rng: random generator, the samples only depend on the state of rng and width
+        :param width: number of chains
+        :param keep_passwords: whether to return the sampled passwords
+        :return: minus log probs of the samples, and the sampled passwords (None if keep_passwords is False)
+        """
+        width = min(max(1, width), size)
+        results = numpy.empty(size)
+        passwords = [""] * size if keep_passwords else None
+        # the sample drawn by each chain
+        seqs = numpy.arange(width)
+        n_started = width
+        ctx = numpy.full(width, self.start, dtype=numpy.int64)
+        minus_log_probs = numpy.zeros(width)
+        lens = numpy.zeros(width, dtype=numpy.int64)
+        steps = numpy.zeros(width, dtype=numpy.int64)
+        history = numpy.empty((width, 64), dtype=numpy.int32) if keep_passwords else None
+        while len(seqs) > 0:
+            n_chains = len(seqs)
+            entries = numpy.searchsorted(self.__keys, ctx + rng.random(n_chains), side='right')
+            entries = numpy.minimum(entries, self.__last[ctx])
+            minus_log_probs += self.__minus_log_probs[entries]
+            ends = self.__ends[entries]
+            going = ~ends
+            if keep_passwords:
+                if steps.max() >= history.shape[1]:
+                    history = numpy.concatenate([history, numpy.empty_like(history)], axis=1)
+                history[numpy.arange(n_chains), steps] = self.__entry_tokens[entries]
+            lens += numpy.where(going, self.__lens[entries], 0)
+            steps += going
+            finished = ends & (lens >= self.min_len)
+            # a chain dropped for its length draws the same sample again, as sample1 does
+            restart = finished | (ends & (lens < self.min_len)) | (going & (lens >= self.max_len))
+            moving = entries[~restart]
+            unresolved = moving[self.__next[moving] < 0]
+            if len(unresolved) > 0:
+                self.__resolve(unresolved)
+            ctx[~restart] = self.__next[moving]
+            done = numpy.flatnonzero(finished)
+            results[seqs[done]] = minus_log_probs[done]
+            if keep_passwords:
+                for i in done.tolist():
+                    passwords[seqs[i]] = "".join([self.tokens[t] for t in history[i, :steps[i]].tolist()])
+            ctx[restart] = self.start
+            minus_log_probs[restart] = .0
+            lens[restart] = 0
+            steps[restart] = 0
+            n_new = min(len(done), size - n_started)
+            seqs[done[:n_new]] = numpy.arange(n_started, n_started + n_new)
+            n_started += n_new
+            if n_new < len(done):
+                # no more chains to start, the chains finished are retired
+                alive = numpy.ones(n_chains, dtype=bool)
+                alive[done[n_new:]] = False
+                seqs, ctx, minus_log_probs, lens, steps = \
+                    seqs[alive], ctx[alive], minus_log_probs[alive], lens[alive], steps[alive]
+                if keep_passwords:
+                    history = history[alive]
+        return results, passwords
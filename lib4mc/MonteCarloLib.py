@@ -1,21 +1,356 @@
-import bisect
-from math import log2, ceil
-from typing import List, Tuple, TextIO
+"""
+This is a library for ranking passwords by the Monte Carlo method.
+
+On-disk layout of a rank table (all integers are little endian):
+    magic (8 bytes) | header length (uint64) | JSON header, padded with spaces to a multiple of 64 bytes |
+    sorted minus log probs (float64 * size) | cumulative positions (float64 * size) |
+    minus log proposal probs (float64 * size, only if weighted)
+The JSON header holds the format version, the fingerprint of the model, the number of samples
+and whether the samples are drawn from a proposal distribution (importance sampling).
+Results dumped by `write_binary` are framed in the same way (with another magic),
+and the header lists the names and dtypes of the columns following it.
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+from itertools import islice
+from math import log2
+from stat import S_ISREG
+from typing import List, Tuple, TextIO, Union, Dict, Iterator
 
 import numpy
-from tqdm import tqdm
+
+from lib4mc.PerfLib import progress, phase
+
+TABLE_MAGIC = b"MCTABLE\x00"
+TABLE_VERSION = 1
+TABLE_ALIGN = 64
+RESULT_MAGIC = b"MCGUESS\x00"
+RESULT_VERSION = 1
+
+
+def fingerprint(*components) -> str:
+    """
+    fingerprint of a model, the model is described by the components used to build it
+    :param components: opened regular files are identified by their names, sizes and mtimes, and os.PathLike
+        components (e.g., pathlib.Path) by the names, sizes and mtimes of the files in them. Only the components
+        themselves are taken as files, strings are always hashed by their content, and lists and tuples by their
+        items, so that a training list holding a password such as "." is not taken as a folder.
+        Opened files which are not regular files (e.g., stdin) can not be identified, and the fingerprint is then
+        unique, i.e., a rank table is never reused for them
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+
+    def _update(comp):
+        if isinstance(comp, (list, tuple)):
+            sha.update(f"seq:{len(comp)}".encode("utf-8"))
+            for item in comp:
+                _update(item)
+        else:
+            sha.update(repr(comp).encode("utf-8"))
+        sha.update(b"\x00")
+
+    for component in components:
+        if hasattr(component, "fileno") and hasattr(component, "name"):
+            stat = os.fstat(component.fileno())
+            if not S_ISREG(stat.st_mode):
+                print(f"{component.name} is not a regular file, its rank table will not be reused", file=sys.stderr)
+                sha.update(os.urandom(16))
+            else:
+                sha.update(f"file:{component.name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+            sha.update(b"\x00")
+        elif isinstance(component, os.PathLike):
+            path = os.fspath(component)
+            for root, dirs, files in os.walk(path) if os.path.isdir(path) else [("", [], [path])]:
+                dirs.sort()
+                for file in sorted(files):
+                    stat = os.stat(os.path.join(root, file))
+                    sha.update(f"path:{os.path.join(root, file)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+            sha.update(b"\x00")
+        else:
+            _update(component)
+    return sha.hexdigest()
+
+
+def _create_table(path: str, size: int, model_fingerprint: str, weighted: bool = False) \
+        -> Tuple[str, numpy.ndarray, numpy.ndarray, Union[numpy.ndarray, None]]:
+    """
+    create a temporary table file for `path`, rename it to `path` when the arrays are filled
+    :return: path of the temporary file, writable minus log probs, positions and minus log proposal probs
+        (None if not weighted)
+    """
+    header = json.dumps({"version": TABLE_VERSION, "fingerprint": model_fingerprint, "size": size,
+                         "weighted": weighted}).encode("utf-8")
+    header += b" " * (-(len(TABLE_MAGIC) + 8 + len(header)) % TABLE_ALIGN)
+    offset = len(TABLE_MAGIC) + 8 + len(header)
+    n_arrays = 3 if weighted else 2
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as fout:
+        fout.write(TABLE_MAGIC)
+        fout.write(struct.pack("<Q", len(header)))
+        fout.write(header)
+        fout.truncate(offset + 8 * n_arrays * size)
+    if size == 0:
+        return tmp_path, numpy.zeros(0), numpy.zeros(0), numpy.zeros(0) if weighted else None
+    arrays = [numpy.memmap(tmp_path, dtype="<f8", mode='r+', offset=offset + 8 * size * i, shape=(size,))
+              for i in range(n_arrays)]
+    return tmp_path, arrays[0], arrays[1], arrays[2] if weighted else None
+
+
+def merge_sorted(shards: List[numpy.ndarray], out: numpy.ndarray, chunk: int = 1 << 20,
+                 payloads: List[numpy.ndarray] = None, out_payload: numpy.ndarray = None) -> None:
+    """
+    k-way merge of sorted arrays, at most `chunk` items of each shard are loaded at a time.
+    Therefore, both the shards and `out` could be memory-mapped files larger than RAM.
+    :param shards: sorted arrays
+    :param out: merged array, its length should be the total length of the shards
+    :param chunk: block size
+    :param payloads: arrays aligned with the shards, reordered in the same way as the shards
+    :param out_payload: merged payloads
+    """
+    heads = [0 for _ in shards]
+    filled = 0
+    while True:
+        blocks = [(i, shard[heads[i]:heads[i] + chunk]) for i, shard in enumerate(shards) if heads[i] < len(shard)]
+        if len(blocks) == 0:
+            break
+        # items not larger than the smallest tail of the blocks are ready to be merged,
+        # and at least one block is consumed entirely
+        bound = min(block[-1] for _, block in blocks)
+        parts, payload_parts = [], []
+        for i, block in blocks:
+            n = len(block) if block[-1] <= bound else numpy.searchsorted(block, bound, side='right')
+            parts.append(block[:n])
+            if payloads is not None:
+                payload_parts.append(payloads[i][heads[i]:heads[i] + n])
+            heads[i] += n
+        merged = numpy.concatenate(parts)
+        if payloads is None:
+            merged.sort(kind='stable')
+        else:
+            order = merged.argsort(kind='stable')
+            merged = merged[order]
+            out_payload[filled:filled + len(merged)] = numpy.concatenate(payload_parts)[order]
+        out[filled:filled + len(merged)] = merged
+        filled += len(merged)
+    pass
+
+
+def cum_positions(minus_log_probs: numpy.ndarray, out: numpy.ndarray, chunk: int = 1 << 22,
+                  minus_log_proposals: numpy.ndarray = None) -> None:
+    """
+    positions of sorted minus log probs, the same as `(2 ** (minus_log_probs - log2(n))).cumsum()`
+    but computed block by block
+    :param minus_log_probs: sorted minus log probs of all samples
+    :param out: positions
+    :param chunk: block size
+    :param minus_log_proposals: if samples are drawn from a proposal distribution q instead of the model p,
+        a sample adds 1 / (n * q) instead of 1 / (n * p) to the positions (importance sampling)
+    """
+    if len(minus_log_probs) == 0:
+        return
+    if minus_log_proposals is None:
+        minus_log_proposals = minus_log_probs
+    logn = log2(len(minus_log_probs))
+    carry = .0
+    for start in range(0, len(minus_log_probs), chunk):
+        block = 2 ** (numpy.asarray(minus_log_proposals[start:start + chunk], dtype=numpy.float64) - logn)
+        block[0] += carry
+        block.cumsum(out=block)
+        out[start:start + len(block)] = block
+        carry = block[-1]
+    pass
 
 
 class MonteCarloLib:
-    def __init__(self, minus_log_prob_list: List[float]):
-        minus_log_prob_list.sort()
-        self.__minus_log_prob_list = minus_log_prob_list
-        minus_log_probs, positions = self.__gen_rank_from_minus_log_prob()
-        self.__minus_log_probs = minus_log_probs
-        self.__positions = positions
+    def __init__(self, minus_log_prob_list: Union[List[float], None],
+                 minus_log_proposal_list: Union[List[float], None] = None):
+        """
+        :param minus_log_prob_list: minus log probs of samples given by the model
+        :param minus_log_proposal_list: minus log probs of samples given by the proposal distribution,
+            None if the samples are drawn from the model itself
+        """
         self.__gc = None
+        self.__minus_log_proposals = None
+        if minus_log_prob_list is None:
+            # filled by the alternative constructors, such as `load`
+            return
+        with phase("Tabulating", items=len(minus_log_prob_list)):
+            if minus_log_proposal_list is not None:
+                minus_log_probs = numpy.fromiter(minus_log_prob_list, float)
+                order = minus_log_probs.argsort(kind='stable')
+                self.__minus_log_prob_list = None
+                self.__minus_log_probs = minus_log_probs[order]
+                self.__minus_log_proposals = numpy.fromiter(minus_log_proposal_list, float)[order]
+                self.__positions = numpy.empty(len(order))
+                cum_positions(self.__minus_log_probs, self.__positions,
+                              minus_log_proposals=self.__minus_log_proposals)
+                return
+            minus_log_prob_list.sort()
+            self.__minus_log_prob_list = minus_log_prob_list
+            minus_log_probs, positions = self.__gen_rank_from_minus_log_prob()
+            self.__minus_log_probs = minus_log_probs
+            self.__positions = positions
+        pass
+
+    @classmethod
+    def from_arrays(cls, minus_log_probs: numpy.ndarray, positions: numpy.ndarray,
+                    minus_log_proposals: numpy.ndarray = None) -> "MonteCarloLib":
+        """
+        build the lib from sorted minus log probs and corresponding positions directly
+        :param minus_log_probs: sorted, could be a numpy.memmap
+        :param positions: cumulative positions, could be a numpy.memmap
+        :param minus_log_proposals: aligned with minus_log_probs, None if not weighted
+        :return: MonteCarloLib
+        """
+        mc = cls(None)
+        mc.__minus_log_prob_list = None
+        mc.__minus_log_probs = minus_log_probs
+        mc.__positions = positions
+        mc.__minus_log_proposals = minus_log_proposals
+        return mc
+
+    def __len__(self):
+        return len(self.__minus_log_probs)
+
+    def save(self, path: str, model_fingerprint: str = "") -> None:
+        """
+        save sorted minus log probs and positions so that the table can be reloaded by `load`
+        :param path: table file
+        :param model_fingerprint: fingerprint of the model used to draw the samples
+        """
+        weighted = self.__minus_log_proposals is not None
+        tmp_path, minus_log_probs, positions, minus_log_proposals = _create_table(
+            path, len(self.__minus_log_probs), model_fingerprint, weighted=weighted)
+        chunk = 1 << 22
+        for start in range(0, len(minus_log_probs), chunk):
+            minus_log_probs[start:start + chunk] = self.__minus_log_probs[start:start + chunk]
+            positions[start:start + chunk] = self.__positions[start:start + chunk]
+            if weighted:
+                minus_log_proposals[start:start + chunk] = self.__minus_log_proposals[start:start + chunk]
+        del minus_log_probs, positions, minus_log_proposals
+        # replace at the end, the old table may still be memory-mapped
+        os.replace(tmp_path, path)
         pass
 
+    @classmethod
+    def from_shards(cls, shards: List[Union[str, "MonteCarloLib", numpy.ndarray, List[float], Tuple]],
+                    path: str = None, model_fingerprint: Union[str, None] = None,
+                    chunk: int = 1 << 20) -> "MonteCarloLib":
+        """
+        build a table from independently sampled shards by a k-way merge,
+        the positions are recomputed with the global sample size
+        :param shards: table files, MonteCarloLibs, minus log probs (sorted if not yet),
+            or tuples of minus log probs and minus log proposal probs for importance samples
+        :param path: write the merged table to this file and memory-map it, None to keep it in memory
+        :param model_fingerprint: fingerprint of the merged table, use the one of the table files if None
+        :param chunk: block size of the merge
+        :return: MonteCarloLib
+        """
+        arrays, proposals, fingerprints = [], [], set()
+        for shard in shards:
+            if isinstance(shard, str):
+                header, _ = cls.read_header(shard)
+                fingerprints.add(header["fingerprint"])
+                shard = cls.load(shard)
+            if isinstance(shard, MonteCarloLib):
+                arrays.append(shard.__minus_log_probs)
+                proposals.append(shard.__minus_log_proposals)
+                continue
+            arr, proposal = (shard if isinstance(shard, tuple) else (shard, None))
+            arr = numpy.asarray(arr, dtype=numpy.float64)
+            if proposal is not None:
+                proposal = numpy.asarray(proposal, dtype=numpy.float64)
+            if len(arr) > 1 and not numpy.all(arr[:-1] <= arr[1:]):
+                order = arr.argsort(kind='stable')
+                arr = arr[order]
+                proposal = proposal[order] if proposal is not None else None
+            arrays.append(arr)
+            proposals.append(proposal)
+        if len(fingerprints) > 1:
+            raise Exception(f"shards were sampled from different models")
+        if model_fingerprint is None:
+            model_fingerprint = fingerprints.pop() if len(fingerprints) > 0 else ""
+        weighted = any(proposal is not None for proposal in proposals)
+        if weighted:
+            # samples drawn from the model itself are weighted by the model
+            proposals = [arr if proposal is None else proposal for arr, proposal in zip(arrays, proposals)]
+        else:
+            proposals = None
+        size = sum(len(arr) for arr in arrays)
+        if path is None:
+            minus_log_probs, positions = numpy.empty(size), numpy.empty(size)
+            minus_log_proposals = numpy.empty(size) if weighted else None
+        else:
+            tmp_path, minus_log_probs, positions, minus_log_proposals = _create_table(
+                path, size, model_fingerprint, weighted=weighted)
+        merge_sorted(arrays, minus_log_probs, chunk=chunk, payloads=proposals, out_payload=minus_log_proposals)
+        cum_positions(minus_log_probs, positions, minus_log_proposals=minus_log_proposals)
+        if path is None:
+            return cls.from_arrays(minus_log_probs, positions, minus_log_proposals)
+        del minus_log_probs, positions, minus_log_proposals
+        os.replace(tmp_path, path)
+        return cls.load(path)
+
+    def add_samples(self, minus_log_prob_list: Union[List[float], numpy.ndarray],
+                    minus_log_proposal_list: Union[List[float], numpy.ndarray, None] = None,
+                    path: str = None, model_fingerprint: str = "") -> None:
+        """
+        refine the table with more samples, only the new samples are sorted,
+        and then merged with the sorted samples in the table
+        :param minus_log_prob_list: minus log probs of new samples
+        :param minus_log_proposal_list: minus log proposal probs of new samples, None if drawn from the model
+        :param path: write the refined table to this file and memory-map it, None to keep it in memory
+        :param model_fingerprint: fingerprint of the refined table
+        """
+        merged = MonteCarloLib.from_shards([self, (minus_log_prob_list, minus_log_proposal_list)], path=path,
+                                           model_fingerprint=model_fingerprint)
+        self.__minus_log_prob_list = None
+        self.__minus_log_probs = merged.__minus_log_probs
+        self.__positions = merged.__positions
+        self.__minus_log_proposals = merged.__minus_log_proposals
+        pass
+
+    @staticmethod
+    def read_header(path: str) -> Tuple[dict, int]:
+        """
+        :param path: table file
+        :return: JSON header and the offset of the first array
+        """
+        with open(path, 'rb') as fin:
+            magic = fin.read(len(TABLE_MAGIC))
+            if magic != TABLE_MAGIC:
+                raise Exception(f"{path} is not a Monte Carlo rank table")
+            header_len, = struct.unpack("<Q", fin.read(8))
+            header = json.loads(fin.read(header_len).decode("utf-8"))
+        if header.get("version") != TABLE_VERSION:
+            raise Exception(f"{path} has version {header.get('version')}, expected {TABLE_VERSION}")
+        return header, len(TABLE_MAGIC) + 8 + header_len
+
+    @classmethod
+    def load(cls, path: str, model_fingerprint: Union[str, None] = None) -> "MonteCarloLib":
+        """
+        memory-map a table saved by `save`, tables larger than RAM are fine
+        :param path: table file
+        :param model_fingerprint: raise an exception if given and not equal to the saved one
+        :return: MonteCarloLib
+        """
+        header, offset = cls.read_header(path)
+        if model_fingerprint is not None and header["fingerprint"] != model_fingerprint:
+            raise Exception(f"{path} was built for another model")
+        size, weighted = header["size"], header.get("weighted", False)
+        if size == 0:
+            return cls.from_arrays(numpy.zeros(0), numpy.zeros(0), numpy.zeros(0) if weighted else None)
+        minus_log_probs = numpy.memmap(path, dtype="<f8", mode='r', offset=offset, shape=(size,))
+        positions = numpy.memmap(path, dtype="<f8", mode='r', offset=offset + 8 * size, shape=(size,))
+        minus_log_proposals = None
+        if weighted:
+            minus_log_proposals = numpy.memmap(path, dtype="<f8", mode='r', offset=offset + 16 * size, shape=(size,))
+        return cls.from_arrays(minus_log_probs, positions, minus_log_proposals)
+
     def __gen_rank_from_minus_log_prob(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
         """
         calculate the ranks according to Monte Carlo method
@@ -27,10 +362,162 @@ class MonteCarloLib:
         return minus_log_probs, positions
         pass
 
+    def rank_errors(self, guesses: List[int]) -> List[dict]:
+        """
+        Monte Carlo standard errors of the rank estimates at guess number checkpoints.
+        Let w_i = 2 ** (mlp_i - log2(n)) (mlp of the proposal for importance samples),
+        the rank estimate at the k-th sample is sum_{i <= k} w_i,
+        and its variance is estimated by sum_{i <= k} w_i ** 2 - (sum_{i <= k} w_i) ** 2 / n.
+        :param guesses: guess number checkpoints
+        :return: for each checkpoint, the minus log prob whose rank reaches the checkpoint, the rank,
+            the standard error, the relative error and the 95% confidence interval.
+            The errors are None if the checkpoint is beyond the largest rank in the table
+        """
+        n = len(self.__minus_log_probs)
+        indices = numpy.searchsorted(self.__positions, guesses, side='left') if n > 0 else [0 for _ in guesses]
+        reached = [int(idx) for idx in indices if idx < n]
+        sq_sums = numpy.zeros(0)
+        if len(reached) > 0:
+            logn = log2(n)
+            with numpy.errstate(over='ignore'):
+                weighted = self.__minus_log_proposals is not None
+                minus_log_weights = (self.__minus_log_proposals if weighted else self.__minus_log_probs)
+                weights = 2 ** (numpy.asarray(minus_log_weights[:max(reached) + 1]) - logn)
+                sq_sums = (weights * weights).cumsum()
+        errors = []
+        for guess, idx in zip(guesses, indices):
+            if idx >= n:
+                errors.append({"guesses": guess, "minus_log_prob": None, "rank": None, "std_err": None,
+                               "rel_err": None, "lower": None, "upper": None})
+                continue
+            rank = float(self.__positions[idx])
+            std_err = float(numpy.sqrt(max(sq_sums[idx] - rank * rank / n, .0)))
+            errors.append({"guesses": guess, "minus_log_prob": float(self.__minus_log_probs[idx]), "rank": rank,
+                           "std_err": std_err, "rel_err": std_err / rank,
+                           "lower": max(rank - 1.96 * std_err, .0), "upper": rank + 1.96 * std_err})
+        return errors
+
+    def max_rel_err(self, guesses: List[int]) -> float:
+        """
+        :param guesses: guess number checkpoints
+        :return: the largest relative error of the rank estimates at the checkpoints, inf if any is not reached
+        """
+        rel_errs = [e["rel_err"] for e in self.rank_errors(guesses)]
+        return max([float('inf') if r is None else r for r in rel_errs], default=.0)
+
+    def write_rank_errors(self, fd: TextIO, guesses: List[int]) -> None:
+        """
+        write the error bounds of the rank estimates at the checkpoints in json
+        """
+        if not fd.writable():
+            raise Exception(f"{fd.name} is not writable")
+        json.dump({"samples": len(self), "checkpoints": self.rank_errors(guesses)}, fd, indent=2)
+        pass
+
     def ml2p2rank(self, minus_log_prob):
-        idx = bisect.bisect_right(self.__minus_log_probs, minus_log_prob)
+        idx = numpy.searchsorted(self.__minus_log_probs, minus_log_prob, side='right')
         return self.__positions[idx - 1] if idx > 0 else 1
 
+    def ml2p_arr2position(self, minus_log_probs: numpy.ndarray) -> numpy.ndarray:
+        """
+        the vectorized version of ml2p2rank, minus log probs are not necessarily sorted
+        :param minus_log_probs: minus log probs
+        :return: positions (estimated guess numbers, not rounded)
+        """
+        idx = numpy.searchsorted(self.__minus_log_probs, minus_log_probs, side='right')
+        positions = numpy.ones(len(idx), dtype=numpy.float64)
+        found = idx > 0
+        positions[found] = self.__positions[idx[found] - 1]
+        return positions
+
+    def ml2p_arr2rank(self, minus_log_probs: numpy.ndarray, counts: numpy.ndarray, add1: bool = True,
+                      prev_rank: float = 0, prev_cracked: int = 0, total: int = None) \
+            -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        rank a batch of minus log probs at once, the vectorized version of ml2p_iter2gc
+        :param minus_log_probs: sorted in ascending order
+        :param counts: appearances of corresponding passwords
+        :param add1: rank is larger than previous one
+        :param prev_rank: rank of the password before this batch, to rank a long list batch by batch
+        :param prev_cracked: cracked passwords before this batch
+        :param total: number of passwords to compute cracked ratios, the cracked passwords of this batch if None
+        :return: ranks (int64, or python ints in an object array if a rank could reach 2^62, so that the ranks are
+            exact as with ml2p2rank), cumulative cracked and cracked ratios
+        """
+        minus_log_probs = numpy.asarray(minus_log_probs, dtype=numpy.float64)
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        raw_ranks = numpy.ceil(self.ml2p_arr2position(minus_log_probs))
+        addon = 1 if add1 else 0
+        steps = numpy.arange(1, len(raw_ranks) + 1, dtype=numpy.int64) * addon
+        prev_rank = int(prev_rank)
+        if len(raw_ranks) == 0 or max(raw_ranks.max(), prev_rank) + len(raw_ranks) < 2 ** 62:
+            raw_ranks = raw_ranks.astype(numpy.int64)
+        else:
+            # float64 can not tell rank_{i-1} + 1 from rank_{i-1} above 2^53
+            raw_ranks = numpy.array([int(r) for r in raw_ranks.tolist()], dtype=object)
+            steps = steps.astype(object)
+        # rank_i = max(ceil(position_i), rank_{i-1} + addon) with rank_{-1} = prev_rank,
+        # i.e., rank_i = (i + 1) * addon + max(prev_rank, max_{j <= i} (ceil(position_j) - (j + 1) * addon))
+        ranks = numpy.maximum.accumulate(numpy.maximum(raw_ranks - steps, prev_rank)) + steps
+        cracked = counts.cumsum() + prev_cracked
+        if total is None:
+            total = cracked[-1] if len(cracked) > 0 else 0
+        ratios = cracked / max(total, 1) * 100
+        return ranks, cracked, ratios
+
+    def write_stream(self, minus_log_prob_iter: Iterator[Tuple[str, int, float]], total: int, fd: TextIO,
+                     add1: bool = True, chunk: int = 1 << 16) -> None:
+        """
+        rank scored passwords batch by batch and write them in the same format as write2,
+        so that the scored passwords are not held in memory, see MonteCarlo.parse_file_stream
+        :param minus_log_prob_iter: (pwd, appearance, minus log prob) in ascending order of minus log probs
+        :param total: number of passwords, to compute cracked ratios
+        :param fd: file to save the results
+        :param add1: rank is larger than previous one
+        :param chunk: number of passwords ranked at a time
+        """
+        if not fd.writable():
+            raise Exception(f"{fd.name} is not writable")
+        minus_log_prob_iter = iter(minus_log_prob_iter)
+        prev_rank, prev_cracked = 0, 0
+        with progress(desc="Saving: ", total=total) as bar:
+            while True:
+                batch = list(islice(minus_log_prob_iter, chunk))
+                if len(batch) == 0:
+                    break
+                appearances = numpy.fromiter((a for _, a, _ in batch), dtype=numpy.int64, count=len(batch))
+                mlps = numpy.fromiter((mlp for _, _, mlp in batch), dtype=numpy.float64, count=len(batch))
+                ranks, cracked, ratios = self.ml2p_arr2rank(mlps, appearances, add1=add1, prev_rank=prev_rank,
+                                                            prev_cracked=prev_cracked, total=total)
+                for (pwd, _, _), mlp, appearance, rank, cracked_num, cracked_ratio in zip(
+                        batch, mlps.tolist(), appearances.tolist(), self.__ranks2int(ranks), cracked.tolist(),
+                        ratios.tolist()):
+                    fd.write(f"{pwd}\t{mlp:.8f}\t{appearance}\t{rank}\t{cracked_num}\t{cracked_ratio:5.2f}\n")
+                prev_rank, prev_cracked = ranks[-1], int(cracked[-1])
+                bar.update(int(appearances.sum()))
+        pass
+
+    def rank_scored(self, minus_log_prob_iter: List[Tuple[str, int, float]],
+                    need_resort: bool = False, add1: bool = True) -> None:
+        """
+        rank scored passwords and keep the results as columns, which are written by write2, write_curve
+        and write_binary. Use this instead of ml2p_iter2gc if the list of results is not needed
+        :param add1: rank is larger than previous one
+        :param need_resort:
+        :param minus_log_prob_iter: sorted
+        """
+        with phase("Ranking", items=len(minus_log_prob_iter)):
+            if need_resort:
+                minus_log_prob_iter = sorted(minus_log_prob_iter, key=lambda x: x[2])
+            pwds = [pwd for pwd, _, _ in minus_log_prob_iter]
+            appearances = numpy.fromiter((a for _, a, _ in minus_log_prob_iter), dtype=numpy.int64,
+                                         count=len(minus_log_prob_iter))
+            mlps = numpy.fromiter((mlp for _, _, mlp in minus_log_prob_iter), dtype=numpy.float64,
+                                  count=len(minus_log_prob_iter))
+            ranks, cracked, ratios = self.ml2p_arr2rank(mlps, appearances, add1=add1)
+            self.__gc = (pwds, mlps, appearances, ranks, cracked, ratios)
+        pass
+
     def ml2p_iter2gc(self, minus_log_prob_iter: List[Tuple[str, int, float]],
                      need_resort: bool = False, add1: bool = True) \
             -> List[Tuple[str, float, int, int, int, float]]:
@@ -41,28 +528,114 @@ class MonteCarloLib:
         :param minus_log_prob_iter: sorted
         :return:
         """
-        if need_resort:
-            minus_log_prob_iter = sorted(minus_log_prob_iter, key=lambda x: x[2])
-        gc = []
-        prev_rank = 0
-        cracked = 0
-        total = sum([a for _, a, _ in minus_log_prob_iter])
-        addon = 1 if add1 else 0
-        for pwd, appearance, mlp in tqdm(minus_log_prob_iter, desc="Ranking: "):
-            idx = bisect.bisect_right(self.__minus_log_probs, mlp)
-            rank = ceil(max(self.__positions[idx - 1] if idx > 0 else 1, prev_rank + addon))
-            cracked += appearance
-            prev_rank = rank
-            gc.append((pwd, mlp, appearance, rank, cracked, cracked / total * 100))
-        self.__gc = gc
+        self.rank_scored(minus_log_prob_iter, need_resort=need_resort, add1=add1)
+        pwds, mlps, appearances, ranks, cracked, ratios = self.__gc
+        gc = list(zip(pwds, mlps.tolist(), appearances.tolist(), self.__ranks2int(ranks), cracked.tolist(),
+                      ratios.tolist()))
         return gc
 
-    def write2(self, fd: TextIO):
+    @staticmethod
+    def __ranks2int(ranks: numpy.ndarray) -> List[int]:
+        if len(ranks) == 0 or ranks[-1] < 2 ** 62:
+            return numpy.asarray(ranks).astype(numpy.int64).tolist()
+        return [int(r) for r in ranks.tolist()]
+
+    def __check_gc(self, fd):
         if not fd.writable():
             raise Exception(f"{fd.name} is not writable")
         if self.__gc is None:
-            raise Exception(f"run mlps2gc before invoke this method")
-        for pwd, mlp, appearance, rank, cracked, cracked_ratio in tqdm(self.__gc, desc="Saving: "):
+            raise Exception(f"run rank_scored or ml2p_iter2gc before invoke this method")
+
+    def write2(self, fd: TextIO):
+        """
+        write one line per password: pwd, minus log prob, appearance, rank, cracked, cracked ratio
+        """
+        self.__check_gc(fd)
+        pwds, mlps, appearances, ranks, cracked, ratios = self.__gc
+        for pwd, mlp, appearance, rank, cracked, cracked_ratio in progress(
+                zip(pwds, mlps.tolist(), appearances.tolist(), self.__ranks2int(ranks), cracked.tolist(),
+                    ratios.tolist()), total=len(pwds), desc="Saving: "):
             fd.write(f"{pwd}\t{mlp:.8f}\t{appearance}\t{rank}\t{cracked}\t{cracked_ratio:5.2f}\n")
         self.__gc = None
         pass
+
+    def write_curve(self, fd: TextIO, points_per_decade: int = 10):
+        """
+        write the guess number curve at log-spaced checkpoints: guesses, cracked, cracked ratio.
+        The last line is the largest rank, i.e., all passwords are cracked
+        :param fd: file to save the curve
+        :param points_per_decade: number of checkpoints between 10^k and 10^(k+1)
+        """
+        self.__check_gc(fd)
+        _, _, _, ranks, cracked, ratios = self.__gc
+        if len(ranks) == 0:
+            return
+        ranks = numpy.asarray(ranks, dtype=numpy.float64)
+        decades = max(numpy.log10(ranks[-1]), .0)
+        guesses = numpy.unique(numpy.ceil(numpy.logspace(0, decades, int(numpy.ceil(decades * points_per_decade)) + 1)))
+        guesses[-1] = ranks[-1]
+        # the number of passwords whose ranks are not larger than the checkpoint
+        idx = numpy.searchsorted(ranks, guesses, side='right')
+        for guess, i in zip(self.__ranks2int(guesses), idx.tolist()):
+            fd.write(f"{guess}\t{cracked[i - 1] if i > 0 else 0}\t{ratios[i - 1] if i > 0 else .0:5.2f}\n")
+        pass
+
+    def write_binary(self, path: str):
+        """
+        dump the results as columns, see read_binary.
+        Passwords are not included, the columns are minus log prob (float64), appearance (int64),
+        rank (float64) and cracked (int64) in little endian
+        :param path: binary file
+        """
+        if self.__gc is None:
+            raise Exception(f"run rank_scored or ml2p_iter2gc before invoke this method")
+        _, mlps, appearances, ranks, cracked, _ = self.__gc
+        columns = [("minus_log_prob", "<f8", mlps), ("appearance", "<i8", appearances), ("rank", "<f8", ranks),
+                   ("cracked", "<i8", cracked)]
+        header = json.dumps({"version": RESULT_VERSION, "size": len(mlps),
+                             "columns": [[name, dtype] for name, dtype, _ in columns]}).encode("utf-8")
+        header += b" " * (-(len(RESULT_MAGIC) + 8 + len(header)) % TABLE_ALIGN)
+        with open(path, 'wb') as fout:
+            fout.write(RESULT_MAGIC)
+            fout.write(struct.pack("<Q", len(header)))
+            fout.write(header)
+            for _, dtype, column in columns:
+                fout.write(numpy.ascontiguousarray(column, dtype=dtype).tobytes())
+        pass
+
+    @staticmethod
+    def read_binary(path: str) -> Dict[str, numpy.ndarray]:
+        """
+        memory-map the columns dumped by write_binary
+        :param path: binary file
+        :return: column name -> column
+        """
+        with open(path, 'rb') as fin:
+            if fin.read(len(RESULT_MAGIC)) != RESULT_MAGIC:
+                raise Exception(f"{path} is not a Monte Carlo result file")
+            header_len, = struct.unpack("<Q", fin.read(8))
+            header = json.loads(fin.read(header_len).decode("utf-8"))
+        if header.get("version") != RESULT_VERSION:
+            raise Exception(f"{path} has version {header.get('version')}, expected {RESULT_VERSION}")
+        size, offset = header["size"], len(RESULT_MAGIC) + 8 + header_len
+        columns = {}
+        for name, dtype in header["columns"]:
+            columns[name] = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(size,)) \
+                if size > 0 else numpy.zeros(0, dtype=dtype)
+            offset += numpy.dtype(dtype).itemsize * size
+        return columns
+
+    def write_results(self, save: TextIO = None, curve: TextIO = None, binary: str = None):
+        """
+        write the requested outputs, the per-password text is written last because it releases the results
+        :param save: see write2
+        :param curve: see write_curve
+        :param binary: see write_binary
+        """
+        if curve is not None:
+            self.write_curve(curve)
+        if binary is not None:
+            self.write_binary(binary)
+        if save is not None:
+            self.write2(save)
+        pass
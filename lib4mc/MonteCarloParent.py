@@ -1,14 +1,93 @@
 import abc
+import argparse
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import sys
+import time
 from collections import defaultdict
+from itertools import islice
 from math import log2
-from typing import List, TextIO, Tuple, Union, Dict
+from typing import List, TextIO, Tuple, Union, Dict, Sequence, Iterator, Container
 
-from tqdm import tqdm
+import numpy
 
-from lib4mc.FileLib import wc_l
+from lib4mc.FileLib import read_lines, count_lines, external_sort
+from lib4mc.MonteCarloLib import MonteCarloLib
+from lib4mc.PerfLib import progress
+
+# samples are drawn in chunks of this size, each chunk with its own random stream,
+# so that the samples only depend on the master seed instead of the number of workers
+SAMPLE_CHUNK = 100000
+# unique passwords of the testing set are scored in chunks of this size by the worker processes
+SCORE_CHUNK = 256
+# the model shipped to worker processes, see _init_worker
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _draw_chunk_in_worker(task):
+    return _worker_model.draw_chunk(*task)
+
+
+def _score_chunk_in_worker(pwds):
+    return _worker_model.score_chunk(pwds)
+
+
+def worker_pool(model, workers: int) -> multiprocessing.pool.Pool:
+    """
+    a process pool whose workers hold the model. The model is shipped once per worker instead of per task,
+    and it is inherited rather than pickled if processes are forked. If model.shared is set, the model is published
+    into shared memory first, and the workers attach to it instead of holding a copy each
+    :param model: the model used by the workers
+    :param workers: number of processes
+    :return: pool
+    """
+    if model.shared:
+        model.share()
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context()
+    return ctx.Pool(processes=workers, initializer=_init_worker, initargs=(model,))
+
+
+def accept_proposals(minus_log_proposals: List[float], draws: int) -> List[float]:
+    """
+    the samples of a proposal which rejects some draws (e.g., too short passwords) follow q / Z, where Z is the
+    acceptance rate of the proposal. The importance weight p / q of such a sample overestimates the rank by 1 / Z,
+    therefore the proposal probs are divided by the acceptance rate estimated from the number of draws
+    :param minus_log_proposals: minus log probs given by the proposal of the accepted samples
+    :param draws: number of draws from the proposal, including the rejected ones
+    :return: minus log probs of the normalized proposal
+    """
+    if draws <= len(minus_log_proposals):
+        return minus_log_proposals
+    shift = log2(len(minus_log_proposals) / draws)
+    return [mlq + shift for mlq in minus_log_proposals]
 
 
 class MonteCarlo(metaclass=abc.ABCMeta):
+    # random number generator of the samplers, a seeded random.Random is used for each chunk of parallel sampling
+    rng = random
+    # if it is set, only the sampled passwords in it are kept by draw_chunk, see sample_hits
+    sample_targets: Union[Container[str], None] = None
+    # publish the model into shared memory by share before starting worker processes
+    shared = False
+
+    def share(self):
+        """
+        publish the tables of the model into shared memory, once, and use them instead of the private ones.
+        Worker processes attach to the shared tables read-only, so that the memory stays at the size of one model
+        no matter how many workers there are. Models without shareable tables keep them private
+        """
+        pass
+
     @staticmethod
     def minus_log2(prob: float) -> float:
         return -log2(prob)
@@ -30,10 +109,160 @@ class MonteCarlo(metaclass=abc.ABCMeta):
         """
         return .0, ""
 
-    def sample(self, size: int, sampled_pwds: Dict[str, List] = None, clearIfNotNone: bool = True) -> List[float]:
+    def sample1_tempered(self, temperature: float) -> (float, float, str, int):
+        """
+        get one sample from the tempered proposal, i.e., each step draws from q ~ p ** (1 / temperature).
+        A temperature larger than 1 flattens the model, so that more samples land in the tail
+        :param temperature: temperature of the proposal
+        :return: (minus log prob given by the model, minus log prob given by the proposal, sample, number of draws
+            from the proposal to get the sample, i.e., 1 + the rejected ones), see accept_proposals
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support tempered sampling")
+
+    def sample_tempered(self, size: int, temperature: float, workers: int = 1,
+                        seed: Union[int, Sequence[int], None] = None) -> Tuple[List[float], List[float]]:
+        """
+        importance sampling, see sample1_tempered
+        :param size: sample size
+        :param temperature: temperature of the proposal
+        :param workers: number of processes, see sample_parallel
+        :param seed: master seed, see sample_parallel
+        :return: minus log probs given by the model and by the proposal
+        """
+        if workers > 1 or seed is not None:
+            minus_log_probs, minus_log_proposals, _ = self.sample_parallel(size, workers, seed=seed,
+                                                                           temperature=temperature)
+            return minus_log_probs, minus_log_proposals
+        minus_log_probs, minus_log_proposals = [], []
+        draws = 0
+        for _ in progress(iterable=range(size), desc="Sampling: "):
+            mlp, mlq, _, n = self.sample1_tempered(temperature)
+            minus_log_probs.append(mlp)
+            minus_log_proposals.append(mlq)
+            draws += n
+        return minus_log_probs, accept_proposals(minus_log_proposals, draws)
+
+    def draw_chunk(self, seed_seq: numpy.random.SeedSequence, size: int, temperature: Union[float, None],
+                   keep_samples: bool) \
+            -> Tuple[List[float], Union[List[float], None], Union[Dict[str, List], None], int]:
+        """
+        draw a chunk of samples using the random stream given by `seed_seq`
+        :param seed_seq: seed of the chunk
+        :param size: sample size
+        :param temperature: see sample1_tempered, None to draw from the model
+        :param keep_samples: whether to return the sampled passwords
+        :return: minus log probs, minus log proposal probs (None if temperature is None),
+            sampled passwords (None if keep_samples is False, see count_samples), and the number of draws
+            (larger than size if some draws from the proposal are rejected, see sample1_tempered)
+        """
+        had_rng, prev_rng = 'rng' in self.__dict__, self.__dict__.get('rng')
+        self.rng = random.Random(int(seed_seq.generate_state(1, numpy.uint64)[0]))
+        results, proposals, pwds = [], None if temperature is None else [], []
+        draws = size
+        try:
+            for _ in range(size):
+                if temperature is None:
+                    prob, pwd = self.sample1()
+                else:
+                    prob, proposal, pwd, n = self.sample1_tempered(temperature)
+                    proposals.append(proposal)
+                    draws += n - 1
+                results.append(prob)
+                if keep_samples:
+                    pwds.append(pwd)
+        finally:
+            if had_rng:
+                self.rng = prev_rng
+            else:
+                del self.rng
+        return results, proposals, self.count_samples(results, pwds) if keep_samples else None, draws
+
+    def count_samples(self, minus_log_probs: List[float], pwds: List[str]) -> Dict[str, List]:
+        """
+        :param minus_log_probs: minus log probs of the samples
+        :param pwds: sampled passwords
+        :return: sampled password -> [minus log prob, count]. If sample_targets is set, only the passwords in it
+            are kept, as sampled password -> [minus log prob, count, index of the first draw]
+        """
+        samples = {}
+        targets = self.sample_targets
+        for i, (prob, pwd) in enumerate(zip(minus_log_probs, pwds)):
+            if targets is not None and pwd not in targets:
+                continue
+            if pwd not in samples:
+                samples[pwd] = [prob, 0] if targets is None else [prob, 0, i]
+            samples[pwd][1] += 1
+        return samples
+
+    def sample_parallel(self, size: int, workers: int, seed: Union[int, Sequence[int], None] = None,
+                        temperature: float = None, keep_samples: bool = False) \
+            -> Tuple[List[float], Union[List[float], None], Union[Dict[str, List], None]]:
+        """
+        draw samples in chunks of SAMPLE_CHUNK by a process pool, see draw_chunk.
+        Every chunk has its own random stream spawned from the master seed,
+        therefore the samples are reproducible for a given seed regardless of `workers`
+        :param size: sample size
+        :param workers: number of processes, draw the chunks in this process if not larger than 1
+        :param seed: master seed, a random one if None
+        :param temperature: see sample1_tempered, None to draw from the model
+        :param keep_samples: whether to return the sampled passwords
+        :return: minus log probs, minus log proposal probs (None if temperature is None, otherwise corrected by
+            accept_proposals), and sampled passwords (None if keep_samples is False), see draw_chunk
+        """
+        if seed is None:
+            seed = random.getrandbits(64)
+        chunk_seqs = numpy.random.SeedSequence(seed).spawn((size + SAMPLE_CHUNK - 1) // SAMPLE_CHUNK)
+        tasks = [(seq, min(SAMPLE_CHUNK, size - i * SAMPLE_CHUNK), temperature, keep_samples)
+                 for i, seq in enumerate(chunk_seqs)]
+        results, proposals, samples = [], None if temperature is None else [], {} if keep_samples else None
+        draws = 0
+        pool = worker_pool(self, workers) if workers > 1 else None
+        try:
+            chunks = pool.imap(_draw_chunk_in_worker, tasks) if pool is not None \
+                else (self.draw_chunk(*task) for task in tasks)
+            with progress(total=size, desc="Sampling: ") as bar:
+                for (chunk_results, chunk_proposals, chunk_samples, chunk_draws), task in zip(chunks, tasks):
+                    if keep_samples:
+                        for pwd, (prob, cnt, *first) in chunk_samples.items():
+                            if pwd not in samples:
+                                # the index of the first draw is shifted by the samples of previous chunks
+                                samples[pwd] = [prob, 0] + [len(results) + i for i in first]
+                            samples[pwd][1] += cnt
+                    results.extend(chunk_results)
+                    if temperature is not None:
+                        proposals.extend(chunk_proposals)
+                    draws += chunk_draws
+                    bar.update(task[1])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if temperature is not None:
+            proposals = accept_proposals(proposals, draws)
+        return results, proposals, samples
+
+    def sample(self, size: int, sampled_pwds: Dict[str, List] = None, clearIfNotNone: bool = True,
+               workers: int = 1, seed: Union[int, Sequence[int], None] = None) -> List[float]:
+        """
+        :param size: sample size
+        :param sampled_pwds: if it is a dict, the sampled passwords with their minus log probs and counts
+            are put into it
+        :param clearIfNotNone: clear sampled_pwds before putting the sampled passwords into it
+        :param workers: number of processes, see sample_parallel
+        :param seed: master seed, see sample_parallel
+        :return: minus log probs of the samples
+        """
+        if workers > 1 or seed is not None:
+            results, _, samples = self.sample_parallel(size, workers, seed=seed,
+                                                       keep_samples=isinstance(sampled_pwds, dict))
+            if isinstance(sampled_pwds, dict):
+                if clearIfNotNone:
+                    sampled_pwds.clear()
+                sampled_pwds.update(samples)
+            return results
         results = []
         samples = {}
-        for _ in tqdm(iterable=range(size), desc="Sampling: "):
+        for _ in progress(iterable=range(size), desc="Sampling: "):
             prob, pwd = self.sample1()
             results.append(prob)
             if pwd not in samples:
@@ -45,25 +274,234 @@ class MonteCarlo(metaclass=abc.ABCMeta):
             sampled_pwds.update(samples)
         return results
 
-    def parse_file(self, testing_set: TextIO, using_component: bool = False) -> \
+    def sample_hits(self, size: int, targets: Container[str], workers: int = 1,
+                    seed: Union[int, Sequence[int], None] = None) -> Tuple[List[float], Dict[str, List]]:
+        """
+        sample attack without keeping every sampled password: only the samples in `targets` are kept
+        :param size: sample size
+        :param targets: passwords to be cracked, e.g., a set of the testing set
+        :param workers: number of processes, see sample_parallel
+        :param seed: master seed, see sample_parallel
+        :return: minus log probs of all samples, and hit password -> [minus log prob, count, index of the first draw]
+        """
+        self.sample_targets = targets
+        try:
+            results, _, hits = self.sample_parallel(size, workers, seed=seed, keep_samples=True)
+        finally:
+            del self.sample_targets
+        return results, hits
+
+    def rank_table(self, size: int, table: str = None, model_fingerprint: str = "",
+                   grow: bool = False, rel_err: float = None, guesses: List[int] = None,
+                   time_budget: float = None, temperature: float = None, workers: int = 1,
+                   seed: int = None, max_samples: int = None) -> MonteCarloLib:
+        """
+        reuse the rank table saved in `table` if it was built for the same model,
+        otherwise sample `size` passwords to build the table (and save it to `table`)
+        :param size: sample size
+        :param table: path of the rank table, None to always sample
+        :param model_fingerprint: see lib4mc.MonteCarloLib.fingerprint
+        :param grow: add `size` more samples to the reused table and save it
+        :param rel_err: adaptive mode, keep adding batches of `size` samples until the relative errors of
+            the rank estimates at `guesses` are not larger than `rel_err`
+        :param guesses: guess number checkpoints of the adaptive mode
+        :param time_budget: adaptive mode, stop adding samples after `time_budget` seconds
+        :param temperature: draw importance samples from the tempered proposal, None to draw from the model
+        :param workers: number of processes to draw samples, see sample_parallel
+        :param seed: master seed. A batch of samples added to a table of k samples uses the seed (seed, k)
+        :param max_samples: adaptive mode, stop adding samples once the table holds this many samples. Note that a
+            checkpoint beyond the total rank mass of the model is never reached, so that the adaptive mode should be
+            bounded by max_samples or time_budget
+        :return: MonteCarloLib
+        """
+        start_at = time.time()
+
+        def draw(existing: int) -> Tuple[List[float], Union[List[float], None]]:
+            batch_seed = None if seed is None else [seed, existing]
+            if temperature is None:
+                return self.sample(size=size, workers=workers, seed=batch_seed), None
+            return self.sample_tempered(size, temperature, workers=workers, seed=batch_seed)
+
+        mc = self.__rank_table(table, model_fingerprint, grow, draw)
+        if rel_err is None:
+            return mc
+        while True:
+            achieved = mc.max_rel_err(guesses)
+            print(f"{len(mc)} samples, max relative error: {achieved:.4f}", file=sys.stderr)
+            if achieved <= rel_err:
+                break
+            if time_budget is not None and time.time() - start_at >= time_budget:
+                print(f"Time budget ({time_budget}s) runs out", file=sys.stderr)
+                break
+            if max_samples is not None and len(mc) >= max_samples:
+                print(f"Max samples ({max_samples}) reached", file=sys.stderr)
+                break
+            mc.add_samples(*draw(len(mc)), path=table, model_fingerprint=model_fingerprint)
+        return mc
+
+    @staticmethod
+    def __rank_table(table: str, model_fingerprint: str, grow: bool, draw) -> MonteCarloLib:
+        if table is not None and os.path.exists(table):
+            header, _ = MonteCarloLib.read_header(table)
+            if header["fingerprint"] == model_fingerprint:
+                print(f"Reuse {header['size']} samples in {table}", file=sys.stderr)
+                mc = MonteCarloLib.load(table, model_fingerprint)
+                if grow:
+                    mc.add_samples(*draw(len(mc)), path=table, model_fingerprint=model_fingerprint)
+                    print(f"{table} now has {len(mc)} samples", file=sys.stderr)
+                return mc
+            print(f"{table} was built for another model, sample again", file=sys.stderr)
+        mc = MonteCarloLib(*draw(0))
+        if table is not None:
+            mc.save(table, model_fingerprint)
+        return mc
+
+    def score_chunk(self, pwds: List[str]) -> List[Tuple[float, List[str]]]:
+        """
+        :param pwds: passwords
+        :return: minus log prob and components of each password.
+            The components are [pwd] if calc_ml2p of the model only returns the minus log prob
+        """
+        res = []
+        for pwd in pwds:
+            scored = self.calc_ml2p(pwd)
+            if isinstance(scored, tuple):
+                res.append((scored[0], scored[1]))
+            else:
+                res.append((scored, [pwd]))
+        return res
+
+    def __score_pairs(self, pairs: Iterator[Tuple[str, int]], using_component: bool, workers: int,
+                      total: int = None) -> Iterator[Tuple[Union[str, List[str]], int, float]]:
+        """
+        score (pwd, appearance) pairs in chunks of SCORE_CHUNK, at most a few chunks per worker are in flight
+        :return: (pwd or components, appearance, minus log prob) in the order of pairs
+        """
+        chunks = iter(lambda: list(islice(pairs, SCORE_CHUNK)), [])
+        pool = worker_pool(self, workers) if workers > 1 else None
+        try:
+            with progress(total=total, desc="Scoring: ") as bar:
+                while True:
+                    window = list(islice(chunks, max(workers, 1) * 4))
+                    if len(window) == 0:
+                        break
+                    tasks = [[pwd for pwd, _ in chunk] for chunk in window]
+                    scored_chunks = pool.imap(_score_chunk_in_worker, tasks) if pool is not None \
+                        else (self.score_chunk(task) for task in tasks)
+                    for chunk, scored_chunk in zip(window, scored_chunks):
+                        for (pwd, num), (_mlp, components) in zip(chunk, scored_chunk):
+                            yield components if using_component else pwd, num, _mlp
+                        bar.update(len(chunk))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def parse_file(self, testing_set: TextIO, using_component: bool = False, workers: int = 1) -> \
             List[Tuple[Union[str, List[str]], int, float]]:
         """
         get minus log prob for test set
         :param using_component:
         :param testing_set: test set
+        :param workers: number of processes to score the unique passwords in chunks of SCORE_CHUNK
         :return: List of tuple (pwd, appearance, minus log prob)
         """
-        line_num = wc_l(testing_set)
         pwd_counter = defaultdict(int)
-        for line in tqdm(testing_set, desc="Reading: ", total=line_num):
+        for line in read_lines(testing_set, desc="Reading: "):
             line = line.strip("\r\n")
             pwd_counter[line] += 1
-        res: List[Tuple[Union[str, List[str]], int, float]] = []
-        for pwd, num in tqdm(pwd_counter.items(), desc="Scoring: "):  # type: str, int
-            _mlp, components = self.calc_ml2p(pwd)
-            if using_component:
-                res.append((components, num, _mlp))
-            else:
-                res.append((pwd, num, _mlp))
+        res = list(self.__score_pairs(iter(pwd_counter.items()), using_component, workers, total=len(pwd_counter)))
         res = sorted(res, key=lambda x: x[2])
         return res
+
+    def parse_file_stream(self, testing_set: TextIO, using_component: bool = False, workers: int = 1,
+                          max_entries: int = 1 << 22, tmp_dir: str = None) \
+            -> Tuple[int, Iterator[Tuple[Union[str, List[str]], int, float]]]:
+        """
+        the streaming version of parse_file for test sets which do not fit in memory.
+        The test set is read once, at most `max_entries` passwords are held in memory when counting and sorting,
+        the others are spilled to disk as sorted runs and merged
+        :param testing_set: test set
+        :param using_component: see parse_file
+        :param workers: see parse_file
+        :param max_entries: max number of passwords in memory
+        :param tmp_dir: folder of the runs, None for the default temporary folder
+        :return: number of passwords in the test set, and (pwd, appearance, minus log prob) in ascending order of
+            minus log probs, which are scored when iterated
+        """
+        total, pairs = count_lines(testing_set, max_entries=max_entries, tmp_dir=tmp_dir)
+        scored = self.__score_pairs(pairs, using_component, workers)
+        return total, external_sort(scored, key=lambda x: x[2], max_entries=max_entries, tmp_dir=tmp_dir)
+
+
+def add_simulator_arguments(cli, size: int = 100000, n_gram: bool = True, trains: bool = False):
+    """
+    add the options shared by the simulators to the argument parser of an entry point: the outputs, the rank table,
+    the sampling and the worker processes. Check them by check_simulator_arguments after parsing
+    :param cli: argparse.ArgumentParser
+    :param size: default sample size
+    :param n_gram: also add --lockstep, --max-contexts and --flat of the n-gram like models
+    :param trains: the simulator trains the model from a training file, which is counted by the workers as well
+    """
+    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=False, default=None,
+                     help="save Monte Carlo results of each password here")
+    cli.add_argument("--curve", dest="curve", type=argparse.FileType('w'), required=False, default=None,
+                     help="save the guess number curve (guesses, cracked, cracked ratio) at log-spaced checkpoints")
+    cli.add_argument("--binary", dest="binary", type=str, required=False, default=None,
+                     help="save the results as memory-mappable columns (minus log prob, appearance, rank, cracked)")
+    cli.add_argument("--size", dest="size", type=int, required=False, default=size, help="sample size")
+    cli.add_argument("--table", dest="table", type=str, required=False, default=None,
+                     help="rank table of Monte Carlo samples. Reuse it if it was built for the same model, "
+                          "otherwise sample and save the table here")
+    cli.add_argument("--grow", dest="grow", required=False, action="store_true",
+                     help="add `size` more samples to the reused rank table to refine it")
+    cli.add_argument("--adaptive", dest="adaptive", type=float, required=False, default=None,
+                     help="adaptive mode, sample in batches of `size` until the relative standard errors of "
+                          "the rank estimates at the checkpoints are not larger than the given value. "
+                          "The error bounds are saved in `<results>.bounds.json`, "
+                          "where results is the first one of save, curve and binary")
+    cli.add_argument("--checkpoints", dest="checkpoints", type=int, nargs="+", required=False,
+                     default=[10 ** i for i in range(1, 15)], help="guess number checkpoints of the adaptive mode")
+    cli.add_argument("--time-budget", dest="time_budget", type=float, required=False, default=None,
+                     help="adaptive mode, stop sampling after this many seconds")
+    cli.add_argument("--max-samples", dest="max_samples", type=int, required=False, default=None,
+                     help="adaptive mode, stop sampling once the rank table holds this many samples")
+    cli.add_argument("--temperature", dest="temperature", type=float, required=False, default=None,
+                     help="importance sampling from the model tempered by the given temperature (e.g., 2), "
+                          "so that more samples land in the tail and deep guess numbers are more precise")
+    cli.add_argument("--stream", dest="stream", required=False, action="store_true",
+                     help="read the testing set once and keep at most `max-entries` passwords in memory, "
+                          "the others are spilled to disk. Only -s/--save is supported")
+    cli.add_argument("--max-entries", dest="max_entries", type=int, required=False, default=1 << 22,
+                     help="max number of passwords of the testing set in memory in the streaming mode")
+    if n_gram:
+        cli.add_argument("--lockstep", dest="lockstep", type=int, required=False, default=0,
+                         help="draw samples by advancing this many chains in lockstep with numpy arrays "
+                              "(e.g., 4096), 0 to draw samples one by one")
+        cli.add_argument("--max-contexts", dest="max_contexts", type=int, required=False, default=None,
+                         help="build the sampling table of a context when it is first reached, and keep at most "
+                              "this many tables (least recently used ones are dropped). All tables are kept by default")
+        cli.add_argument("--flat", dest="flat", required=False, action="store_true",
+                         help="keep the model in contiguous arrays with interned tokens, which takes much less memory")
+    cli.add_argument("--shared", dest="shared", required=False, action="store_true",
+                     help="publish the model into shared memory once, the worker processes attach to it instead of "
+                          "holding a copy each" +
+                          (". Use it with --max-contexts to bound the tables built by each worker" if n_gram else ""))
+    cli.add_argument("--workers", dest="workers", type=int, required=False, default=1,
+                     help=f"number of processes to {'count the training file, to ' if trains else ''}draw samples "
+                          f"and to score the testing set")
+    cli.add_argument("--seed", dest="seed", type=int, required=False, default=None,
+                     help="seed of sampling. The samples only depend on the seed, not on the number of workers")
+
+
+def check_simulator_arguments(cli, args):
+    """
+    check the options added by add_simulator_arguments, exit with the usage if they conflict
+    """
+    if args.save is None and args.curve is None and args.binary is None:
+        cli.error("at least one of -s/--save, --curve and --binary is required")
+    if args.stream and (args.save is None or args.curve is not None or args.binary is not None):
+        cli.error("--stream only supports -s/--save")
+    if args.adaptive is not None and args.time_budget is None and args.max_samples is None:
+        # checkpoints beyond the total rank mass of the model are never reached
+        cli.error("--adaptive requires --time-budget or --max-samples")
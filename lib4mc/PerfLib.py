@@ -0,0 +1,227 @@
+"""
+Instrumentation of the phases of training, sampling, scoring and ranking.
+
+A phase records its wall time, CPU time (including the worker processes which have been joined), the number of
+items processed, the peak RSS and, if enabled, the peak memory traced by tracemalloc. `progress` is a drop-in
+replacement of tqdm which records a phase named by `desc`, and shows no progress bar in quiet mode.
+Phases started inside another phase (e.g., a round of backwords_secondary_main) are named `outer/inner`.
+"""
+import atexit
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from itertools import chain
+from typing import Iterable, List, Union
+
+from tqdm import tqdm
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _peak_rss_mb(who) -> Union[float, None]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def _cpu_time() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class PhaseRecorder:
+    def __init__(self):
+        # drop the progress bars
+        self.quiet = False
+        # trace the peak memory of python objects by tracemalloc, which slows down the program
+        self.trace_memory = False
+        self.records: List[dict] = []
+        self.__stack: List[dict] = []
+        self.__started_at = time.perf_counter()
+        self.__cpu_at = _cpu_time()
+        pass
+
+    def enable(self, quiet: bool = False, trace_memory: bool = False):
+        self.quiet = quiet
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self, name: str) -> dict:
+        """
+        :param name: name of the phase
+        :return: the record of the phase, pass it to stop
+        """
+        path = "/".join([r["name"] for r in self.__stack] + [name])
+        record = {"name": name, "path": path, "started_s": time.perf_counter() - self.__started_at,
+                  "items": None, "_wall": time.perf_counter(), "_cpu": _cpu_time(), "_peak": 0}
+        if tracemalloc.is_tracing():
+            if len(self.__stack) > 0:
+                self.__stack[-1]["_peak"] = max(self.__stack[-1]["_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.records.append(record)
+        self.__stack.append(record)
+        return record
+
+    def stop(self, record: dict):
+        """
+        :param record: returned by start, set record["items"] to the number of items processed in the phase
+        """
+        if "_wall" not in record:
+            return
+        wall = time.perf_counter() - record.pop("_wall")
+        record["wall_s"] = wall
+        record["cpu_s"] = _cpu_time() - record.pop("_cpu")
+        record["items_per_s"] = record["items"] / wall if record["items"] is not None and wall > 0 else None
+        record["peak_rss_mb"] = _peak_rss_mb(resource.RUSAGE_SELF) if resource is not None else None
+        record["peak_rss_children_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None
+        peak = record.pop("_peak")
+        if record in self.__stack:
+            self.__stack.remove(record)
+        if tracemalloc.is_tracing():
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record["peak_traced_mb"] = peak / (1 << 20)
+            if len(self.__stack) > 0:
+                self.__stack[-1]["_peak"] = max(self.__stack[-1]["_peak"], peak)
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name: str, items: int = None):
+        """
+        record a phase, e.g., `with recorder.phase("Ranking", items=len(scored)):`
+        :param name: name of the phase
+        :param items: number of items processed, could also be set by record["items"] in the block
+        """
+        record = self.start(name)
+        record["items"] = items
+        try:
+            yield record
+        finally:
+            self.stop(record)
+
+    def report(self) -> dict:
+        wall = time.perf_counter() - self.__started_at
+        return {
+            "argv": sys.argv,
+            "wall_s": wall,
+            "cpu_s": _cpu_time() - self.__cpu_at,
+            "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF) if resource is not None else None,
+            "peak_rss_children_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            "phases": [{k: v for k, v in r.items() if not k.startswith("_")} for r in self.records],
+        }
+
+    def write_report(self, path: str):
+        with open(path, 'w') as fout:
+            json.dump(self.report(), fout, indent=2)
+
+
+recorder = PhaseRecorder()
+
+
+def phase(name: str, items: int = None):
+    """
+    see PhaseRecorder.phase
+    """
+    return recorder.phase(name, items)
+
+
+class progress:
+    def __init__(self, iterable: Iterable = None, desc: str = None, total: int = None, **kwargs):
+        """
+        the same as tqdm, but the loop is recorded as a phase and there is no progress bar in quiet mode
+        :param iterable: see tqdm
+        :param desc: see tqdm, the name of the phase is desc without the trailing ": "
+        :param total: see tqdm
+        """
+        self.iterable = iterable
+        self.total = total
+        self.name = (desc or "").strip(": ") or "Progress"
+        self.n = 0
+        self.__bar = None if recorder.quiet else tqdm(iterable=iterable, desc=desc, total=total, **kwargs)
+        self.__record = None
+        pass
+
+    def __start(self):
+        if self.__record is None:
+            self.__record = recorder.start(self.name)
+
+    def __enter__(self):
+        self.__start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        self.__start()
+        if self.__bar is None:
+            length = self.total if self.total is not None else \
+                len(self.iterable) if hasattr(self.iterable, "__len__") else None
+            if length is not None:
+                # no python code per item in quiet mode, the items are counted beforehand
+                self.n = length
+                return chain(self.iterable, self.__closing())
+        return self.__counting()
+
+    def __closing(self):
+        # stops the phase once the iterable is exhausted
+        self.close()
+        yield from ()
+
+    def __counting(self):
+        try:
+            if self.__bar is not None:
+                yield from self.__bar
+            else:
+                for item in self.iterable:
+                    self.n += 1
+                    yield item
+        finally:
+            self.close()
+
+    def update(self, n: int = 1):
+        if self.__bar is not None:
+            self.__bar.update(n)
+        else:
+            self.n += n
+
+    def __del__(self):
+        # the loop is broken in quiet mode, see __closing
+        self.close()
+
+    def close(self):
+        if self.__bar is not None:
+            self.n = self.__bar.n
+            self.__bar.close()
+        if self.__record is not None:
+            self.__record["items"] = self.n
+            recorder.stop(self.__record)
+
+
+def add_perf_arguments(cli):
+    """
+    add --report, --quiet and --trace-memory to the argument parser of an entry point
+    """
+    cli.add_argument("--report", dest="report", type=str, required=False, default=None,
+                     help="save the wall time, CPU time, items/sec and peak memory of each phase here (JSON)")
+    cli.add_argument("--quiet", dest="quiet", required=False, action="store_true",
+                     help="do not show progress bars")
+    cli.add_argument("--trace-memory", dest="trace_memory", required=False, action="store_true",
+                     help="record the peak memory of python objects of each phase by tracemalloc (slow)")
+
+
+def instrument(args):
+    """
+    enable the options added by add_perf_arguments, the report is saved when the program exits
+    """
+    recorder.enable(quiet=args.quiet, trace_memory=args.trace_memory)
+    if args.report is not None:
+        atexit.register(recorder.write_report, args.report)
@@ -1,43 +1,286 @@
 import bisect
 import random
 import sys
+from collections import OrderedDict
+from collections.abc import Mapping
 from math import log2
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Iterator
 
 import numpy
 
+# alias tables of the distributions with fewer keys save little time but cost memory
+ALIAS_MIN = 64
 
-def expand_2d(two_d_dict: Dict[Any, Dict[Any, float]], minus_log_based: bool = False) \
+
+def expand_2d(two_d_dict: Dict[Any, Dict[Any, float]], minus_log_based: bool = False, alias: int = None) \
         -> Dict[Any, Tuple[Dict[Any, float], List[Any], List[float]]]:
+    """
+    :param two_d_dict: prefix -> (key -> prob or count)
+    :param minus_log_based: see expand_1d
+    :param alias: build the alias tables of the prefixes with at least `alias` keys, None to build no alias table
+    :return: prefix -> expanded distribution, see expand_1d
+    """
     new_two_d_dict = {}
     for k, items in two_d_dict.items():
         if len(items) == 0:
             continue
-        new_two_d_dict[k] = expand_1d(items, minus_log_based=minus_log_based)
+        new_two_d_dict[k] = expand_1d(items, minus_log_based=minus_log_based,
+                                      alias=alias is not None and len(items) >= alias)
     return new_two_d_dict
 
 
-def expand_1d(one_d_dict: Dict[Any, float], minus_log_based: bool = False) \
+class LazyExpanded(Mapping):
+    def __init__(self, two_d_dict: Dict[Any, Dict[Any, float]], minus_log_based: bool = False, alias: int = None,
+                 max_contexts: int = None):
+        """
+        The same as expand_2d, but the expanded distribution of a prefix is built when it is first accessed.
+        :param two_d_dict: prefix -> (key -> prob or count), kept by reference
+        :param minus_log_based: see expand_1d
+        :param alias: see expand_2d
+        :param max_contexts: keep at most this many expanded distributions, the least recently used one is dropped
+            and built again when accessed. None to keep all
+        """
+        self.__two_d_dict = {k: items for k, items in two_d_dict.items() if len(items) > 0}
+        self.minus_log_based = minus_log_based
+        self.alias = alias
+        self.max_contexts = max_contexts
+        self.__expanded: OrderedDict = OrderedDict()
+        pass
+
+    def _expand(self, k) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+        """
+        build the expanded distribution of prefix k, which is in the model
+        """
+        items = self.__two_d_dict[k]
+        return expand_1d(items, minus_log_based=self.minus_log_based,
+                         alias=self.alias is not None and len(items) >= self.alias)
+
+    def __expand(self, k) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+        expanded = self._expand(k)
+        self.__expanded[k] = expanded
+        if self.max_contexts is not None:
+            # other threads may evict concurrently, the popped one is built again when accessed
+            while len(self.__expanded) > self.max_contexts:
+                try:
+                    self.__expanded.popitem(last=False)
+                except KeyError:
+                    break
+        return expanded
+
+    def get(self, k, default=None):
+        # called for every token sampled or scored, so it avoids the KeyError of Mapping.get
+        expanded = self.__expanded.get(k)
+        if expanded is None:
+            if k not in self:
+                return default
+            return self.__expand(k)
+        if self.max_contexts is not None:
+            try:
+                self.__expanded.move_to_end(k)
+            except KeyError:
+                pass
+        return expanded
+
+    def __getitem__(self, k) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+        expanded = self.get(k)
+        if expanded is None:
+            raise KeyError(k)
+        return expanded
+
+    def __contains__(self, k) -> bool:
+        return k in self.__two_d_dict
+
+    def __iter__(self) -> Iterator:
+        return iter(self.__two_d_dict)
+
+    def __len__(self) -> int:
+        return len(self.__two_d_dict)
+
+    @property
+    def two_d_dict(self) -> Dict[Any, Dict[Any, float]]:
+        """
+        :return: prefix -> (key -> prob or count) the distributions are expanded from, empty for the subclasses
+            which expand them from other stores (e.g., FlatModel)
+        """
+        return self.__two_d_dict
+
+    @property
+    def materialized(self) -> int:
+        """
+        :return: number of expanded distributions kept
+        """
+        return len(self.__expanded)
+
+    def __getstate__(self):
+        # the expanded distributions are not pickled, they are built again when accessed
+        state = self.__dict__.copy()
+        state[f"_{LazyExpanded.__name__}__expanded"] = OrderedDict()
+        return state
+
+
+def lazy_expand_2d(two_d_dict: Dict[Any, Dict[Any, float]], minus_log_based: bool = False, alias: int = None,
+                   max_contexts: int = None) -> LazyExpanded:
+    """
+    :param two_d_dict: prefix -> (key -> prob or count), or a LazyExpanded (e.g., FlatModel) which is reused
+    :return: see LazyExpanded
+    """
+    if isinstance(two_d_dict, LazyExpanded):
+        two_d_dict.minus_log_based = minus_log_based
+        two_d_dict.alias = alias
+        two_d_dict.max_contexts = max_contexts
+        return two_d_dict
+    return LazyExpanded(two_d_dict, minus_log_based=minus_log_based, alias=alias, max_contexts=max_contexts)
+
+
+class TemperedExpanded(LazyExpanded):
+    def __init__(self, expanded: Mapping, temperature: float, minus_log_based: bool = False,
+                 max_contexts: int = None):
+        """
+        tempered proposals of the distributions of a LazyExpanded (see temper_expand), built when first accessed.
+        The items of the tempered distributions are probs
+        :param expanded: prefix -> expanded distribution, e.g., LazyExpanded or FlatModel
+        :param temperature: see temper_expand
+        :param minus_log_based: whether the items of `expanded` are minus log probs
+        :param max_contexts: see LazyExpanded
+        """
+        super().__init__({}, max_contexts=max_contexts)
+        self.expanded = expanded
+        self.temperature = temperature
+        self.expanded_minus_log_based = minus_log_based
+        pass
+
+    def _expand(self, k) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+        return temper_expand(self.expanded[k], self.temperature, minus_log_based=self.expanded_minus_log_based)
+
+    def __contains__(self, k) -> bool:
+        return k in self.expanded
+
+    def __iter__(self) -> Iterator:
+        return iter(self.expanded)
+
+    def __len__(self) -> int:
+        return len(self.expanded)
+
+
+def expand_1d(one_d_dict: Dict[Any, float], minus_log_based: bool = False, alias: bool = False) \
         -> Tuple[Dict[Any, float], List[Any], List[float]]:
+    """
+    :param one_d_dict: key -> prob or count
+    :param minus_log_based: whether the items of the expanded distribution are minus log probs instead of probs
+    :param alias: append the alias table, so that pick_expand draws a key in O(1) instead of O(log n)
+    :return: (items, keys, cum_sums), or (items, keys, cum_sums, alias table) if alias is True
+    """
     keys = list(one_d_dict.keys())
     cum_sums = numpy.array(list(one_d_dict.values())).cumsum()
     n_one = one_d_dict
     if minus_log_based:
         n_one = {k: -log2(v) for k, v in one_d_dict.items()}
+    if alias:
+        return n_one, keys, cum_sums, alias_table(list(one_d_dict.values()))
     new_one_d_dict = (n_one, keys, cum_sums)
     return new_one_d_dict
 
 
-def pick_expand(expanded: Tuple[Dict[str, float], List[str], List[float]]) -> Tuple[float, str]:
+def alias_table(weights: List[float]) -> Tuple[List[float], List[int]]:
+    """
+    Walker's alias table: draw i uniformly, then keep i with probability probs[i], otherwise take aliases[i].
+    Vose's method is vectorized: the keys whose scaled weights w are less than 1 (small) are filled by the others
+    (large) in order, and a large key becomes small itself once its excess is used up, then it is filled by the next
+    large key. Let E_j be the cumulative excess (w - 1) of the large keys and D_i the cumulative deficit (1 - w)
+    of the small keys. The i-th small key is filled by the first large key j with E_j >= D_{i-1}, and the j-th
+    large key is used up by the first small key i with D_i > E_j, leaving 1 + E_j - D_i for itself.
+    Lists instead of numpy arrays, because scalar access is faster.
+    :param weights: probs or counts of the keys
+    :return: probs and aliases
+    """
+    scaled = numpy.asarray(weights, dtype=float)
+    scaled = scaled * (len(scaled) / scaled.sum())
+    probs = numpy.ones(len(scaled))
+    aliases = numpy.arange(len(scaled))
+    small = numpy.flatnonzero(scaled < 1)
+    large = numpy.flatnonzero(scaled >= 1)
+    if len(small) == 0 or len(large) == 0:
+        return probs.tolist(), aliases.tolist()
+    deficits = (1 - scaled[small]).cumsum()
+    excesses = (scaled[large] - 1).cumsum()
+    probs[small] = scaled[small]
+    filled_by = numpy.searchsorted(excesses, numpy.concatenate([[.0], deficits[:-1]]), side='left')
+    aliases[small] = large[numpy.minimum(filled_by, len(large) - 1)]
+    # the last large key is never used up, up to rounding errors
+    used_up = numpy.searchsorted(deficits, excesses[:-1], side='right')
+    turned = numpy.flatnonzero(used_up < len(small))
+    probs[large[turned]] = numpy.clip(1 + excesses[turned] - deficits[used_up[turned]], .0, 1.)
+    aliases[large[turned]] = large[turned + 1]
+    return probs.tolist(), aliases.tolist()
+
+
+def temper_expand(expanded: Tuple[Dict[Any, float], List[Any], List[float]], temperature: float,
+                  minus_log_based: bool = False) -> Tuple[Dict[Any, float], List[Any], List[float]]:
+    """
+    tempered proposal of an expanded distribution, q ~ p ** (1 / temperature)
+    :param expanded: obtained by expand_1d
+    :param temperature: larger than 1 to flatten the distribution
+    :param minus_log_based: whether the items of `expanded` are minus log probs
+    :return: the same structure as expanded, items are the probs given by the proposal
+    """
+    items, keys = expanded[0], expanded[1]
+    probs = numpy.fromiter((items[k] for k in keys), float, count=len(keys))
+    if minus_log_based:
+        probs = 2 ** (-probs)
+    proposals = probs ** (1 / temperature)
+    proposals /= proposals.sum()
+    return dict(zip(keys, proposals.tolist())), keys, proposals.cumsum()
+
+
+def pick_expand(expanded: Tuple[Dict[str, float], List[str], List[float]], rng=random) -> Tuple[float, str]:
+    """
+    draw a key from the expanded distribution
+    :param expanded: obtained by expand_1d
+    :param rng: random.Random or the random module itself
+    :return: item and key
+    """
     try:
-        items, keys, cum_sums = expanded
+        items, keys, cum_sums = expanded[:3]
     except TypeError:
         print(expanded)
         sys.exit(-1)
+    if len(expanded) > 3:
+        probs, aliases = expanded[3]
+        x = rng.random() * len(keys)
+        idx = min(int(x), len(keys) - 1)
+        if x - idx >= probs[idx]:
+            idx = aliases[idx]
+        k: str = keys[idx]
+        return items.get(k), k
     if len(cum_sums) < 1:
         print(keys)
         pass
     total = cum_sums[-1]
-    idx = bisect.bisect_right(cum_sums, random.uniform(0, total))
+    idx = bisect.bisect_right(cum_sums, rng.uniform(0, total))
     k: str = keys[idx]
     return items.get(k), k
+
+
+def pick_expand_batch(expanded: Tuple[Dict[str, float], List[str], List[float]], size: int,
+                      rng: numpy.random.Generator) -> Tuple[List[float], List[str]]:
+    """
+    draw `size` keys from the expanded distribution at once
+    :param expanded: obtained by expand_1d
+    :param size: number of keys
+    :param rng: numpy random generator
+    :return: items and keys
+    """
+    items, keys, cum_sums = expanded[:3]
+    n = len(keys)
+    if len(expanded) > 3:
+        # converting the alias table costs O(n), which pays off when size is not much smaller than n
+        probs, aliases = expanded[3]
+        x = rng.random(size) * n
+        indices = numpy.minimum(x.astype(numpy.int64), n - 1)
+        rejected = x - indices >= numpy.asarray(probs)[indices]
+        indices[rejected] = numpy.asarray(aliases)[indices[rejected]]
+    else:
+        indices = numpy.searchsorted(cum_sums, rng.random(size) * cum_sums[-1], side='right')
+        indices = numpy.minimum(indices, n - 1)
+    picked = [keys[i] for i in indices.tolist()]
+    return [items.get(k) for k in picked], picked
@@ -1,5 +1,65 @@
+"""
+Save and load models.
+
+Besides pickles, models could be saved in a versioned binary format which is opened by memory mapping, i.e., in
+constant time, no matter how large the model is. The layout of a model file is
+
+    MODEL_MAGIC (8 bytes) | header length (uint64, little endian) | JSON header, padded to MODEL_ALIGN | arrays
+
+and every array starts at a multiple of MODEL_ALIGN. The header is
+
+    {"version": 1 or 2, "config": {...}, "tokens": n_tokens, "words": n_words,
+     "sections": {name: {"contexts": n_contexts, "transitions": n_transitions, "str_contexts": bool,
+                         "quantized": null or {"bits": 8 or 16, "step": bits of minus log prob per code}}},
+     "arrays": {name: [dtype, offset from the end of the header in bytes, length]}}
+
+where config holds what the model was trained with (e.g., start_chr, end_chr, threshold, max_gram and
+training_list of backwords). A section is a model prefix -> (token -> value) in the layout of FlatModel, e.g.,
+`counts` to continue the training and `probs` to sample and score. All sections share one token table:
+
+    tokens.offsets <i8, tokens.blob u1        utf-8 of the i-th token is blob[offsets[i]:offsets[i + 1]]
+    words.ids <i4, words.counts <i8           words (e.g., subwords of backwords) and their counts
+    {section}.offsets <i8                     transitions of the i-th prefix are offsets[i]:offsets[i + 1]
+    {section}.token_ids <i4, .values <f8, .cum_sums <f8
+    {section}.codes u1 or <u2                 instead of values and cum_sums if the section is quantized, see
+                                              lib4mc/CompactLib.py
+    {section}.context_offsets <i8, .context_token_ids <i4
+                                              tokens of the i-th prefix, a str prefix (str_contexts) is a tuple of
+                                              chars
+    {section}.slots <i8, .hashes <u4         open addressing hash table of the prefixes, -1 for empty slots.
+                                              A prefix is at slot context_hash(prefix) % len(slots), or at the
+                                              following slots (linear probing), and hashes keeps the hash of
+                                              the prefix of each slot
+
+Tokens and prefixes are decoded when they are first reached, so opening a model does not build any Python object
+per prefix or per transition, only the words are loaded into a dict.
+Version 2 adds quantized sections, files without them are saved as version 1.
+"""
+import atexit
+import json
+import mmap
+import os
 import pickle
-from typing import Dict, BinaryIO
+import struct
+import tempfile
+import zlib
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Dict, BinaryIO, Tuple, Union
+
+import numpy
+
+from lib4mc.CompactLib import dequantize, quantize
+from lib4mc.FlatLib import FlatModel, segment_cum_sums
+
+MODEL_MAGIC = b"MCMODEL\x00"
+MODEL_VERSION = 2
+MODEL_ALIGN = 64
+# max number of prefixes whose ids are cached by ContextIndex
+CONTEXT_CACHE = 1 << 20
+# models published by share_model are saved here. /dev/shm is a tmpfs, i.e., shared memory, on Linux,
+# elsewhere the pages of the file are still shared by the processes mapping it
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
 
 
 def save_ngram(ngram_float_dict: Dict[str, Dict[str, float]], n: int, end_chr: str, file: BinaryIO) -> None:
@@ -10,5 +70,346 @@ def save_ngram(ngram_float_dict: Dict[str, Dict[str, float]], n: int, end_chr: s
 
 
 def load_ngram(file: BinaryIO) -> (int, str, Dict[str, Dict[str, float]]):
+    if is_model_file(file):
+        sections, _, config = open_model(file.name)
+        return config['n'], config['end_chr'], sections['probs']
     n, end_chr, ngram_float_dict = pickle.load(file)
     return n, end_chr, ngram_float_dict
+
+
+def context_hash(context: Union[Tuple, str]) -> int:
+    """
+    :param context: a prefix, i.e., a tuple of tokens, or a str
+    :return: hash of the prefix in the hash table of the prefixes, which does not depend on PYTHONHASHSEED
+    """
+    # tokens containing \x00 may make different prefixes collide, which is resolved by comparing the prefixes
+    return zlib.crc32("\x00".join(context).encode("utf-8", "surrogatepass"))
+
+
+class TokenTable(Sequence):
+    def __init__(self, blob: numpy.ndarray, offsets: numpy.ndarray):
+        """
+        tokens in a model file, a token is decoded when it is first accessed
+        :param blob: utf-8 of the tokens
+        :param offsets: utf-8 of the i-th token is blob[offsets[i]:offsets[i + 1]]
+        """
+        self.__blob = blob
+        self.__offsets = offsets
+        self.__decoded: Dict[int, str] = {}
+        pass
+
+    def __getitem__(self, i: int) -> str:
+        token = self.__decoded.get(i)
+        if token is None:
+            if not 0 <= i < len(self):
+                raise IndexError(i)
+            start, end = int(self.__offsets[i]), int(self.__offsets[i + 1])
+            token = self.__blob[start:end].tobytes().decode("utf-8", "surrogatepass")
+            self.__decoded[i] = token
+        return token
+
+    def __len__(self) -> int:
+        return len(self.__offsets) - 1
+
+
+class ContextTable(Sequence):
+    def __init__(self, tokens: TokenTable, offsets: numpy.ndarray, token_ids: numpy.ndarray, str_contexts: bool):
+        """
+        prefixes of a section of a model file, decoded when accessed
+        :param tokens: the token table of the model file
+        :param offsets: tokens of the i-th prefix are token_ids[offsets[i]:offsets[i + 1]]
+        :param token_ids: see offsets
+        :param str_contexts: the prefixes are str instead of tuples
+        """
+        self.__tokens = tokens
+        self.__offsets = offsets
+        self.__token_ids = token_ids
+        self.__str_contexts = str_contexts
+        pass
+
+    def __getitem__(self, i: int) -> Union[Tuple, str]:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = int(self.__offsets[i]), int(self.__offsets[i + 1])
+        context = tuple([self.__tokens[t] for t in self.__token_ids[start:end].tolist()])
+        return "".join(context) if self.__str_contexts else context
+
+    def __len__(self) -> int:
+        return len(self.__offsets) - 1
+
+
+class ContextIndex(Mapping):
+    def __init__(self, contexts: ContextTable, slots: numpy.ndarray, hashes: numpy.ndarray):
+        """
+        prefix -> id of a section of a model file, looked up in the hash table saved in the file
+        :param contexts: prefixes of the section
+        :param slots: see the layout of the model file
+        :param hashes: see the layout of the model file
+        """
+        self.__contexts = contexts
+        self.__slots = slots
+        self.__hashes = hashes
+        # prefix -> id, or -1 if the prefix is not in the model
+        self.__cache: Dict[Union[Tuple, str], int] = {}
+        pass
+
+    def __lookup(self, context) -> int:
+        if len(self.__cache) >= CONTEXT_CACHE:
+            self.__cache.clear()
+        n_slots = len(self.__slots)
+        h = context_hash(context)
+        slot = h % n_slots
+        while True:
+            i = int(self.__slots[slot])
+            if i < 0 or (self.__hashes[slot] == h and self.__contexts[i] == context):
+                break
+            slot = (slot + 1) % n_slots
+        self.__cache[context] = i
+        return i
+
+    def get(self, context, default=None):
+        i = self.__cache.get(context)
+        if i is None:
+            i = self.__lookup(context)
+        return default if i < 0 else i
+
+    def __getitem__(self, context) -> int:
+        i = self.get(context)
+        if i is None:
+            raise KeyError(context)
+        return i
+
+    def __contains__(self, context) -> bool:
+        i = self.__cache.get(context)
+        if i is None:
+            i = self.__lookup(context)
+        return i >= 0
+
+    def __iter__(self):
+        return iter(self.__contexts)
+
+    def __len__(self) -> int:
+        return len(self.__contexts)
+
+
+class MappedModel(FlatModel):
+    def __init__(self, path: str, section: str, minus_log_based: bool = False, alias: int = None,
+                 max_contexts: int = None):
+        """
+        a section of a model file, the arrays are memory-mapped and shared with other processes mapping the file
+        :param path: model file
+        :param section: name of the section, e.g., probs
+        :param minus_log_based: see FlatModel
+        :param alias: see FlatModel
+        :param max_contexts: see FlatModel
+        """
+        header, arrays = _map_model(path)
+        if section not in header['sections']:
+            raise Exception(f"{path} has no section `{section}`, "
+                            f"available sections: {', '.join(header['sections'].keys())}")
+        tokens = TokenTable(arrays['tokens.blob'], arrays['tokens.offsets'])
+        contexts = ContextTable(tokens, arrays[f'{section}.context_offsets'], arrays[f'{section}.context_token_ids'],
+                                header['sections'][section]['str_contexts'])
+        quantized = header['sections'][section].get('quantized')
+        super().__init__(contexts, tokens, arrays[f'{section}.offsets'], arrays[f'{section}.token_ids'],
+                         arrays[f'{section}.values'] if quantized is None else None,
+                         cum_sums=arrays[f'{section}.cum_sums'] if quantized is None else None,
+                         minus_log_based=minus_log_based, alias=alias, max_contexts=max_contexts,
+                         context_ids=ContextIndex(contexts, arrays[f'{section}.slots'],
+                                                  arrays[f'{section}.hashes']))
+        self.path = path
+        self.section = section
+        # the probs of a quantized section are recovered from the codes of a prefix when it is expanded
+        self.__codes = None if quantized is None else arrays[f'{section}.codes']
+        self.__step = None if quantized is None else quantized['step']
+        pass
+
+    def _segment(self, start: int, end: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        if self.__codes is None:
+            return super()._segment(start, end)
+        probs = dequantize(self.__codes[start:end], self.__step, numpy.array([0, end - start]))
+        return probs, numpy.cumsum(probs)
+
+    def __getattr__(self, name):
+        # the whole arrays of a quantized section are only recovered for their users, e.g., LockstepSampler
+        if name in ("probs", "cum_sums") and self.__dict__.get(f"_{MappedModel.__name__}__codes") is not None:
+            self.probs = dequantize(self.__codes, self.__step, self.offsets)
+            self.cum_sums = segment_cum_sums(self.offsets, self.probs)
+            return self.__dict__[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __reduce__(self):
+        # map the file again instead of pickling the arrays
+        return MappedModel, (self.path, self.section, self.minus_log_based, self.alias, self.max_contexts)
+
+
+def is_model_file(file: Union[str, BinaryIO]) -> bool:
+    """
+    :param file: path, or a file opened in binary mode whose position is kept
+    :return: whether it is a model file in the binary format
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as fin:
+            return fin.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+    position = file.tell()
+    magic = file.read(len(MODEL_MAGIC))
+    file.seek(position)
+    return magic == MODEL_MAGIC
+
+
+def read_model_header(path: str) -> Tuple[dict, int]:
+    """
+    :param path: model file
+    :return: JSON header and the offset of the arrays
+    """
+    with open(path, 'rb') as fin:
+        if fin.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise Exception(f"{path} is not a model file")
+        header_len, = struct.unpack("<Q", fin.read(8))
+        header = json.loads(fin.read(header_len).decode("utf-8"))
+    if header['version'] > MODEL_VERSION:
+        raise Exception(f"{path} is of version {header['version']}, "
+                        f"but only versions up to {MODEL_VERSION} are supported")
+    return header, len(MODEL_MAGIC) + 8 + header_len
+
+
+def _map_model(path: str) -> Tuple[dict, Dict[str, numpy.ndarray]]:
+    header, offset = read_model_header(path)
+    with open(path, 'rb') as fin:
+        # the mapping is kept alive by the arrays, plain arrays are indexed much faster than numpy.memmap
+        buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for name, (dtype, array_offset, length) in header['arrays'].items():
+        arrays[name] = numpy.frombuffer(buffer, dtype=dtype, count=length, offset=offset + array_offset)
+    return header, arrays
+
+
+def save_model(path: str, sections: Dict[str, FlatModel], words: Dict[str, int] = None, config: dict = None,
+               quantized: Dict[str, int] = None):
+    """
+    save models in the binary format, see the layout at the top of this file
+    :param path: model file, written to a temporary file and renamed when done
+    :param sections: name -> model, e.g., {"counts": ..., "probs": ...}, the prefixes should be tuples or str
+    :param words: word -> count, e.g., subwords of backwords
+    :param config: JSON serializable config of the model
+    :param quantized: name -> bits of the codes (8 or 16), the sections of probs saved as quantized minus log probs
+    """
+    quantized = {} if quantized is None else quantized
+    tokens, ids_of_tokens = [], {}
+
+    def intern(token: str) -> int:
+        token_id = ids_of_tokens.get(token)
+        if token_id is None:
+            token_id = len(tokens)
+            ids_of_tokens[token] = token_id
+            tokens.append(token)
+        return token_id
+
+    arrays, header_sections = [], {}
+    for name, model in sections.items():
+        remap = numpy.array([intern(token) for token in model.tokens], dtype=numpy.int32)
+        context_offsets, context_token_ids = array('q', [0]), array('i')
+        n_contexts = len(model.contexts)
+        slots = numpy.full(1 << max(0, 2 * n_contexts - 1).bit_length(), -1, dtype=numpy.int64)
+        hashes = numpy.zeros(len(slots), dtype=numpy.uint32)
+        str_contexts = n_contexts > 0 and isinstance(model.contexts[0], str)
+        for i, ctx in enumerate(model.contexts):
+            if isinstance(ctx, str) != str_contexts:
+                raise Exception(f"prefixes of `{name}` should be all tuples or all str")
+            context_token_ids.extend([intern(token) for token in ctx])
+            context_offsets.append(len(context_token_ids))
+            h = context_hash(ctx)
+            slot = h % len(slots)
+            while slots[slot] >= 0:
+                slot = (slot + 1) % len(slots)
+            slots[slot] = i
+            hashes[slot] = h
+        header_sections[name] = {"contexts": n_contexts, "transitions": len(model.token_ids),
+                                 "str_contexts": str_contexts, "quantized": None}
+        arrays.extend([
+            (f"{name}.offsets", numpy.asarray(model.offsets, dtype="<i8")),
+            (f"{name}.token_ids", remap[model.token_ids].astype("<i4")),
+        ])
+        if name in quantized:
+            codes, step = quantize(model.probs, quantized[name])
+            header_sections[name]["quantized"] = {"bits": quantized[name], "step": step}
+            arrays.append((f"{name}.codes", codes.astype(codes.dtype.newbyteorder("<"))))
+        else:
+            arrays.extend([
+                (f"{name}.values", numpy.asarray(model.probs, dtype="<f8")),
+                (f"{name}.cum_sums", numpy.asarray(model.cum_sums, dtype="<f8")),
+            ])
+        arrays.extend([
+            (f"{name}.context_offsets", numpy.frombuffer(context_offsets, dtype=numpy.int64).astype("<i8")),
+            (f"{name}.context_token_ids", numpy.frombuffer(context_token_ids, dtype=numpy.int32).astype("<i4")),
+            (f"{name}.slots", slots.astype("<i8")),
+            (f"{name}.hashes", hashes.astype("<u4")),
+        ])
+    words = {} if words is None else words
+    arrays.extend([
+        ("words.ids", numpy.array([intern(word) for word in words.keys()], dtype="<i4")),
+        ("words.counts", numpy.array(list(words.values()), dtype="<i8")),
+    ])
+    encoded = [token.encode("utf-8", "surrogatepass") for token in tokens]
+    token_offsets = numpy.zeros(len(encoded) + 1, dtype="<i8")
+    numpy.cumsum([len(e) for e in encoded], out=token_offsets[1:])
+    arrays.extend([
+        ("tokens.offsets", token_offsets),
+        ("tokens.blob", numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)),
+    ])
+    header_arrays, array_offset = {}, 0
+    for name, values in arrays:
+        header_arrays[name] = [values.dtype.str, array_offset, len(values)]
+        array_offset += values.nbytes + (-values.nbytes % MODEL_ALIGN)
+    header = json.dumps({"version": MODEL_VERSION if len(quantized) > 0 else 1,
+                         "config": {} if config is None else config, "tokens": len(tokens), "words": len(words),
+                         "sections": header_sections, "arrays": header_arrays}).encode("utf-8")
+    header += b" " * (-(len(MODEL_MAGIC) + 8 + len(header)) % MODEL_ALIGN)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as fout:
+        fout.write(MODEL_MAGIC)
+        fout.write(struct.pack("<Q", len(header)))
+        fout.write(header)
+        for _, values in arrays:
+            fout.write(values.tobytes())
+            fout.write(b"\x00" * (-values.nbytes % MODEL_ALIGN))
+    os.replace(tmp_path, path)
+    pass
+
+
+def open_model(path: str, **kwargs) -> Tuple[Dict[str, MappedModel], Dict[str, int], dict]:
+    """
+    :param path: model file saved by save_model
+    :param kwargs: see MappedModel, applied to every section
+    :return: name -> section, word -> count and the config
+    """
+    header, arrays = _map_model(path)
+    tokens = TokenTable(arrays['tokens.blob'], arrays['tokens.offsets'])
+    words = {tokens[i]: count for i, count in zip(arrays['words.ids'].tolist(), arrays['words.counts'].tolist())}
+    sections = {name: MappedModel(path, name, **kwargs) for name in header['sections']}
+    return sections, words, header['config']
+
+
+def _remove_shared(path: str, owner: int):
+    # forked processes inherit the exit handlers of the owner
+    if os.getpid() == owner and os.path.exists(path):
+        os.remove(path)
+
+
+def share_model(sections: Dict[str, FlatModel], words: Dict[str, int] = None, config: dict = None,
+                **kwargs) -> Dict[str, MappedModel]:
+    """
+    publish models into shared memory once, the returned sections are mapped read-only. Pickling a section ships
+    its path only, so that worker processes map the same pages instead of holding a copy of the model each.
+    The shared memory is released when the publishing process exits
+    :param sections: see save_model
+    :param words: see save_model
+    :param config: see save_model
+    :param kwargs: see MappedModel, applied to every section
+    :return: name -> section
+    """
+    fd, path = tempfile.mkstemp(prefix="mcmodel-", suffix=".mcmodel", dir=SHARED_DIR)
+    os.close(fd)
+    atexit.register(_remove_shared, path, os.getpid())
+    save_model(path, sections, words, config)
+    return {name: MappedModel(path, name, **kwargs) for name in sections}
@@ -0,0 +1,219 @@
+"""
+A long-running server to score passwords: load a model and a rank table once, then answer queries.
+
+POST /rank with {"passwords": ["123456", ...]} or GET /rank?password=123456 returns
+    {"results": [{"password": "123456", "minus_log_prob": 10.2, "guesses": 1175}, ...], "latency_ms": 0.3}
+GET /stats returns the number of requests, cache hits and latency percentiles of recent requests.
+"""
+import argparse
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Dict, Any
+from urllib.parse import urlparse, parse_qs
+
+import numpy
+
+from lib4mc.MonteCarloLib import MonteCarloLib, fingerprint
+from lib4mc.MonteCarloParent import MonteCarlo
+from lib4mc.SaveModelLib import read_model_header
+
+
+class ScoringService:
+    def __init__(self, model: MonteCarlo, mc: MonteCarloLib, cache_size: int = 1000000, window: int = 10000):
+        """
+        :param model: any subclass of MonteCarlo
+        :param mc: rank table of the model
+        :param cache_size: max number of passwords whose results are cached
+        :param window: latency percentiles are computed over the latest `window` requests
+        """
+        self.model = model
+        self.mc = mc
+        self.cache_size = cache_size
+        self.__cache: OrderedDict = OrderedDict()
+        self.__latencies = deque(maxlen=window)
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__hits = 0
+        self.__misses = 0
+        pass
+
+    def score(self, passwords: List[str]) -> List[Dict[str, Any]]:
+        """
+        :param passwords: passwords to be scored
+        :return: minus log prob and guess number of each password
+        """
+        start_at = time.perf_counter()
+        mlps = numpy.empty(len(passwords))
+        missing = []
+        with self.__lock:
+            for i, pwd in enumerate(passwords):
+                if pwd in self.__cache:
+                    self.__cache.move_to_end(pwd)
+                    mlps[i] = self.__cache[pwd]
+                else:
+                    missing.append(i)
+            self.__hits += len(passwords) - len(missing)
+            self.__misses += len(missing)
+        for i, (mlp, _) in zip(missing, self.model.score_chunk([passwords[i] for i in missing])):
+            mlps[i] = mlp
+        with self.__lock:
+            for i in missing:
+                self.__cache[passwords[i]] = mlps[i]
+            while len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        guesses = numpy.ceil(self.mc.ml2p_arr2position(mlps))
+        results = [{"password": pwd, "minus_log_prob": mlp, "guesses": int(gn)}
+                   for pwd, mlp, gn in zip(passwords, mlps.tolist(), guesses.tolist())]
+        with self.__lock:
+            self.__requests += 1
+            self.__latencies.append((time.perf_counter() - start_at) * 1000)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        with self.__lock:
+            latencies = numpy.array(self.__latencies)
+            stats = {"requests": self.__requests, "cache_hits": self.__hits, "cache_misses": self.__misses,
+                     "cached": len(self.__cache), "samples": len(self.mc)}
+        if len(latencies) > 0:
+            p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99]).tolist()
+            stats["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99, "max": float(latencies.max()),
+                                   "window": len(latencies)}
+        return stats
+
+
+def make_handler(service: ScoringService):
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            # client_address is empty for unix sockets
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+        def __reply(self, code: int, body: Dict[str, Any]):
+            content = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def __rank(self, passwords: List[str]):
+            start_at = time.perf_counter()
+            results = service.score(passwords)
+            self.__reply(200, {"results": results, "latency_ms": (time.perf_counter() - start_at) * 1000})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                self.__reply(200, service.stats())
+            elif url.path == "/rank":
+                self.__rank(parse_qs(url.query, keep_blank_values=True).get("password", []))
+            else:
+                self.__reply(404, {"error": f"unknown path {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/rank":
+                self.__reply(404, {"error": f"unknown path {url.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                passwords = body.get("passwords") if isinstance(body, dict) else None
+                if not isinstance(passwords, list) or not all(isinstance(p, str) for p in passwords):
+                    raise ValueError("`passwords` should be a list of strings")
+            except ValueError as e:
+                self.__reply(400, {"error": str(e)})
+                return
+            self.__rank(passwords)
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def load_model(args) -> (MonteCarlo, str):
+    """
+    :return: the model and its fingerprint
+    """
+    if args.bpe is not None:
+        from bpe_simulator import BpePcfgSim
+        return BpePcfgSim(model_path=args.bpe), fingerprint(BpePcfgSim.__name__, Path(args.bpe))
+    secondary = args.secondary
+    if args.model is not None:
+        # the config saved with the model tells the family: n of n-gram models, threshold of backoff models
+        header, _ = read_model_header(args.model)
+        config = header['config']
+        if 'n' in config:
+            from nwords_simulator import NWordsMonteCarlo
+            return NWordsMonteCarlo.from_model(args.model), fingerprint(NWordsMonteCarlo.__name__, Path(args.model))
+        if 'threshold' not in config:
+            raise Exception(f"{args.model} is neither an n-gram model nor a backoff model, "
+                            f"its config has no `n` or `threshold`")
+        secondary = args.model
+    from backwords_secondary_simulator import BackWordsSecondaryMonteCarlo
+    with open(secondary, 'rb') as fin:
+        model_fingerprint = fingerprint(BackWordsSecondaryMonteCarlo.__name__, fin)
+        return BackWordsSecondaryMonteCarlo(fin, max_iter=args.max_iter), model_fingerprint
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Password strength scoring server")
+    models = cli.add_mutually_exclusive_group(required=True)
+    models.add_argument("--secondary", dest="secondary", type=str, default=None,
+                        help="model trained by backwords_secondary_trainer.py or backwords_secondary_main.py")
+    models.add_argument("--bpe", dest="bpe", type=str, default=None, help="model folder of BPE PCFG")
+    models.add_argument("--model", dest="model", type=str, default=None,
+                        help="model file in the binary format (see lib4mc/SaveModelLib.py), e.g., saved by "
+                             "compact_model.py or convert_model.py. N-gram and backoff models are told by the config")
+    cli.add_argument("--table", dest="table", type=str, required=True,
+                     help="rank table of the model, sample `size` passwords and save the table here if the table "
+                          "does not exist or was built for another model")
+    cli.add_argument("--size", dest="size", type=int, required=False, default=1000000, help="sample size")
+    cli.add_argument("--max-iter", dest="max_iter", required=False, default=10 ** 20, type=int,
+                     help="max iteration when calculating the maximum probability of a password")
+    cli.add_argument("--host", dest="host", type=str, required=False, default="127.0.0.1", help="listen on host")
+    cli.add_argument("--port", dest="port", type=int, required=False, default=8964, help="listen on port")
+    cli.add_argument("--unix", dest="unix", type=str, required=False, default=None,
+                     help="listen on this unix socket instead of host:port")
+    cli.add_argument("--cache-size", dest="cache_size", type=int, required=False, default=1000000,
+                     help="max number of passwords whose results are cached")
+    cli.add_argument("--window", dest="window", type=int, required=False, default=10000,
+                     help="latency percentiles are computed over the latest `window` requests")
+    args = cli.parse_args()
+    # a stale socket left by a previous server is removed before listening, anything else is never removed
+    if args.unix is not None and os.path.exists(args.unix) and not stat.S_ISSOCK(os.stat(args.unix).st_mode):
+        cli.error(f"{args.unix} exists and is not a unix socket")
+    model, model_fingerprint = load_model(args)
+    mc = model.rank_table(size=args.size, table=args.table, model_fingerprint=model_fingerprint)
+    service = ScoringService(model, mc, cache_size=args.cache_size, window=args.window)
+    handler = make_handler(service)
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = ThreadingUnixHTTPServer(args.unix, handler)
+        print(f"Serving on unix socket {args.unix}", file=sys.stderr)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped", file=sys.stderr)
+    finally:
+        server.server_close()
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
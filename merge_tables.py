@@ -0,0 +1,28 @@
+"""
+Merge rank tables sampled independently from the same model
+"""
+import argparse
+import sys
+
+from lib4mc.MonteCarloLib import MonteCarloLib
+from lib4mc.PerfLib import add_perf_arguments, instrument
+
+
+def wrapper():
+    cli = argparse.ArgumentParser("Merge Monte Carlo rank tables")
+    cli.add_argument("-i", "--tables", dest="tables", type=str, nargs="+", required=True,
+                     help="rank tables (shards) saved by the simulators using `--table`")
+    cli.add_argument("-s", "--save", dest="save", type=str, required=True,
+                     help="save the merged rank table here, could be one of the input tables")
+    cli.add_argument("--chunk", dest="chunk", type=int, required=False, default=1 << 20,
+                     help="number of samples of each shard loaded at a time")
+    add_perf_arguments(cli)
+    args = cli.parse_args()
+    instrument(args)
+    mc = MonteCarloLib.from_shards(args.tables, path=args.save, chunk=args.chunk)
+    print(f"{len(args.tables)} tables merged, {len(mc)} samples in {args.save}", file=sys.stderr)
+    pass
+
+
+if __name__ == '__main__':
+    wrapper()
@@ -3,11 +3,12 @@ N words
 """
 import re
 from collections import defaultdict
+from functools import partial
 from typing import TextIO, Dict, Tuple
 
-from tqdm import tqdm
-
-from lib4mc.FileLib import wc_l
+from lib4mc.CountLib import count_sections
+from lib4mc.FlatLib import FlatModel
+from lib4mc.PerfLib import progress
 
 
 def parse_line(line: str, splitter: str, start4words: int, skip4words: int):
@@ -20,34 +21,36 @@ def parse_line(line: str, splitter: str, start4words: int, skip4words: int):
 
 
 def nwords_counter(nwords_list: TextIO, n: int, splitter: str, end_chr: str, start4words: int,
-                   skip4words: int, start_chr: str = '\x00'):
+                   skip4words: int, start_chr: str = '\x00', flat: bool = False, workers: int = 1):
+    """
+    :param flat: return the model as a FlatModel instead of dicts
+    :param workers: number of processes to count the lines, see lib4mc.CountLib.count_sections
+    :return: model, i.e., prefix -> (transition -> prob), and the counts of words
+    """
     nwords_dict: Dict[Tuple, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
     prefix_words_num = n - 1
-    line_num = wc_l(nwords_list)
-    section_dict = defaultdict(int)
     words: Dict[str, int] = defaultdict(int)
     # default_start = start_chr * (n - 1)
-    for line in tqdm(nwords_list, total=line_num, desc="Reading: "):  # type: str
-        line = line.strip("\r\n")
-        sections = [start_chr for _ in range(n - 1)]
-        extends = parse_line(line, splitter, start4words, skip4words)
-        sections.extend(extends)
-        sections.append(end_chr)
-        for sec in sections:
-            words[sec] += 1
-        section_dict[tuple(sections)] += 1
+    section_dict = count_sections(
+        nwords_list, partial(parse_line, splitter=splitter, start4words=start4words, skip4words=skip4words),
+        head=tuple([start_chr for _ in range(n - 1)]), tail=(end_chr,), workers=workers)
     nwords_list.close()
-    for sections, cnt in tqdm(section_dict.items(), desc="Counting: "):
+    for sections, cnt in progress(section_dict.items(), desc="Counting: "):
+        # the unique sections are in the order of first appearance, so are the words
+        for sec in sections:
+            words[sec] += cnt
         for i in range(len(sections) - prefix_words_num):
             grams = tuple(sections[i:i + prefix_words_num])
             transition = sections[i + prefix_words_num]
             nwords_dict[grams][transition] += cnt
     del section_dict
     nwords_float_dict: Dict[Tuple, Dict[str, float]] = {}
-    for prefix, ends in tqdm(nwords_dict.items(), "Converting: "):
+    for prefix, ends in progress(nwords_dict.items(), "Converting: "):
         nwords_float_dict[prefix] = {}
         total = sum(ends.values())
         for e, v in ends.items():
             nwords_float_dict[prefix][e] = (v / total)
     del nwords_dict
+    if flat:
+        return FlatModel.from_dict(nwords_float_dict, consume=True), words
     return nwords_float_dict, words
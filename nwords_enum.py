@@ -1,12 +1,14 @@
 import argparse
 
+from lib4mc.FileLib import input_file
+from lib4mc.PerfLib import add_perf_arguments, instrument
 from nwords.nwords_enumerator import enumerator
 from nwords.nwords_trainer import nwords_counter
 
 
 def wrapper():
     cli = argparse.ArgumentParser("Backoff Enumerator")
-    cli.add_argument("-f", '--pwd-file', dest="pwd_file", required=True, type=argparse.FileType('r'),
+    cli.add_argument("-f", '--pwd-file', dest="pwd_file", required=True, type=input_file,
                      help="Training file")
     cli.add_argument("-n", '--ngram', dest="ngram", required=True, type=int,
                      help="ngram of the model")
@@ -23,13 +25,17 @@ def wrapper():
                      help="Minimal length of password candidates")
     cli.add_argument("-s", '--save', dest="f_save", required=True, type=argparse.FileType('w'),
                      help="save password candidates here")
+    cli.add_argument("--flat", dest="flat", required=False, action="store_true",
+                     help="keep the model in contiguous arrays with interned tokens, which takes much less memory")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
     splitter_map = {"empty": "", "space": " ", "tab": "\t"}
     splitter = splitter_map[args.splitter]
     nwords_dict_float, _ = nwords_counter(
         args.pwd_file, n=args.ngram, splitter=splitter,
         end_chr='\x00', start_chr='\x03',
-        start4words=args.start4words, skip4words=args.skip4words)
+        start4words=args.start4words, skip4words=args.skip4words, flat=args.flat)
     enumerator(nwords_dict_float, threshold=args.min_prob, end_chr='\x00', start_chr='\x03',
                min_len=args.min_len, f_save=args.f_save, order=args.ngram - 1)
     pass
@@ -2,23 +2,37 @@
 Simulator for N Words
 """
 import argparse
-from typing import TextIO, List, Union, Tuple
+import random
+from pathlib import Path
+from typing import TextIO, List, Union, Tuple, Dict, Sequence
 
-from lib4mc.MonteCarloLib import MonteCarloLib
-from lib4mc.MonteCarloParent import MonteCarlo
-from lib4mc.ProbLib import expand_2d, pick_expand
+import numpy
+
+from lib4mc.FileLib import input_file
+from lib4mc.FlatLib import FlatModel
+from lib4mc.LockstepLib import LockstepSampler
+from lib4mc.MonteCarloLib import fingerprint
+from lib4mc.MonteCarloParent import MonteCarlo, add_simulator_arguments, check_simulator_arguments
+from lib4mc.PerfLib import add_perf_arguments, instrument
+from lib4mc.ProbLib import ALIAS_MIN, TemperedExpanded, lazy_expand_2d, pick_expand
+from lib4mc.SaveModelLib import MappedModel, open_model, share_model
 from nwords.nwords_trainer import nwords_counter
 
 
 class NWordsMonteCarlo(MonteCarlo):
     def __init__(self, training_set: Union[TextIO, None], n: int = 2, splitter: str = ' ', start4word: int = 0,
                  skip4word: int = 1, start_chr="\x00",
-                 end_chr: str = "\x03"):
+                 end_chr: str = "\x03", max_contexts: int = None, flat: bool = False, workers: int = 1):
+        # temperature -> tempered proposals of the contexts (TemperedExpanded), built when first reached
+        self._tempered = {}
+        # number of chains advanced in lockstep when sampling, 0 to draw samples one by one by sample1
+        self.lockstep = 0
+        self._lockstep_sampler = None
         if training_set is None:
             return
         nwords, words = nwords_counter(training_set, n, splitter, end_chr, start4word, skip4word,
-                                       start_chr=start_chr)
-        self.nwords = expand_2d(nwords)
+                                       start_chr=start_chr, flat=flat, workers=workers)
+        self.nwords = lazy_expand_2d(nwords, alias=ALIAS_MIN, max_contexts=max_contexts)
         self.__n = n
         self.words = words
         self.end_chr = end_chr
@@ -27,6 +41,25 @@ class NWordsMonteCarlo(MonteCarlo):
         self.start_chr = start_chr
         pass
 
+    @classmethod
+    def from_model(cls, path: str, max_contexts: int = None) -> "NWordsMonteCarlo":
+        """
+        :param path: model file in the binary format (see lib4mc/SaveModelLib.py), e.g., saved by compact_model.py,
+            whose config holds n, start_chr and end_chr
+        :param max_contexts: see LazyExpanded
+        :return: the simulator of the model
+        """
+        sections, words, config = open_model(path)
+        nword_mc = cls(None)
+        nword_mc.nwords = lazy_expand_2d(sections['probs'], alias=ALIAS_MIN, max_contexts=max_contexts)
+        nword_mc.__n = config['n']
+        nword_mc.words = words
+        nword_mc.end_chr = config['end_chr']
+        nword_mc.min_len = 4
+        nword_mc.default_start = tuple([config['start_chr'] for _ in range(config['n'] - 1)])
+        nword_mc.start_chr = config['start_chr']
+        return nword_mc
+
     def _get_prefix(self, pwd: Union[List, Tuple], transition: str):
         if len(pwd) < self.__n:
             return tuple(pwd)
@@ -95,7 +128,7 @@ class NWordsMonteCarlo(MonteCarlo):
         pwd_len = 0
         while True:
             tar = self._get_prefix(pwd, "")
-            p, addon = pick_expand(self.nwords.get(tar))
+            p, addon = pick_expand(self.nwords.get(tar), self.rng)
             prob += self.minus_log2(p)
             if addon == self.end_chr:
                 if pwd_len >= self.min_len:
@@ -115,16 +148,114 @@ class NWordsMonteCarlo(MonteCarlo):
                 pwd_len = 0
         return prob, "".join([c for c in pwd if c != self.start_chr])
 
+    def sample1_tempered(self, temperature: float) -> (float, float, str, int):
+        if temperature not in self._tempered:
+            self._tempered[temperature] = TemperedExpanded(self.nwords, temperature,
+                                                           max_contexts=self.nwords.max_contexts)
+        tempered = self._tempered[temperature]
+        pwd = self.default_start
+        prob, proposal = .0, .0
+        pwd_len = 0
+        draws = 1
+        while True:
+            tar = self._get_prefix(pwd, "")
+            expanded = self.nwords.get(tar)
+            q, addon = pick_expand(tempered[tar], self.rng)
+            prob += self.minus_log2(expanded[0].get(addon))
+            proposal += self.minus_log2(q)
+            if addon == self.end_chr:
+                if pwd_len >= self.min_len:
+                    break
+                else:
+                    pwd = self.default_start
+                    prob, proposal = .0, .0
+                    pwd_len = 0
+                    draws += 1
+                    continue
+            _tmp = list(pwd)
+            _tmp.append(addon)
+            pwd = tuple(_tmp)
+            pwd_len += len(addon)
+            if pwd_len >= 256:
+                pwd = self.default_start
+                prob, proposal = .0, .0
+                pwd_len = 0
+                draws += 1
+        return prob, proposal, "".join([c for c in pwd if c != self.start_chr]), draws
+
+    def _next_context(self, ctx: Tuple, token: str) -> Tuple:
+        return self._get_prefix(ctx + (token,), "")
+
+    def share(self):
+        if isinstance(self.nwords, MappedModel):
+            # published already, or mapped from a model file whose pages are shared anyway
+            return
+        nwords = self.nwords
+        flat = nwords if isinstance(nwords, FlatModel) else FlatModel.from_dict(nwords.two_d_dict)
+        self.nwords = share_model({'probs': flat}, minus_log_based=nwords.minus_log_based, alias=nwords.alias,
+                                   max_contexts=nwords.max_contexts)['probs']
+        self._lockstep_sampler = None
+        self._tempered = {}
+        pass
+
+    def lockstep_sampler(self) -> LockstepSampler:
+        """
+        the arrays of the model for sampling in lockstep, built when first used.
+        For backoff models, the context reached is the longest suffix of the previous context and the token,
+        which is the same as the one found in the whole prefix as long as the suffixes of a context are contexts
+        :return: LockstepSampler
+        """
+        if self._lockstep_sampler is None:
+            self._lockstep_sampler = LockstepSampler(
+                self.nwords, self._get_prefix(self.default_start, ""), self._next_context, self.end_chr,
+                min_len=self.min_len)
+        return self._lockstep_sampler
+
+    def sample_lockstep(self, size: int, width: int = 4096, keep_passwords: bool = False,
+                        seed: Union[int, Sequence[int], numpy.random.SeedSequence, None] = None) \
+            -> Tuple[numpy.ndarray, Union[List[str], None]]:
+        """
+        draw samples by advancing `width` chains in lockstep, see LockstepSampler.sample
+        :param size: sample size
+        :param width: number of chains
+        :param keep_passwords: whether to return the sampled passwords
+        :param seed: seed of numpy.random.default_rng
+        :return: minus log probs of the samples, and the sampled passwords (None if keep_passwords is False)
+        """
+        return self.lockstep_sampler().sample(size, numpy.random.default_rng(seed), width=width,
+                                              keep_passwords=keep_passwords)
+
+    def draw_chunk(self, seed_seq: numpy.random.SeedSequence, size: int, temperature: Union[float, None],
+                   keep_samples: bool) \
+            -> Tuple[List[float], Union[List[float], None], Union[Dict[str, List], None], int]:
+        if self.lockstep <= 0 or temperature is not None:
+            return super().draw_chunk(seed_seq, size, temperature, keep_samples)
+        results, passwords = self.sample_lockstep(size, width=self.lockstep, keep_passwords=keep_samples,
+                                                  seed=seed_seq)
+        results = results.tolist()
+        return results, None, self.count_samples(results, passwords) if keep_samples else None, size
+
+    def sample(self, size: int, sampled_pwds: Dict[str, List] = None, clearIfNotNone: bool = True,
+               workers: int = 1, seed: Union[int, Sequence[int], None] = None) -> List[float]:
+        if self.lockstep > 0:
+            # build the arrays before forking the workers, and draw the samples in chunks
+            self.lockstep_sampler()
+            if seed is None:
+                seed = random.getrandbits(64)
+        return super().sample(size, sampled_pwds=sampled_pwds, clearIfNotNone=clearIfNotNone, workers=workers,
+                              seed=seed)
+
 
 def wrapper():
     cli = argparse.ArgumentParser("N words simulator")
-    cli.add_argument("-i", "--input", dest="input", type=argparse.FileType('r'), required=True, help="nwords file")
-    cli.add_argument("-t", "--test", dest="test", type=argparse.FileType('r'), required=True, help="testing file")
-    cli.add_argument("-s", "--save", dest="save", type=argparse.FileType('w'), required=True,
-                     help="save Monte Carlo results here")
+    models = cli.add_mutually_exclusive_group(required=True)
+    models.add_argument("-i", "--input", dest="input", type=input_file, help="nwords file")
+    models.add_argument("-m", "--model", dest="model", type=str,
+                        help="model file in the binary format, e.g., saved by compact_model.py")
+    cli.add_argument("-t", "--test", dest="test", type=input_file, required=True, help="testing file")
+    add_simulator_arguments(cli, trains=True)
     cli.add_argument("-n", "--ngram", dest="ngram", type=int, required=False, default=2, choices=[2, 3, 4, 5, 6],
                      help="ngram")
-    cli.add_argument("--size", dest="size", type=int, required=False, default=100000, help="sample size")
     cli.add_argument("--splitter", dest="splitter", type=lambda x: str(x).replace("\\\\", "\\"), required=False,
                      default="\t",
                      help="how to divide different columns from the input file. "
@@ -136,16 +267,40 @@ def wrapper():
     cli.add_argument("--skip4word", dest="skip4word", type=int, required=False, default=1,
                      help="there may be other elements between words, such as tags. "
                           "Set skip4word larger than 1 to skip unwanted elements.")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
+    check_simulator_arguments(cli, args)
     if args.splitter == 'empty':
         args.splitter = ''
-    nword_mc = NWordsMonteCarlo(args.input, splitter=args.splitter, n=args.ngram, start4word=args.start4word,
-                                skip4word=args.skip4word)
-    ml2p_list = nword_mc.sample(size=args.size)
-    mc = MonteCarloLib(ml2p_list)
-    scored_testing = nword_mc.parse_file(args.test)
-    mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
-    mc.write2(args.save)
+    if args.model is not None:
+        model_fingerprint = fingerprint(NWordsMonteCarlo.__name__, Path(args.model))
+        nword_mc = NWordsMonteCarlo.from_model(args.model, max_contexts=args.max_contexts)
+    else:
+        model_fingerprint = fingerprint(NWordsMonteCarlo.__name__, args.input, args.splitter, args.ngram,
+                                        args.start4word, args.skip4word)
+        nword_mc = NWordsMonteCarlo(args.input, splitter=args.splitter, n=args.ngram, start4word=args.start4word,
+                                    skip4word=args.skip4word, max_contexts=args.max_contexts, flat=args.flat,
+                                    workers=args.workers)
+    nword_mc.lockstep = args.lockstep
+    nword_mc.shared = args.shared
+    mc = nword_mc.rank_table(size=args.size, table=args.table, model_fingerprint=model_fingerprint,
+                             grow=args.grow, rel_err=args.adaptive, guesses=args.checkpoints,
+                             time_budget=args.time_budget, temperature=args.temperature,
+                             workers=args.workers, seed=args.seed, max_samples=args.max_samples)
+    if args.stream:
+        total, scored_testing = nword_mc.parse_file_stream(args.test, workers=args.workers,
+                                                           max_entries=args.max_entries)
+        mc.write_stream(scored_testing, total, args.save)
+    else:
+        scored_testing = nword_mc.parse_file(args.test, workers=args.workers)
+        mc.rank_scored(minus_log_prob_iter=scored_testing)
+        mc.write_results(save=args.save, curve=args.curve, binary=args.binary)
+    if args.adaptive is not None:
+        results = args.save.name if args.save is not None else args.curve.name if args.curve is not None \
+            else args.binary
+        with open(f"{results}.bounds.json", 'w') as fout_bounds:
+            mc.write_rank_errors(fout_bounds, args.checkpoints)
     pass
 
 
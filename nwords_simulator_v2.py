@@ -2,16 +2,18 @@ import argparse
 import sys
 from typing import TextIO
 
+from lib4mc.FileLib import input_file
 from lib4mc.MonteCarloLib import MonteCarloLib
 from lib4mc.MonteCarloParent import MonteCarlo
-from lib4mc.ProbLib import expand_2d, pick_expand
+from lib4mc.PerfLib import add_perf_arguments, instrument
+from lib4mc.ProbLib import ALIAS_MIN, expand_2d, pick_expand
 from nwords_v2.nwords_trainer_v2 import nwords_counter
 
 
 class NWords2MonteCarlo(MonteCarlo):
     def __init__(self, training_set: TextIO, n: int, end_chr: str = "\x03"):
         nwords, words = nwords_counter(training_set, n, end_chr)
-        self.__nwords = expand_2d(nwords)
+        self.__nwords = expand_2d(nwords, alias=ALIAS_MIN)
         self.__n = n
         self.__words = words
         self.end_chr = end_chr
@@ -63,9 +65,9 @@ class NWords2MonteCarlo(MonteCarlo):
         pwd_len = 0
         while True:
             if pwd_len < self.__n:
-                p, addon = pick_expand(self.__nwords.get(pwd))
+                p, addon = pick_expand(self.__nwords.get(pwd), self.rng)
             else:
-                p, addon = pick_expand(self.__nwords.get(pwd[1 - self.__n:]))
+                p, addon = pick_expand(self.__nwords.get(pwd[1 - self.__n:]), self.rng)
             prob += self.minus_log2(p)
             if addon == self.end_chr:
                 if pwd_len > 3:
@@ -97,13 +99,16 @@ def test():
 
 def main():
     cli = argparse.ArgumentParser("NWords v2")
-    cli.add_argument("-f", "--file", dest="training", required=True, type=argparse.FileType("r"), help="training set")
-    cli.add_argument("-t", "--target", dest="testing", required=True, type=argparse.FileType("r"), help="testing set")
+    cli.add_argument("-f", "--file", dest="training", required=True, type=input_file, help="training set")
+    cli.add_argument("-t", "--target", dest="testing", required=True, type=input_file, help="testing set")
     cli.add_argument("-s", "--save", dest="save", required=False, default=sys.stdout, type=argparse.FileType("w"),
                      help="save results")
+    cli.add_argument("--size", dest="size", type=int, required=False, default=100000, help="sample size")
+    add_perf_arguments(cli)
     args = cli.parse_args()
+    instrument(args)
     nwmc = NWords2MonteCarlo(args.training, 4)
-    ml2p_list = nwmc.sample()
+    ml2p_list = nwmc.sample(size=args.size)
     mc = MonteCarloLib(ml2p_list)
     scored_testing = nwmc.parse_file(args.testing)
     mc.ml2p_iter2gc(minus_log_prob_iter=scored_testing)
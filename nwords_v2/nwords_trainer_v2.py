@@ -4,19 +4,17 @@ N words v2
 from collections import defaultdict
 from typing import TextIO, Dict, Tuple
 
-from tqdm import tqdm
-
-from lib4mc.FileLib import wc_l
+from lib4mc.FileLib import read_lines
+from lib4mc.PerfLib import progress
 
 
 def nwords_counter(nwords_list: TextIO, n: int = 4, end_chr: str = "\x03", threshold: int = 10):
     nwords_dict: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
     prefix_words = n - 1
-    line_num = wc_l(nwords_list)
     section_dict = defaultdict(int)
     words: Dict[str, int] = defaultdict(int)
 
-    for line in tqdm(nwords_list, total=line_num, desc="Parsing: "):  # type: str
+    for line in read_lines(nwords_list, desc="Parsing: "):  # type: str
         line = line.strip("\r\n")
         items = line.split("\t")
         pwd = items[0] + end_chr
@@ -34,7 +32,7 @@ def nwords_counter(nwords_list: TextIO, n: int = 4, end_chr: str = "\x03", thres
         section_dict[tuple(sections)] += 1
     needed = {k: v for k, v in words.items() if v >= threshold}
     nwords_list.close()
-    for sections, cnt in tqdm(section_dict.items(), desc="Counting: "):
+    for sections, cnt in progress(section_dict.items(), desc="Counting: "):
         n_sections = []
         for i, sec in enumerate(sections):
             if sec in needed:
@@ -47,7 +45,7 @@ def nwords_counter(nwords_list: TextIO, n: int = 4, end_chr: str = "\x03", thres
             prev_chrs = f"{prev_chrs}{sec}"[-prefix_words:]
     del section_dict
     nwords_float_dict: Dict[str, Dict[str, float]] = {}
-    for prefix, ends in tqdm(nwords_dict.items(), "Converting: "):
+    for prefix, ends in progress(nwords_dict.items(), "Converting: "):
         nwords_float_dict[prefix] = {}
         total = sum(ends.values())
         for e, v in ends.items():
@@ -0,0 +1,56 @@
+import os
+import random
+import tempfile
+import unittest
+
+import numpy
+
+from nwords_simulator import NWordsMonteCarlo
+
+
+def synthetic_training(n: int, seed: int):
+    """
+    passwords of 4 to 20 letters from a skewed alphabet, so that the lengths and the probs spread widely
+    """
+    rng = numpy.random.default_rng(seed)
+    letters = list("abcdefghijklmnop")
+    weights = 0.6 ** numpy.arange(len(letters))
+    weights /= weights.sum()
+    return ["".join(rng.choice(letters, size=rng.integers(4, 21), p=weights)) for _ in range(n)]
+
+
+class TestLockstep(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "training.txt")
+            with open(path, 'w') as fout:
+                fout.write("\n".join(synthetic_training(20000, seed=1)) + "\n")
+            with open(path) as fin:
+                cls.model = NWordsMonteCarlo(fin, n=3, splitter='')
+        random.seed(2)
+        cls.plain = numpy.array([cls.model.sample1()[0] for _ in range(20000)])
+
+    def assertSameMean(self, samples: numpy.ndarray):
+        # within 4 standard errors of the difference
+        err = 4 * (self.plain.var() / len(self.plain) + samples.var() / len(samples)) ** .5
+        self.assertLess(abs(samples.mean() - self.plain.mean()), err)
+
+    def test_width_equals_size(self):
+        # every chain started is a sample, the long chains of small probs are not left out
+        samples, _ = self.model.sample_lockstep(4096, width=4096, seed=3)
+        self.assertSameMean(samples)
+
+    def test_fewer_chains_than_samples(self):
+        samples, _ = self.model.sample_lockstep(20000, width=256, seed=4)
+        self.assertSameMean(samples)
+
+    def test_passwords(self):
+        samples, passwords = self.model.sample_lockstep(1000, width=4096, keep_passwords=True, seed=5)
+        self.assertEqual(len(passwords), 1000)
+        for mlp, pwd in zip(samples.tolist()[:100], passwords[:100]):
+            self.assertAlmostEqual(mlp, self.model.calc_ml2p(pwd)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()